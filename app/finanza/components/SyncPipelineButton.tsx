@@ -12,13 +12,24 @@ import {
 import { RefreshCcw, CheckCircle2, XCircle, Loader2, Clock } from "lucide-react"
 import { toast } from "sonner"
 
+interface StepProgress {
+  fase: string | null
+  totale: number | null
+  elaborati: number
+  abbinati: number
+  errori: number
+  velocita: number
+  eta_s: number | null
+}
+
 interface StepResult {
   name: string
   label: string
-  status: 'success' | 'error' | 'skipped'
+  status: 'pending' | 'running' | 'success' | 'error' | 'skipped'
   duration_ms: number
   data?: Record<string, unknown>
   error?: string
+  progress?: StepProgress
 }
 
 type TaskStatus = 'pending' | 'running' | 'completed' | 'error'
@@ -27,6 +38,8 @@ const STAT_LABELS: Record<string, string> = {
   nuove: 'Fatture nuove',
   scadenze_create: 'Scadenze create',
   scadenze_recuperate: 'Scadenze recuperate',
+  ddt_collegati: 'DDT collegati',
+  ddt_ambigui: 'DDT ambigui',
   skipped: 'Saltate',
   errori: 'Errori',
   orphans_found: 'Orfane trovate',
@@ -35,12 +48,25 @@ const STAT_LABELS: Record<string, string> = {
   da_pagare: 'Da pagare',
   pagate: 'Pagate',
   uploadati: 'PDF caricati',
+  riusati: 'PDF già su Storage',
   matchati: 'PDF associati',
+  fuzzy: 'PDF associati (fuzzy)',
+  da_revisionare: 'Abbinamenti da controllare',
   non_matchati: 'PDF non associati',
+  inseriti: 'Anagrafiche inserite',
+  aggiornati: 'Anagrafiche aggiornate',
+  fornitori: 'Fornitori',
+  importate: 'Fatture importate',
+  gia_presenti: 'Già presenti',
+  saltate: 'Saltate',
+  saltati: 'Saltati',
+  duplicati: 'Duplicati',
+  invariati: 'Anagrafiche invariate',
+  file_xml: 'File XML',
 }
 
 const POLL_INTERVAL_MS = 2000
-const TIMEOUT_MS = 5 * 60 * 1000 // 5 minuti
+const TIMEOUT_MS = 15 * 60 * 1000 // 15 minuti (gli step dipendenti girano in sequenza)
 
 function formatStatValue(key: string, value: unknown): string {
   if (typeof value === 'number' && (key.includes('importo') || key.includes('totale'))) {
@@ -49,10 +75,27 @@ function formatStatValue(key: string, value: unknown): string {
   return String(value)
 }
 
-function statusLabel(status: TaskStatus): string {
+function formatEta(secondi: number): string {
+  return secondi >= 60 ? `${Math.round(secondi / 60)} min` : `${secondi}s`
+}
+
+function progressLabel(step: StepResult): string | null {
+  const p = step.progress
+  if (!p || !p.totale) return null
+  const eta = p.eta_s != null && p.elaborati > 0 ? ` · ${formatEta(p.eta_s)}` : ''
+  return `${step.label} ${p.elaborati}/${p.totale}${eta}`
+}
+
+function statusLabel(status: TaskStatus, steps: StepResult[] | null): string {
   switch (status) {
     case 'pending':  return 'In attesa dell\'agent...'
-    case 'running':  return 'Aggiornamento...'
+    case 'running': {
+      // L'agent scrive lo stato e l'avanzamento di ogni step mentre il task e' in corso
+      if (!steps || steps.length === 0) return 'Aggiornamento...'
+      const finiti = steps.filter(s => !['pending', 'running'].includes(s.status)).length
+      const attivo = steps.map(progressLabel).find(Boolean)
+      return `Aggiornamento (${finiti}/${steps.length})${attivo ? ` — ${attivo}` : '...'}`
+    }
     default:         return 'Aggiornamento...'
   }
 }
@@ -78,7 +121,7 @@ export default function SyncPipelineButton() {
       stopPolling()
       setIsRunning(false)
       setTaskStatus(null)
-      toast.error('Timeout: l\'agent non ha risposto entro 5 minuti. Verifica che run_sync_agent.bat sia attivo.')
+      toast.error(`Timeout: l'agent non ha risposto entro ${TIMEOUT_MS / 60000} minuti. Verifica che run_sync_agent.bat sia attivo.`)
     }, TIMEOUT_MS)
 
     pollRef.current = setInterval(async () => {
@@ -91,7 +134,9 @@ export default function SyncPipelineButton() {
 
         setTaskStatus(status)
 
-        if (status === 'completed') {
+        if (status === 'running') {
+          setResults(data.results || null)
+        } else if (status === 'completed') {
           stopPolling()
           setIsRunning(false)
           const stepResults: StepResult[] = data.results || []
@@ -139,7 +184,7 @@ export default function SyncPipelineButton() {
     }
   }
 
-  const buttonLabel = isRunning && taskStatus ? statusLabel(taskStatus) : 'Aggiorna Dati'
+  const buttonLabel = isRunning && taskStatus ? statusLabel(taskStatus, results) : 'Aggiorna Dati'
 
   return (
     <>
@@ -0,0 +1,190 @@
+"""
+abbinamento_fuzzy.py
+====================
+Secondo passaggio di abbinamento PDF -> scadenza per i file rimasti senza
+scadenza dopo il match esatto di import_fatture_pdf (numero normalizzato +
+data, soggetto + data).
+
+Casi tipici nel log: il nome file porta solo il progressivo ("237_del_...")
+mentre la scadenza ha il numero completo ("FR A26\\237"), oppure la data del
+file differisce di qualche giorno da data_emissione.
+
+Ogni coppia (file, scadenza candidata) riceve un punteggio 0..1:
+  - numero:   uguale normalizzato 1.0; stesso ultimo gruppo di cifre 0.85;
+              uno suffisso dell'altro 0.75; altrimenti quota di suffisso /
+              prefisso comune
+  - data:     1 a data uguale, scende a 0 oltre TOLLERANZA_GIORNI
+  - soggetto: 1 se la PIVA del file e' del soggetto della scadenza, 0.5 se
+              la PIVA non e' nota, 0 se e' di un altro soggetto
+I candidati non vengono cercati su tutte le scadenze: solo nei blocchi
+(soggetto) e (ultimo gruppo di cifre del numero), filtrati per finestra di
+date. Sopra SOGLIA_AUTO (e con distacco dal secondo candidato) l'abbinamento
+e' applicato, tra SOGLIA_REVISIONE e SOGLIA_AUTO finisce nel report da
+controllare a mano.
+
+Il nome file non contiene l'importo: l'importo della scadenza compare nel
+report come aiuto alla revisione ma non entra nel punteggio.
+"""
+
+import csv
+import os
+import re
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import date
+
+TOLLERANZA_GIORNI = 10
+SOGLIA_AUTO = 0.85
+SOGLIA_REVISIONE = 0.6
+DISTACCO_MINIMO = 0.05      # sotto questo distacco dal secondo candidato: revisione
+
+PESO_NUMERO = 0.5
+PESO_DATA = 0.2
+PESO_SOGGETTO = 0.3
+
+
+@dataclass
+class Proposta:
+    nome_file: str
+    scadenza: dict
+    punteggio: float
+    numero: float
+    giorni: int
+    soggetto: float
+    distacco: float
+
+
+def _normalizza(s: str) -> str:
+    return re.sub(r"[/\\\s\-._]", "", s or "").upper()
+
+
+def _ultimo_gruppo(s: str) -> str | None:
+    """Ultimo gruppo di cifre senza zeri iniziali, saltando l'anno se c'e'
+    altro: "FR A26\\0237" -> "237", "5/2026" -> "5", "2026" -> "2026"."""
+    gruppi = re.findall(r"\d+", s or "")
+    senza_anno = [g for g in gruppi if not re.fullmatch(r"(19|20)\d\d", g)]
+    gruppi = senza_anno or gruppi
+    if not gruppi:
+        return None
+    return gruppi[-1].lstrip("0") or "0"
+
+
+def _comune(a: str, b: str) -> int:
+    return len(os.path.commonprefix([a, b]))
+
+
+def similarita_numero(numero_file: str, numero_scadenza: str) -> float:
+    a, b = _normalizza(numero_file), _normalizza(numero_scadenza)
+    if not a or not b:
+        return 0.0
+    if a == b:
+        return 1.0
+    ga, gb = _ultimo_gruppo(numero_file), _ultimo_gruppo(numero_scadenza)
+    if ga is not None and ga == gb:
+        return 0.85
+    if min(len(a), len(b)) >= 2 and (a.endswith(b) or b.endswith(a)):
+        return 0.75
+    suffisso = _comune(a[::-1], b[::-1])
+    prefisso = _comune(a, b)
+    return 0.6 * max(suffisso, prefisso) / max(len(a), len(b))
+
+
+class AbbinatoreFuzzy:
+    """Scadenze ancora libere indicizzate per soggetto e per ultimo gruppo di
+    cifre del numero; `abbina` assegna i file residui."""
+
+    def __init__(self, scadenze: list[dict]):
+        self._per_soggetto = defaultdict(list)
+        self._per_gruppo = defaultdict(list)
+        for sc in scadenze:
+            try:
+                sc["_data"] = date.fromisoformat(sc["data_emissione"][:10])
+            except (KeyError, TypeError, ValueError):
+                continue
+            if sc.get("soggetto_id"):
+                self._per_soggetto[sc["soggetto_id"]].append(sc)
+            gruppo = _ultimo_gruppo(sc.get("fattura_riferimento"))
+            if gruppo is not None:
+                self._per_gruppo[gruppo].append(sc)
+
+    def _candidati(self, numero: str, data_file: date, soggetto_id: str | None):
+        visti = set()
+        blocchi = [self._per_gruppo.get(_ultimo_gruppo(numero), [])]
+        if soggetto_id:
+            blocchi.append(self._per_soggetto.get(soggetto_id, []))
+        for blocco in blocchi:
+            for sc in blocco:
+                if sc["id"] in visti or abs((sc["_data"] - data_file).days) > TOLLERANZA_GIORNI:
+                    continue
+                visti.add(sc["id"])
+                yield sc
+
+    def punteggio(self, numero: str, data_file: date, soggetto_id: str | None, sc: dict):
+        n = similarita_numero(numero, sc.get("fattura_riferimento"))
+        giorni = abs((sc["_data"] - data_file).days)
+        d = max(0.0, 1 - giorni / (TOLLERANZA_GIORNI + 1))
+        if soggetto_id is None:
+            s = 0.5
+        else:
+            s = 1.0 if sc.get("soggetto_id") == soggetto_id else 0.0
+        return PESO_NUMERO * n + PESO_DATA * d + PESO_SOGGETTO * s, n, giorni, s
+
+    def abbina(self, residui: list[tuple[str, str, str, str | None]]) -> tuple[list[Proposta], list[Proposta]]:
+        """
+        `residui`: [(nome_file, numero, data_iso, soggetto_id)].
+        Ritorna (automatici, da_revisionare). Tutte le coppie (file, scadenza)
+        sopra SOGLIA_REVISIONE vengono assegnate in ordine di punteggio
+        decrescente (poi nome file e id, per avere lo stesso esito a ogni run):
+        se la scadenza migliore di un file e' gia' presa si passa alla sua
+        successiva. Il distacco e' misurato sul miglior altro candidato ancora
+        libero del file; ogni file e ogni scadenza al massimo una volta.
+        """
+        classifiche: dict[str, list] = {}
+        coppie = []
+        for nome_file, numero, data_iso, soggetto_id in residui:
+            try:
+                data_file = date.fromisoformat(data_iso)
+            except (TypeError, ValueError):
+                continue
+            valutate = sorted(
+                ((self.punteggio(numero, data_file, soggetto_id, sc), sc)
+                 for sc in self._candidati(numero, data_file, soggetto_id)),
+                key=lambda v: (-v[0][0], str(v[1]["id"])),
+            )
+            classifiche[nome_file] = valutate
+            coppie.extend((nome_file, v) for v in valutate if v[0][0] >= SOGLIA_REVISIONE)
+
+        automatici, da_revisionare = [], []
+        assegnate, decisi = set(), set()
+        for nome_file, ((tot, n, giorni, s), sc) in sorted(
+                coppie, key=lambda c: (-c[1][0][0], c[0], str(c[1][1]["id"]))):
+            if nome_file in decisi or sc["id"] in assegnate:
+                continue
+            secondo = next((v[0][0] for v in classifiche[nome_file]
+                            if v[1]["id"] != sc["id"] and v[1]["id"] not in assegnate), 0.0)
+            p = Proposta(nome_file, sc, round(tot, 3), round(n, 2), giorni, s, round(tot - secondo, 3))
+            decisi.add(nome_file)
+            if p.punteggio >= SOGLIA_AUTO and p.distacco >= DISTACCO_MINIMO:
+                assegnate.add(sc["id"])
+                automatici.append(p)
+            else:
+                da_revisionare.append(p)
+
+        # File con candidati validi tutti presi da altri: in revisione col migliore
+        for nome_file, ((tot, n, giorni, s), sc) in coppie:
+            if nome_file not in decisi:
+                decisi.add(nome_file)
+                da_revisionare.append(Proposta(nome_file, sc, round(tot, 3), round(n, 2), giorni, s, 0.0))
+        return automatici, da_revisionare
+
+
+def scrivi_report(percorso: str, proposte: list[Proposta]):
+    """CSV (separatore ;, si apre con Excel) degli abbinamenti da controllare."""
+    with open(percorso, "w", encoding="utf-8-sig", newline="") as f:
+        w = csv.writer(f, delimiter=";")
+        w.writerow(["file", "scadenza_id", "fattura_riferimento", "data_emissione", "importo",
+                    "punteggio", "sim_numero", "giorni_diff", "soggetto", "distacco_secondo"])
+        for p in proposte:
+            sc = p.scadenza
+            w.writerow([p.nome_file, sc["id"], sc.get("fattura_riferimento"), sc.get("data_emissione"),
+                        sc.get("importo_totale"), p.punteggio, p.numero, p.giorni, p.soggetto, p.distacco])
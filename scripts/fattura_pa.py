@@ -0,0 +1,388 @@
+"""
+fattura_pa.py
+=============
+Parser condiviso per le fatture elettroniche FatturaPA (XML SDI), usato da
+tutti gli script di importazione.
+
+Il file viene letto UNA sola volta (in binario) e analizzato in streaming con
+ET.iterparse, che riconosce da solo BOM ed encoding dichiarato nel prologo.
+I namespace vengono risolti sul singolo tag ("{uri}Nome" -> "Nome") senza
+riscrivere l'intero documento con regex, e ogni blocco (CedentePrestatore,
+DatiDDT, DettaglioLinee, DettaglioPagamento...) viene convertito in un oggetto
+tipizzato e poi liberato dalla memoria.
+
+Uso:
+    from fattura_pa import ddt_per_linea, leggi_fattura
+    fattura = leggi_fattura(percorso)
+    fattura.cedente.partita_iva, fattura.corpo.dati_generali.numero, ...
+    ddt_per_linea(fattura.corpo)   # {numero_linea: DDT} per le righe
+"""
+
+import codecs
+import hashlib
+import io
+import os
+import re
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass, field
+
+
+# ─── MODELLO ──────────────────────────────────────────────────────────────────
+
+@dataclass
+class Soggetto:
+    """CedentePrestatore / CessionarioCommittente."""
+    denominazione: str | None = None
+    nome: str | None = None
+    cognome: str | None = None
+    id_paese: str | None = None
+    partita_iva: str | None = None     # IdFiscaleIVA/IdCodice (grezzo, non normalizzato)
+    codice_fiscale: str | None = None
+    indirizzo: str | None = None
+    cap: str | None = None
+    comune: str | None = None
+    provincia: str | None = None
+    nazione: str | None = None
+
+    def nominativo(self, cognome_prima: bool = False) -> str | None:
+        """Denominazione, oppure Nome+Cognome per i professionisti."""
+        if self.denominazione:
+            return self.denominazione
+        parti = [self.cognome or "", self.nome or ""] if cognome_prima else [self.nome or "", self.cognome or ""]
+        return " ".join(parti).strip() or None
+
+
+@dataclass
+class DatiGeneraliDocumento:
+    tipo_documento: str | None = None
+    divisa: str | None = None
+    data: str | None = None
+    numero: str | None = None
+    importo_totale: float | None = None
+    causali: list[str] = field(default_factory=list)
+
+
+@dataclass
+class DatiDDT:
+    numero: str | None = None
+    data: str | None = None
+    riferimenti_linea: list[str] = field(default_factory=list)
+
+
+@dataclass
+class Linea:
+    """Singolo DettaglioLinee."""
+    numero_linea: str | None = None
+    descrizione: str | None = None
+    quantita: float | None = None
+    unita_misura: str | None = None
+    prezzo_unitario: float | None = None
+    prezzo_totale: float | None = None
+    codice_articolo: str | None = None   # primo CodiceArticolo/CodiceValore
+
+
+@dataclass
+class Pagamento:
+    """Singolo DettaglioPagamento (rata)."""
+    modalita: str | None = None
+    data_scadenza: str | None = None
+    importo: float | None = None
+
+
+@dataclass
+class Corpo:
+    """FatturaElettronicaBody (un file puo' contenerne piu' di uno, 'lotto')."""
+    dati_generali: DatiGeneraliDocumento = field(default_factory=DatiGeneraliDocumento)
+    ddt: list[DatiDDT] = field(default_factory=list)
+    linee: list[Linea] = field(default_factory=list)
+    condizioni_pagamento: str | None = None
+    pagamenti: list[Pagamento] = field(default_factory=list)
+
+
+@dataclass
+class FatturaPA:
+    nome_file: str | None = None
+    sha256: str | None = None          # hash dei byte letti (manifest incrementale)
+    versione: str | None = None
+    cedente: Soggetto | None = None
+    cessionario: Soggetto | None = None
+    corpi: list[Corpo] = field(default_factory=list)
+
+    @property
+    def corpo(self) -> Corpo | None:
+        """Primo FatturaElettronicaBody (come faceva root.find('.//FatturaElettronicaBody'))."""
+        return self.corpi[0] if self.corpi else None
+
+
+# ─── HELPERS ──────────────────────────────────────────────────────────────────
+
+def _local(tag) -> str:
+    """'{http://ivaservizi...}FatturaElettronica' -> 'FatturaElettronica'."""
+    if not isinstance(tag, str):
+        return ""
+    return tag.rsplit("}", 1)[-1] if tag[:1] == "{" else tag.split(":")[-1]
+
+
+def _testo(elem: ET.Element, path: str) -> str | None:
+    v = elem.findtext(path)
+    if v is None:
+        return None
+    v = v.strip()
+    return v or None
+
+
+def _numero(elem: ET.Element, path: str) -> float | None:
+    v = _testo(elem, path)
+    if v is None:
+        return None
+    try:
+        return float(v)
+    except ValueError:
+        return None
+
+
+def _soggetto(elem: ET.Element) -> Soggetto:
+    anag = elem.find("DatiAnagrafici")
+    sede = elem.find("Sede")
+    s = Soggetto()
+    if anag is not None:
+        s.denominazione = _testo(anag, ".//Denominazione")
+        s.nome = _testo(anag, ".//Nome")
+        s.cognome = _testo(anag, ".//Cognome")
+        s.id_paese = _testo(anag, "IdFiscaleIVA/IdPaese")
+        s.partita_iva = _testo(anag, "IdFiscaleIVA/IdCodice")
+        s.codice_fiscale = _testo(anag, "CodiceFiscale")
+    if sede is not None:
+        s.indirizzo = _testo(sede, "Indirizzo")
+        s.cap = _testo(sede, "CAP")
+        s.comune = _testo(sede, "Comune")
+        s.provincia = _testo(sede, "Provincia")
+        s.nazione = _testo(sede, "Nazione")
+    return s
+
+
+def _dati_generali(elem: ET.Element) -> DatiGeneraliDocumento:
+    return DatiGeneraliDocumento(
+        tipo_documento=_testo(elem, "TipoDocumento"),
+        divisa=_testo(elem, "Divisa"),
+        data=_testo(elem, "Data"),
+        numero=_testo(elem, "Numero"),
+        importo_totale=_numero(elem, "ImportoTotaleDocumento"),
+        causali=[c.text.strip() for c in elem.findall("Causale") if c.text and c.text.strip()],
+    )
+
+
+def _ddt(elem: ET.Element) -> DatiDDT:
+    return DatiDDT(
+        numero=_testo(elem, "NumeroDDT"),
+        data=_testo(elem, "DataDDT"),
+        riferimenti_linea=[r.text.strip() for r in elem.findall("RiferimentoNumeroLinea") if r.text],
+    )
+
+
+def _linea(elem: ET.Element) -> Linea:
+    return Linea(
+        numero_linea=_testo(elem, "NumeroLinea"),
+        descrizione=elem.findtext("Descrizione"),
+        quantita=_numero(elem, "Quantita"),
+        unita_misura=elem.findtext("UnitaMisura"),
+        prezzo_unitario=_numero(elem, "PrezzoUnitario"),
+        prezzo_totale=_numero(elem, "PrezzoTotale"),
+        codice_articolo=_testo(elem, "CodiceArticolo/CodiceValore"),
+    )
+
+
+def _pagamento(elem: ET.Element) -> Pagamento:
+    return Pagamento(
+        modalita=_testo(elem, "ModalitaPagamento"),
+        data_scadenza=_testo(elem, "DataScadenzaPagamento"),
+        importo=_numero(elem, "ImportoPagamento"),
+    )
+
+
+# ─── ENCODING ─────────────────────────────────────────────────────────────────
+
+_BOM = (
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+)
+_PROLOGO = re.compile(rb"""^\s*<\?xml[^>]*?\bencoding\s*=\s*["']([A-Za-z0-9._:-]+)["']""")
+
+# Dopo BOM ed encoding dichiarato: utf-8 rigoroso, poi cp1252 (gestionali
+# Windows che dichiarano utf-8 ma scrivono 'à' come 0xE0), infine latin-1
+# che decodifica qualsiasi sequenza di byte.
+_RIPIEGO = ("utf-8", "cp1252", "latin-1")
+
+
+def decodifica_xml(raw: bytes) -> tuple[str, str]:
+    """
+    Decodifica i byte di un XML senza perdere caratteri: BOM, poi encoding
+    del prologo <?xml ... encoding="..."?>, poi _RIPIEGO. Ogni tentativo
+    lavora sui byte gia' letti, il file non viene riletto.
+    Ritorna (testo, encoding usato).
+    """
+    for bom, encoding in _BOM:
+        if raw.startswith(bom):
+            return raw.decode(encoding), encoding
+
+    candidati = []
+    dichiarato = _PROLOGO.match(raw[:200])
+    if dichiarato:
+        candidati.append(dichiarato.group(1).decode("ascii").lower())
+    candidati.extend(e for e in _RIPIEGO if e not in candidati)
+
+    for encoding in candidati:
+        try:
+            return raw.decode(encoding), encoding
+        except (UnicodeDecodeError, LookupError):
+            continue
+    return raw.decode("latin-1"), "latin-1"   # non raggiungibile: latin-1 non fallisce
+
+
+# ─── PARSER ───────────────────────────────────────────────────────────────────
+
+def parse_fattura(sorgente, nome_file: str | None = None) -> FatturaPA:
+    """
+    Analizza una FatturaPA in un solo passaggio.
+    `sorgente` puo' essere bytes, str (XML gia' decodificato) o un file-object.
+    Solleva ET.ParseError se l'XML e' malformato.
+    """
+    if isinstance(sorgente, bytes):
+        sorgente = io.BytesIO(sorgente)
+    elif isinstance(sorgente, str):
+        sorgente = io.StringIO(sorgente)
+
+    fattura = FatturaPA(nome_file=nome_file)
+    corpo: Corpo | None = None
+    # Stack dei nomi locali aperti: serve a capire il contesto dei blocchi
+    # (es. DatiGeneraliDocumento dentro DatiGenerali del Body).
+    percorso: list[str] = []
+
+    for evento, elem in ET.iterparse(sorgente, events=("start", "end")):
+        if evento == "start":
+            nome = _local(elem.tag)
+            percorso.append(nome)
+            if nome == "FatturaElettronicaBody":
+                corpo = Corpo()
+                fattura.corpi.append(corpo)
+            elif nome == "FatturaElettronica" and len(percorso) == 1:
+                fattura.versione = elem.get("versione")
+            continue
+
+        # evento == "end": i figli sono gia' stati rinominati, quindi
+        # find/findtext funzionano con i nomi locali.
+        nome = percorso.pop()
+        elem.tag = nome
+
+        if nome == "CedentePrestatore" and "FatturaElettronicaHeader" in percorso:
+            fattura.cedente = _soggetto(elem)
+            elem.clear()
+        elif nome == "CessionarioCommittente" and "FatturaElettronicaHeader" in percorso:
+            fattura.cessionario = _soggetto(elem)
+            elem.clear()
+        elif corpo is None:
+            continue
+        elif nome == "DatiGeneraliDocumento":
+            corpo.dati_generali = _dati_generali(elem)
+            elem.clear()
+        elif nome == "DatiDDT":
+            corpo.ddt.append(_ddt(elem))
+            elem.clear()
+        elif nome == "DettaglioLinee":
+            corpo.linee.append(_linea(elem))
+            elem.clear()
+        elif nome == "CondizioniPagamento" and "DatiPagamento" in percorso:
+            if corpo.condizioni_pagamento is None:
+                corpo.condizioni_pagamento = (elem.text or "").strip() or None
+        elif nome == "DettaglioPagamento":
+            corpo.pagamenti.append(_pagamento(elem))
+            elem.clear()
+        elif nome in ("Allegati", "DatiRiepilogo", "DatiBeniServizi", "FatturaElettronicaBody"):
+            # Blocchi non usati (o gia' estratti): libera subito la memoria,
+            # gli Allegati in particolare contengono PDF in base64.
+            elem.clear()
+
+    return fattura
+
+
+def leggi_fattura(percorso: str) -> FatturaPA:
+    """
+    Legge il file con una sola read binaria e passa i byte al parser.
+    Se il file dichiara un encoding sbagliato (es. utf-8 ma scritto in cp1252)
+    il parser fallisce: i byte vengono decodificati con decodifica_xml (senza
+    scartare caratteri accentati) e analizzati di nuovo.
+    Solleva ET.ParseError se l'XML e' malformato anche cosi'.
+    """
+    with open(percorso, "rb") as f:
+        raw = f.read()
+    nome_file = os.path.basename(percorso)
+    try:
+        fattura = parse_fattura(raw, nome_file)
+    except ET.ParseError:
+        testo, _ = decodifica_xml(raw)
+        # Il prologo dichiarerebbe ancora l'encoding sbagliato: via, il testo e' gia' decodificato
+        fattura = parse_fattura(re.sub(r"^\ufeff?\s*<\?xml[^>]*\?>", "", testo, count=1), nome_file)
+    fattura.sha256 = hashlib.sha256(raw).hexdigest()
+    return fattura
+
+
+# ─── DDT PER RIGA ─────────────────────────────────────────────────────────────
+
+_DDT_IN_DESCRIZIONE = re.compile(r'(?:DDT|DOT|Doc|Bolla|Rif)\.?\s*(?:n\.?|nr\.?|n\s)?\s*0*(\d+)', re.IGNORECASE)
+
+
+def estrai_ddt_da_descrizione(descrizione: str | None) -> str | None:
+    """Numero DDT citato nella descrizione ("DOT 13176 del 01-12-2025" -> "13176")."""
+    if not descrizione:
+        return None
+    match = _DDT_IN_DESCRIZIONE.search(descrizione)
+    return match.group(1) if match else None
+
+
+def ddt_per_linea(corpo: Corpo, unisci_globali: bool = True) -> dict[str, str | None]:
+    """
+    DDT di ogni riga del corpo, {numero_linea: numero DDT}, con una sola
+    passata su DettaglioLinee. Priorita':
+      1) RiferimentoNumeroLinea dei DatiDDT
+      2) riga-header con prezzo 0 ("DOT 13176 del ...") seguita dalle righe
+         del DDT: usata solo se i DatiDDT non hanno riferimenti di linea e gli
+         header individuano almeno due DDT diversi
+      3) DDT senza riferimenti di linea: l'unico presente, o piu' DDT uniti
+         con "," ("13176,13177"); con unisci_globali=False piu' DDT non
+         vengono uniti e si passa al punto 4 (chi raggruppa le righe per DDT
+         non troverebbe nessuno dei due nella stringa unita)
+      4) numero DDT citato nella descrizione della riga
+    Le righe senza NumeroLinea non compaiono.
+    """
+    per_riferimento = {}
+    globali = []
+    for ddt in corpo.ddt:
+        if ddt.numero is None:
+            continue
+        if ddt.riferimenti_linea:
+            for r in ddt.riferimenti_linea:
+                per_riferimento[r] = ddt.numero
+        else:
+            globali.append(ddt.numero)
+    stringa_globali = ",".join(globali) if globali and (unisci_globali or len(globali) == 1) else None
+    usa_header = bool(globali) and not per_riferimento
+
+    per_header = {}
+    ripiego = {}
+    corrente = None
+    for linea in corpo.linee:
+        num = linea.numero_linea
+        if num is None:
+            continue
+        dalla_descrizione = estrai_ddt_da_descrizione(linea.descrizione)
+        if usa_header:
+            if dalla_descrizione and not linea.prezzo_totale:
+                corrente = dalla_descrizione
+            if corrente:
+                per_header[num] = corrente
+        ripiego[num] = per_riferimento.get(num) or stringa_globali or dalla_descrizione
+
+    if len(set(per_header.values())) < 2:
+        per_header = {}
+    return {num: per_header.get(num) or valore for num, valore in ripiego.items()}
@@ -1,248 +1,488 @@
+"""
+fatture_vendita_xml.py
+======================
+Importa le fatture di vendita XML (CessionarioCommittente = cliente) in
+fatture_vendita + fatture_vendita_righe e genera le scadenze di entrata.
+
+Import a blocchi (una manciata di richieste invece di 6-10 per fattura):
+  1. legge e analizza tutti i file della cartella
+  2. pre-carica anagrafica_soggetti, le fatture_vendita gia' presenti per
+     (numero_fattura, soggetto_id) e le scadenze con quei numeri
+  3. decide in memoria cosa inserire e scrive a blocchi: soggetti nuovi,
+     fatture, righe, scadenze; poi collega fatture e scadenze con una
+     chiamata (RPC collega_scadenze_vendita)
+Idempotente: le fatture gia' importate vengono saltate; una fattura rimasta
+senza scadenza_id (run interrotto a meta') viene completata al run dopo.
+
+Uso:
+    python scripts/fatture_vendita_xml.py          # interattivo (chiede INVIO alla fine)
+    python scripts/fatture_vendita_xml.py --json   # non interattivo (sync_agent)
+
+Da codice (sync_agent in-process): esegui(client) -> dict contatori.
+"""
+
 import os
 import sys
+import json
 import traceback
-import xml.etree.ElementTree as ET
+from collections import Counter
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 from supabase import create_client, Client
 
-def main():
+from fattura_pa import Linea, ddt_per_linea, leggi_fattura
+from progresso import Progresso
+from supabase_utils import a_blocchi, scorri_tabella
+
+# Cartella di ricerca
+CARTELLA_VENDITE = r"C:\Users\Ufficio\Desktop\PROGETTO X\Sviluppo\fatture di vendita"
+
+BLOCCO_SCRITTURA = 200   # righe per insert
+BLOCCO_FILTRO = 100      # valori per filtro in_() (finiscono nell'URL)
+
+
+def crea_client() -> Client:
+    print("Inizializzazione script...")
+
+    # 1. Trova il file .env in modo dinamico
+    base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env_path = os.path.join(base_dir, '.env.local')
+    if not os.path.exists(env_path):
+        env_path = os.path.join(base_dir, '.env')
+
+    print(f"Cerco file variabili d'ambiente in: {env_path}")
+    load_dotenv(env_path)
+
+    SUPABASE_URL = os.getenv("NEXT_PUBLIC_SUPABASE_URL")
+    SUPABASE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
+
+    if not SUPABASE_URL or not SUPABASE_KEY:
+        raise ValueError(f"❌ CHIAVI MANCANTI. SUPABASE_URL: {'Trovato' if SUPABASE_URL else 'Mancante'}, SUPABASE_KEY: {'Trovato' if SUPABASE_KEY else 'Mancante'}")
+
+    print("Connessione a Supabase in corso...")
+    return create_client(SUPABASE_URL, SUPABASE_KEY)
+
+
+# ==========================================
+# FUNZIONE DI NORMALIZZAZIONE P.IVA E C.F.
+# ==========================================
+def pulisci_piva_cf(valore):
+    if not valore:
+        return None
+    v = valore.strip().upper()
+    # Rimuove prefisso IT se presente
+    if v.startswith('IT'):
+        v = v[2:]
+
+    # Se è composto interamente da numeri (P.IVA o CF numerico)
+    if v.isdigit():
+        # Rimuove eventuali zeri iniziali sporchi per avere la base numerica pura
+        v = v.lstrip('0')
+        # Aggiunge gli zeri in testa per forzare rigorosamente le 11 cifre italiane standard
+        v = v.zfill(11)
+    return v
+
+
+# ==========================================
+# LETTURA
+# ==========================================
+@dataclass
+class FatturaVendita:
+    """Dati di un XML di vendita che servono all'import."""
+    nome_file: str
+    ragione_sociale: str
+    piva: str | None
+    cf: str | None
+    numero: str | None
+    data: str | None
+    importo_totale: float
+    ddt_righe: dict[str, str | None]     # numero_linea -> un solo DDT (fattura_pa.ddt_per_linea)
+    linee: list[Linea]
+    rate: list[dict] = field(default_factory=list)   # scadenze da creare/ricollegare
+    soggetto_id: str | None = None
+    fattura_id: str | None = None
+    scadenza_id: str | None = None
+
+    @property
+    def chiave_soggetto(self) -> tuple[str, str]:
+        """Ricerca soggetto rigorosa: solo P.IVA se c'e', altrimenti solo CF,
+        altrimenti ragione sociale."""
+        if self.piva:
+            return "piva", self.piva
+        if self.cf:
+            return "cf", self.cf
+        return "rs", self.ragione_sociale
+
+
+def _chiave_soggetto_riga(riga: dict) -> tuple[str, str]:
+    if riga.get("partita_iva"):
+        return "piva", riga["partita_iva"]
+    if riga.get("codice_fiscale"):
+        return "cf", riga["codice_fiscale"]
+    return "rs", riga.get("ragione_sociale") or ""
+
+
+def _scadenza_default(data_fattura: str) -> str:
+    dt_fattura = datetime.strptime(data_fattura, "%Y-%m-%d")
+    return (dt_fattura + timedelta(days=30)).strftime("%Y-%m-%d")
+
+
+def leggi_fattura_vendita(file_path: str) -> FatturaVendita | None:
+    """Analizza l'XML; None se manca il cessionario. Solleva eccezione se il
+    file non e' importabile (XML malformato, data fattura assente...)."""
+    fattura = leggi_fattura(file_path)
+    corpo = fattura.corpo
+    cessionario = fattura.cessionario
+    if cessionario is None or corpo is None:
+        return None
+
+    dati_generali = corpo.dati_generali
+    f = FatturaVendita(
+        nome_file=os.path.basename(file_path),
+        ragione_sociale=cessionario.nominativo() or "",
+        piva=pulisci_piva_cf(cessionario.partita_iva),
+        cf=pulisci_piva_cf(cessionario.codice_fiscale),
+        numero=dati_generali.numero,
+        data=dati_generali.data,
+        importo_totale=dati_generali.importo_totale or 0.0,
+        # Un DDT per riga o nessuno: i report dei costi raggruppano per DDT
+        ddt_righe=ddt_per_linea(corpo, unisci_globali=False),
+        linee=corpo.linee,
+    )
+
+    # AUTO-GENERAZIONE SCADENZE CON SUPPORTO MULTI-RATA
+    rate_xml = corpo.pagamenti
+    if rate_xml:
+        for i, rata in enumerate(rate_xml):
+            data_scadenza = rata.data_scadenza or _scadenza_default(f.data)
+            f.rate.append({
+                "importo_totale": rata.importo or 0.0,
+                "data_scadenza": data_scadenza,
+                "descrizione": f"Fattura di Vendita n. {f.numero} (Rata {i+1}/{len(rate_xml)})",
+                "per_rata": True,
+            })
+    else:
+        f.rate.append({
+            "importo_totale": f.importo_totale,
+            "data_scadenza": _scadenza_default(f.data),
+            "descrizione": f"Fattura di Vendita n. {f.numero}",
+            "per_rata": False,
+        })
+    return f
+
+
+# ==========================================
+# SCRITTURA A BLOCCHI
+# ==========================================
+def inserisci_a_blocchi(supabase: Client, tabella: str, righe: list[dict]) -> list[dict]:
+    """
+    Insert a blocchi di BLOCCO_SCRITTURA; ritorna le righe inserite (con id).
+    Se un blocco fallisce lo riprova riga per riga: le righe che falliscono
+    ancora vengono stampate e mancano dal risultato.
+    """
+    inserite: list[dict] = []
+    for blocco in a_blocchi(righe, BLOCCO_SCRITTURA):
+        try:
+            inserite.extend(supabase.table(tabella).insert(blocco).execute().data or [])
+            continue
+        except Exception as e:
+            print(f"⚠️ Insert di {len(blocco)} righe in {tabella} fallito ({e}) — riprovo una per una")
+        for riga in blocco:
+            try:
+                inserite.extend(supabase.table(tabella).insert(riga).execute().data or [])
+            except Exception as e:
+                print(f"❌ Insert in {tabella} fallito: {e}")
+    return inserite
+
+
+def collega_fatture_scadenze(supabase: Client, fatture: list[dict], scadenze: list[dict]) -> int:
+    """
+    Scrive scadenza_id sulle fatture [{"id", "scadenza_id"}] e
+    fattura_vendita_id sulle scadenze ricollegate [{"id", "fattura_vendita_id"}]
+    con l'RPC collega_scadenze_vendita; senza la migrazione ricade su un
+    update per riga. Ritorna il numero di update falliti.
+    """
+    if not fatture and not scadenze:
+        return 0
     try:
-        print("Inizializzazione script...")
-        
-        # 1. Trova il file .env in modo dinamico
-        base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-        env_path = os.path.join(base_dir, '.env.local')
-        if not os.path.exists(env_path):
-            env_path = os.path.join(base_dir, '.env')
-            
-        print(f"Cerco file variabili d'ambiente in: {env_path}")
-        load_dotenv(env_path)
-
-        SUPABASE_URL = os.getenv("NEXT_PUBLIC_SUPABASE_URL")
-        SUPABASE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
-
-        if not SUPABASE_URL or not SUPABASE_KEY:
-            raise ValueError(f"❌ CHIAVI MANCANTI. SUPABASE_URL: {'Trovato' if SUPABASE_URL else 'Mancante'}, SUPABASE_KEY: {'Trovato' if SUPABASE_KEY else 'Mancante'}")
-
-        print("Connessione a Supabase in corso...")
-        supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-
-        # ==========================================
-        # FUNZIONE DI NORMALIZZAZIONE P.IVA E C.F.
-        # ==========================================
-        def pulisci_piva_cf(valore):
-            if not valore: 
-                return None
-            v = valore.strip().upper()
-            # Rimuove prefisso IT se presente
-            if v.startswith('IT'):
-                v = v[2:]
-            
-            # Se è composto interamente da numeri (P.IVA o CF numerico)
-            if v.isdigit():
-                # Rimuove eventuali zeri iniziali sporchi per avere la base numerica pura
-                v = v.lstrip('0')
-                # Aggiunge gli zeri in testa per forzare rigorosamente le 11 cifre italiane standard
-                v = v.zfill(11)
-            return v
-
-        def strip_namespaces(xml_string):
-            import re
-            return re.sub(' xmlns="[^"]+"', '', xml_string, count=1)
-
-        def parse_e_importa_fattura(file_path):
-            print(f"\n📄 Elaborazione: {os.path.basename(file_path)}")
-            
-            with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                xml_content = f.read()
-            
-            clean_xml = strip_namespaces(xml_content)
-            root = ET.fromstring(clean_xml)
-
-            cessionario = root.find('.//CessionarioCommittente/DatiAnagrafici')
-            if cessionario is None:
-                print("❌ Cessionario non trovato. Saltata.")
-                return
-
-            # Estrazione e normalizzazione PIVA e CF
-            piva_grezza = cessionario.findtext('.//IdFiscaleIVA/IdCodice')
-            piva_cliente = pulisci_piva_cf(piva_grezza)
-
-            cf_grezzo = cessionario.findtext('.//CodiceFiscale')
-            codice_fiscale = pulisci_piva_cf(cf_grezzo)
-            
-            anagrafica = cessionario.find('.//Anagrafica')
-            ragione_sociale = anagrafica.findtext('Denominazione')
-            if not ragione_sociale:
-                nome = anagrafica.findtext('Nome', '')
-                cognome = anagrafica.findtext('Cognome', '')
-                ragione_sociale = f"{nome} {cognome}".strip()
-
-            # Ricerca soggetto rigorosa
-            soggetto_data = []
-            if piva_cliente:
-                res = supabase.table('anagrafica_soggetti').select('id').eq('partita_iva', piva_cliente).execute()
-                soggetto_data = res.data
-            elif codice_fiscale:
-                res = supabase.table('anagrafica_soggetti').select('id').eq('codice_fiscale', codice_fiscale).execute()
-                soggetto_data = res.data
-            else:
-                res = supabase.table('anagrafica_soggetti').select('id').eq('ragione_sociale', ragione_sociale).execute()
-                soggetto_data = res.data
-            
-            if len(soggetto_data) > 0:
-                soggetto_id = soggetto_data[0]['id']
-                print(f"✅ Soggetto trovato: {ragione_sociale} (ID Normalizzato)")
+        supabase.rpc("collega_scadenze_vendita", {"p_fatture": fatture, "p_scadenze": scadenze}).execute()
+        return 0
+    except Exception as e:
+        if "collega_scadenze_vendita" not in str(e):
+            print(f"⚠️ Collegamento fatture/scadenze fallito ({e}) — riprovo una per una")
+
+    falliti = 0
+    for s in scadenze:
+        try:
+            supabase.table('scadenze_pagamento').update({"fattura_vendita_id": s["fattura_vendita_id"]}).eq('id', s["id"]).execute()
+        except Exception as e:
+            print(f"❌ Update scadenza {s['id']}: {e}")
+            falliti += 1
+    for f in fatture:
+        try:
+            supabase.table('fatture_vendita').update({"scadenza_id": f["scadenza_id"]}).eq('id', f["id"]).execute()
+        except Exception as e:
+            print(f"❌ Update fattura {f['id']}: {e}")
+            falliti += 1
+    return falliti
+
+
+def _filtra_in(colonna: str, valori: list):
+    return lambda q: q.in_(colonna, valori)
+
+
+# ==========================================
+# IMPORT
+# ==========================================
+def esegui(client: Client | None = None, progresso: Progresso | None = None) -> dict:
+    """
+    Importa tutte le fatture XML di CARTELLA_VENDITE.
+    `client`: client Supabase gia' aperto (sync_agent); se None lo crea da .env.
+    `progresso`: riceve l'avanzamento (file elaborati, errori).
+    Ritorna i contatori; un errore su un file non ferma gli altri.
+    """
+    stats = {"importate": 0, "gia_presenti": 0, "saltate": 0, "errori": 0}
+    progresso = progresso or Progresso()
+    supabase: Client = client or crea_client()
+
+    cartella = CARTELLA_VENDITE
+    if not os.path.exists(cartella):
+        print(f"\n❌ ERRORE: Cartella {cartella} non trovata.")
+        return {"errore": "cartella_non_trovata", **stats}
+
+    file_xml = sorted(f for f in os.listdir(cartella) if f.lower().endswith('.xml'))
+    print(f"\nTrovati {len(file_xml)} file XML da elaborare nella cartella: {cartella}")
+
+    # 1. Lettura di tutti i file
+    fatture: list[FatturaVendita] = []
+    progresso.fase("lettura", totale=len(file_xml), scansionati=len(file_xml))
+    for nome in file_xml:
+        try:
+            f = leggi_fattura_vendita(os.path.join(cartella, nome))
+            if f is None:
+                print(f"❌ {nome}: Cessionario non trovato. Saltata.")
+                stats["saltate"] += 1
             else:
-                nuovo_soggetto = {
-                    "ragione_sociale": ragione_sociale,
-                    "partita_iva": piva_cliente,
-                    "codice_fiscale": codice_fiscale,
-                    "tipo": "cliente"
-                }
-                res = supabase.table('anagrafica_soggetti').insert(nuovo_soggetto).execute()
-                soggetto_id = res.data[0]['id']
-                print(f"🌟 Nuovo soggetto creato: {ragione_sociale}")
-
-            dati_generali = root.find('.//DatiGeneraliDocumento')
-            numero_fattura = dati_generali.findtext('Numero')
-            data_fattura = dati_generali.findtext('Data')
-            importo_totale = float(dati_generali.findtext('ImportoTotaleDocumento', '0'))
-            
-            dati_ddt = root.find('.//DatiDDT')
-            numero_ddt = dati_ddt.findtext('NumeroDDT') if dati_ddt is not None else None
-
-            check_fattura = supabase.table('fatture_vendita').select('id').eq('numero_fattura', numero_fattura).eq('soggetto_id', soggetto_id).execute()
-            if len(check_fattura.data) > 0:
-                print(f"⚠️ Fattura {numero_fattura} già importata. Ignoro.")
-                return
-
-            nuova_fattura = {
-                "ragione_sociale": ragione_sociale,
-                "piva_cliente": piva_cliente,
-                "numero_fattura": numero_fattura,
-                "data_fattura": data_fattura,
-                "importo_totale": importo_totale,
-                "soggetto_id": soggetto_id,
-                "nome_file_xml": os.path.basename(file_path)
+                fatture.append(f)
+        except Exception:
+            print(f"❌ Errore su {nome}:")
+            traceback.print_exc()
+            stats["errori"] += 1
+        progresso.avanza(errori=stats["errori"])
+
+    if not fatture:
+        print("\nNessuna fattura da importare.")
+        progresso.fine(abbinati=0, errori=stats["errori"])
+        return stats
+
+    # 2. Soggetti: indice dell'anagrafica, poi insert dei clienti nuovi
+    progresso.fase("indici")
+    soggetti: dict[tuple[str, str], str] = {}
+    for r in scorri_tabella(supabase, "anagrafica_soggetti", "id, partita_iva, codice_fiscale, ragione_sociale"):
+        if r.get("partita_iva"):
+            soggetti.setdefault(("piva", r["partita_iva"]), r["id"])
+        if r.get("codice_fiscale"):
+            soggetti.setdefault(("cf", r["codice_fiscale"]), r["id"])
+        if r.get("ragione_sociale"):
+            soggetti.setdefault(("rs", r["ragione_sociale"]), r["id"])
+
+    nuovi_soggetti: dict[tuple[str, str], dict] = {}
+    for f in fatture:
+        if f.chiave_soggetto not in soggetti and f.chiave_soggetto not in nuovi_soggetti:
+            nuovi_soggetti[f.chiave_soggetto] = {
+                "ragione_sociale": f.ragione_sociale,
+                "partita_iva": f.piva,
+                "codice_fiscale": f.cf,
+                "tipo": "cliente",
             }
-            
-            res_fatt = supabase.table('fatture_vendita').insert(nuova_fattura).execute()
-            fattura_id = res_fatt.data[0]['id']
-
-            linee = root.findall('.//DettaglioLinee')
-            righe_da_inserire = []
-            
-            for linea in linee:
-                righe_da_inserire.append({
-                    "fattura_id": fattura_id,
-                    "descrizione": linea.findtext('Descrizione'),
-                    "quantita": float(linea.findtext('Quantita', '1')),
-                    "prezzo_unitario": float(linea.findtext('PrezzoUnitario', '0')),
-                    "importo": float(linea.findtext('PrezzoTotale', '0')),
-                    "codice_articolo": linea.findtext('.//CodiceValore', None),
-                    "ddt_riferimento": numero_ddt
-                })
-            
-            if righe_da_inserire:
-                supabase.table('fatture_vendita_righe').insert(righe_da_inserire).execute()
-
-            # 6. AUTO-GENERAZIONE SCADENZE CON SUPPORTO MULTI-RATA
-            rate_xml = root.findall('.//DettaglioPagamento')
-            scadenza_id = None
-
-            if rate_xml:
-                for i, rata in enumerate(rate_xml):
-                    importo_rata = float(rata.findtext('ImportoPagamento', '0'))
-                    data_scadenza = rata.findtext('DataScadenzaPagamento')
-
-                    if not data_scadenza:
-                        dt_fattura = datetime.strptime(data_fattura, "%Y-%m-%d")
-                        data_scadenza = (dt_fattura + timedelta(days=30)).strftime("%Y-%m-%d")
-
-                    check_scadenza_rata = supabase.table('scadenze_pagamento') \
-                        .select('id') \
-                        .eq('fattura_riferimento', numero_fattura) \
-                        .eq('soggetto_id', soggetto_id) \
-                        .eq('data_scadenza', data_scadenza) \
-                        .eq('importo_totale', importo_rata) \
-                        .eq('tipo', 'entrata') \
-                        .execute()
-
-                    if len(check_scadenza_rata.data) > 0:
-                        scadenza_rata_id = check_scadenza_rata.data[0]['id']
-                        supabase.table('scadenze_pagamento').update({"fattura_vendita_id": fattura_id}).eq('id', scadenza_rata_id).execute()
-                    else:
-                        nuova_scadenza = {
-                            "soggetto_id": soggetto_id,
-                            "fattura_vendita_id": fattura_id,
-                            "fattura_riferimento": numero_fattura,
-                            "importo_totale": importo_rata,
-                            "importo_pagato": 0,
-                            "data_emissione": data_fattura,
-                            "data_scadenza": data_scadenza,
-                            "data_pianificata": data_scadenza,
-                            "tipo": "entrata",
-                            "stato": "da_pagare",
-                            "descrizione": f"Fattura di Vendita n. {numero_fattura} (Rata {i+1}/{len(rate_xml)})"
-                        }
-                        res_scadenza = supabase.table('scadenze_pagamento').insert(nuova_scadenza).execute()
-                        scadenza_rata_id = res_scadenza.data[0]['id']
-
-                    if scadenza_id is None:
-                        scadenza_id = scadenza_rata_id
-            else:
-                dt_fattura = datetime.strptime(data_fattura, "%Y-%m-%d")
-                data_scadenza = (dt_fattura + timedelta(days=30)).strftime("%Y-%m-%d")
-
-                check_scadenza = supabase.table('scadenze_pagamento').select('id').eq('fattura_riferimento', numero_fattura).eq('soggetto_id', soggetto_id).execute()
-
-                if len(check_scadenza.data) > 0:
-                    print(f"⚠️ Scadenza già presente per fattura {numero_fattura}. La ricollego alla fattura.")
-                    scadenza_id = check_scadenza.data[0]['id']
-                    supabase.table('scadenze_pagamento').update({"fattura_vendita_id": fattura_id}).eq('id', scadenza_id).execute()
-                else:
-                    nuova_scadenza = {
-                        "soggetto_id": soggetto_id,
-                        "fattura_vendita_id": fattura_id,
-                        "fattura_riferimento": numero_fattura,
-                        "importo_totale": importo_totale,
-                        "importo_pagato": 0,
-                        "data_emissione": data_fattura,
-                        "data_scadenza": data_scadenza,
-                        "data_pianificata": data_scadenza,
-                        "tipo": "entrata",
-                        "stato": "da_pagare",
-                        "descrizione": f"Fattura di Vendita n. {numero_fattura}"
-                    }
-                    res_scadenza = supabase.table('scadenze_pagamento').insert(nuova_scadenza).execute()
-                    scadenza_id = res_scadenza.data[0]['id']
-
-            supabase.table('fatture_vendita').update({"scadenza_id": scadenza_id}).eq('id', fattura_id).execute()
-
-            print(f"✅ Inserita Fattura {numero_fattura} (€{importo_totale}) e collegata Scadenza (Entrata).")
-
-        # Cartella di ricerca
-        cartella = r"C:\Users\Ufficio\Desktop\PROGETTO X\Sviluppo\fatture di vendita"
-        if not os.path.exists(cartella):
-            print(f"\n❌ ERRORE: Cartella {cartella} non trovata.")
+    if nuovi_soggetti:
+        for r in inserisci_a_blocchi(supabase, "anagrafica_soggetti", list(nuovi_soggetti.values())):
+            soggetti[_chiave_soggetto_riga(r)] = r["id"]
+            print(f"🌟 Nuovo soggetto creato: {r.get('ragione_sociale')}")
+
+    da_importare: list[FatturaVendita] = []
+    for f in fatture:
+        f.soggetto_id = soggetti.get(f.chiave_soggetto)
+        if f.soggetto_id is None:
+            print(f"❌ {f.nome_file}: soggetto {f.ragione_sociale} non creato. Saltata.")
+            stats["errori"] += 1
+        else:
+            da_importare.append(f)
+
+    # 3. Fatture gia' presenti per (numero_fattura, soggetto_id)
+    numeri = sorted({f.numero for f in da_importare if f.numero})
+    esistenti: dict[tuple[str, str], dict] = {}
+    for blocco in a_blocchi(numeri, BLOCCO_FILTRO):
+        for r in scorri_tabella(supabase, "fatture_vendita", "id, numero_fattura, soggetto_id, scadenza_id",
+                                filtri=_filtra_in("numero_fattura", blocco)):
+            esistenti.setdefault((r["numero_fattura"], r["soggetto_id"]), r)
+
+    nuove: list[FatturaVendita] = []
+    da_completare: list[FatturaVendita] = []
+    viste: set[tuple] = set()
+    for f in da_importare:
+        chiave = (f.numero, f.soggetto_id)
+        esistente = esistenti.get(chiave)
+        if chiave in viste or (esistente and esistente.get("scadenza_id")):
+            print(f"⚠️ Fattura {f.numero} già importata. Ignoro.")
+            stats["gia_presenti"] += 1
+        elif esistente:
+            f.fattura_id = esistente["id"]          # import precedente interrotto a meta'
+            da_completare.append(f)
         else:
-            file_xml = [f for f in os.listdir(cartella) if f.lower().endswith('.xml')]
-            print(f"\nTrovati {len(file_xml)} file XML da elaborare nella cartella: {cartella}")
-            
-            for f in file_xml:
-                parse_e_importa_fattura(os.path.join(cartella, f))
+            nuove.append(f)
+        viste.add(chiave)
+
+    # 4. Insert fatture
+    progresso.fase("scrittura", totale=len(nuove) + len(da_completare))
+    inserite = inserisci_a_blocchi(supabase, "fatture_vendita", [{
+        "ragione_sociale": f.ragione_sociale,
+        "piva_cliente": f.piva,
+        "numero_fattura": f.numero,
+        "data_fattura": f.data,
+        "importo_totale": f.importo_totale,
+        "soggetto_id": f.soggetto_id,
+        "nome_file_xml": f.nome_file,
+    } for f in nuove])
+    id_fatture = {(r["numero_fattura"], r["soggetto_id"]): r["id"] for r in inserite}
+    for f in nuove:
+        f.fattura_id = id_fatture.get((f.numero, f.soggetto_id))
+        if f.fattura_id is None:
+            stats["errori"] += 1
+    pronte = [f for f in nuove + da_completare if f.fattura_id]
+
+    # 5. Righe (per le fatture da completare solo se non ne hanno gia')
+    progresso.battito()   # punto di annullamento: il run dopo riprende le fatture senza scadenza_id
+    con_righe: set[str] = set()
+    for blocco in a_blocchi([f.fattura_id for f in da_completare], BLOCCO_FILTRO):
+        for r in scorri_tabella(supabase, "fatture_vendita_righe", "id, fattura_id",
+                                filtri=_filtra_in("fattura_id", blocco)):
+            con_righe.add(r["fattura_id"])
+
+    righe_da_inserire = []
+    attese = Counter()
+    for f in pronte:
+        if f.fattura_id in con_righe:
+            continue
+        for linea in f.linee:
+            righe_da_inserire.append({
+                "fattura_id": f.fattura_id,
+                "descrizione": linea.descrizione,
+                "quantita": 1.0 if linea.quantita is None else linea.quantita,
+                "prezzo_unitario": linea.prezzo_unitario or 0.0,
+                "importo": linea.prezzo_totale or 0.0,
+                "codice_articolo": linea.codice_articolo,
+                "ddt_riferimento": f.ddt_righe.get(linea.numero_linea)
+            })
+            attese[f.fattura_id] += 1
+    inserite_per_fattura = Counter(r["fattura_id"] for r in
+                                   inserisci_a_blocchi(supabase, "fatture_vendita_righe", righe_da_inserire))
+    incomplete = {fid for fid, n in attese.items() if inserite_per_fattura[fid] < n}
+    for f in pronte:
+        if f.fattura_id in incomplete:
+            # Resta senza scadenza_id: il prossimo run la riprende
+            print(f"❌ Fattura {f.numero}: righe non inserite")
+            stats["errori"] += 1
+    pronte = [f for f in pronte if f.fattura_id not in incomplete]
 
-        print("\n🎉 IMPORTAZIONE COMPLETATA CON SUCCESSO!")
+    # 6. Scadenze: ricollega quelle gia' presenti, inserisce le altre
+    progresso.battito()
+    scadenze_esistenti: dict[tuple[str, str], list[dict]] = {}
+    numeri_pronte = sorted({f.numero for f in pronte if f.numero})
+    for blocco in a_blocchi(numeri_pronte, BLOCCO_FILTRO):
+        for r in scorri_tabella(supabase, "scadenze_pagamento",
+                                "id, fattura_riferimento, soggetto_id, data_scadenza, importo_totale, tipo",
+                                filtri=_filtra_in("fattura_riferimento", blocco)):
+            scadenze_esistenti.setdefault((r["fattura_riferimento"], r["soggetto_id"]), []).append(r)
 
+    ricollegate: list[dict] = []
+    nuove_scadenze: list[dict] = []
+    prima_rata: dict[str, str] = {}          # fattura_id -> descrizione della prima rata, se nuova
+    usate: set[str] = set()
+    for f in pronte:
+        candidate = scadenze_esistenti.get((f.numero, f.soggetto_id), [])
+        for i, rata in enumerate(f.rate):
+            trovata = None
+            for sc in candidate:
+                if sc["id"] in usate:
+                    continue
+                if not rata["per_rata"] or (
+                        sc.get("tipo") == "entrata" and sc.get("data_scadenza") == rata["data_scadenza"]
+                        and round(float(sc.get("importo_totale") or 0), 2) == round(float(rata["importo_totale"]), 2)):
+                    trovata = sc
+                    break
+            if trovata:
+                if not rata["per_rata"]:
+                    print(f"⚠️ Scadenza già presente per fattura {f.numero}. La ricollego alla fattura.")
+                usate.add(trovata["id"])
+                ricollegate.append({"id": trovata["id"], "fattura_vendita_id": f.fattura_id})
+                if i == 0:
+                    f.scadenza_id = trovata["id"]
+                continue
+            if i == 0:
+                prima_rata[f.fattura_id] = rata["descrizione"]
+            nuove_scadenze.append({
+                "soggetto_id": f.soggetto_id,
+                "fattura_vendita_id": f.fattura_id,
+                "fattura_riferimento": f.numero,
+                "importo_totale": rata["importo_totale"],
+                "importo_pagato": 0,
+                "data_emissione": f.data,
+                "data_scadenza": rata["data_scadenza"],
+                "data_pianificata": rata["data_scadenza"],
+                "tipo": "entrata",
+                "stato": "da_pagare",
+                "descrizione": rata["descrizione"],
+            })
+
+    scadenze_inserite = inserisci_a_blocchi(supabase, "scadenze_pagamento", nuove_scadenze)
+    id_scadenze = {(r["fattura_vendita_id"], r["descrizione"]): r["id"] for r in scadenze_inserite}
+    attese = Counter(r["fattura_vendita_id"] for r in nuove_scadenze)
+    inserite_per_fattura = Counter(r["fattura_vendita_id"] for r in scadenze_inserite)
+    incomplete = {fid for fid, n in attese.items() if inserite_per_fattura[fid] < n}
+    for f in pronte:
+        if f.fattura_id in incomplete:
+            # Senza scadenza_id il prossimo run ricollega le rate inserite e crea le mancanti
+            print(f"❌ Fattura {f.numero}: scadenze non inserite")
+            f.scadenza_id = None
+        elif f.fattura_id in prima_rata:
+            f.scadenza_id = id_scadenze.get((f.fattura_id, prima_rata[f.fattura_id]))
+
+    # 7. scadenza_id sulle fatture + fattura_vendita_id sulle scadenze ricollegate
+    progresso.battito()
+    collegate = [f for f in pronte if f.scadenza_id]
+    stats["errori"] += len(pronte) - len(collegate)
+    falliti = collega_fatture_scadenze(
+        supabase,
+        [{"id": f.fattura_id, "scadenza_id": f.scadenza_id} for f in collegate],
+        ricollegate,
+    )
+    stats["errori"] += falliti
+    for f in collegate:
+        print(f"✅ Inserita Fattura {f.numero} (€{f.importo_totale}) e collegata Scadenza (Entrata).")
+    stats["importate"] = max(0, len(collegate) - falliti)
+    progresso.avanza(len(nuove) + len(da_completare), abbinati=stats["importate"], errori=stats["errori"])
+
+    print("\n🎉 IMPORTAZIONE COMPLETATA CON SUCCESSO!")
+    progresso.fine(abbinati=stats["importate"], errori=stats["errori"])
+    return stats
+
+
+def main():
+    try:
+        risultato = esegui(progresso=Progresso.da_cli())
     except Exception as e:
         print("\n" + "="*50)
         print("❌ ERRORE CRITICO DURANTE L'ESECUZIONE DELLO SCRIPT ❌")
         print("="*50)
         traceback.print_exc()
         print("="*50)
+        risultato = {"errore": str(e)}
+    if "--json" in sys.argv:
+        print(f"###JSON_RESULT###{json.dumps(risultato)}")
 
 if __name__ == "__main__":
     main()
-    input("\nPremi INVIO per chiudere questa finestra...")
\ No newline at end of file
+    if "--json" not in sys.argv:
+        input("\nPremi INVIO per chiudere questa finestra...")
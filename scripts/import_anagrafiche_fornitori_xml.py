@@ -7,20 +7,42 @@ i record in anagrafica_soggetti con tipo='fornitore'.
 
 NON tocca importi, scadenze o fatture — solo anagrafiche.
 
+Flusso (poche richieste anche su un anno intero di XML):
+  1. legge e analizza tutti i file e accorpa le fatture per fornitore
+     (chiave P.IVA, CF o ragione sociale): vincono i dati della fattura con
+     data piu' recente, i campi che mancano li' si prendono dalle precedenti;
+     con --jobs N l'analisi gira su N processi e ogni processo restituisce
+     solo una tupla compatta per file
+  2. pre-carica anagrafica_soggetti in indici P.IVA / CF / ragione sociale
+     (una select paginata invece di fino a 3 query per fornitore)
+  3. risolve in memoria chi aggiornare e chi inserire (con il diff dei campi):
+     le anagrafiche gia' uguali all'XML non vengono riscritte
+  4. scrive a blocchi: upsert per id degli esistenti cambiati, insert dei nuovi
+
 Uso:
     python scripts/import_anagrafiche_fornitori_xml.py            # modalità live
     python scripts/import_anagrafiche_fornitori_xml.py --dry-run  # solo stampa, nessuna scrittura
+    python scripts/import_anagrafiche_fornitori_xml.py --json     # non interattivo (sync_agent)
+    python scripts/import_anagrafiche_fornitori_xml.py --jobs 8   # analisi XML su 8 processi
+
+Da codice (sync_agent in-process): esegui(client, dry_run=False, jobs=1) -> dict contatori.
 """
 
 import os
 import sys
-import re
+import json
 import traceback
 import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
 from pathlib import Path
 from dotenv import load_dotenv
 from supabase import create_client, Client
 
+from fattura_pa import FatturaPA, leggi_fattura
+from progresso import Progresso
+from supabase_utils import a_blocchi, scorri_tabella
+
 # Fix encoding terminale Windows
 if sys.stdout.encoding and sys.stdout.encoding.lower() != 'utf-8':
     try:
@@ -31,34 +53,12 @@ if sys.stdout.encoding and sys.stdout.encoding.lower() != 'utf-8':
 # ─── CARTELLA XML ─────────────────────────────────────────────────────────────
 XML_DIR = r"\\192.168.1.231\scambio\AMMINISTRAZIONE\Clienti e Fornitori\2025\contabilità\archivio_xml_2024"
 
-# ─── ENCODINGS da provare ─────────────────────────────────────────────────────
-ENCODINGS = ["utf-8", "utf-8-sig", "latin-1", "cp1252", "iso-8859-1"]
+# Campi anagrafici scritti da questo script (stesse chiavi di estrai_fornitore)
+CAMPI = ("ragione_sociale", "partita_iva", "codice_fiscale", "indirizzo", "cap", "comune", "provincia", "tipo")
+BLOCCO_SCRITTURA = 200
 
 # ─── HELPERS ──────────────────────────────────────────────────────────────────
 
-def strip_namespaces(xml_string: str) -> str:
-    # 1. Rimuove dichiarazioni xmlns (sia default che prefissate)
-    xml_string = re.sub(r'\s+xmlns(?::\w+)?="[^"]+"', '', xml_string)
-    # 2. Rimuove prefissi namespace dai nomi dei tag: <p:Foo> → <Foo>, </p:Foo> → </Foo>
-    xml_string = re.sub(r'(</?)\w+:', r'\1', xml_string)
-    # 3. Rimuove attributi con prefisso namespace: xsi:type="..." → rimosso
-    xml_string = re.sub(r'\s+\w+:\w+="[^"]*"', '', xml_string)
-    return xml_string
-
-
-def read_xml(path: str) -> str | None:
-    """Legge il file provando vari encoding."""
-    for enc in ENCODINGS:
-        try:
-            with open(path, "r", encoding=enc, errors="strict") as f:
-                return f.read()
-        except (UnicodeDecodeError, LookupError):
-            continue
-    # Ultimo tentativo con errors='ignore'
-    with open(path, "r", encoding="utf-8", errors="ignore") as f:
-        return f.read()
-
-
 def normalizza_piva(valore: str | None) -> str | None:
     """Normalizza P.IVA: rimuove prefisso IT, zfill a 11 cifre."""
     if not valore:
@@ -71,88 +71,160 @@ def normalizza_piva(valore: str | None) -> str | None:
     return v or None
 
 
-def estrai_fornitore(root: ET.Element) -> dict | None:
+def estrai_fornitore(fattura: FatturaPA) -> dict | None:
     """
-    Estrae i dati del fornitore dal nodo CedentePrestatore.
+    Estrae i dati del fornitore dal CedentePrestatore gia' analizzato.
     Restituisce un dict con i campi anagrafica o None se non trovato.
     """
-    cedente = root.find(".//CedentePrestatore")
+    cedente = fattura.cedente
     if cedente is None:
         return None
 
-    dati_anag = cedente.find(".//DatiAnagrafici")
-    if dati_anag is None:
-        return None
-
     # Ragione sociale
-    anag = dati_anag.find(".//Anagrafica")
-    ragione_sociale = None
-    if anag is not None:
-        ragione_sociale = anag.findtext("Denominazione")
-        if not ragione_sociale:
-            nome    = anag.findtext("Nome", "")
-            cognome = anag.findtext("Cognome", "")
-            ragione_sociale = f"{nome} {cognome}".strip() or None
-
+    ragione_sociale = cedente.nominativo()
     if not ragione_sociale:
         return None
 
     # P.IVA e CF
-    piva = normalizza_piva(dati_anag.findtext(".//IdFiscaleIVA/IdCodice"))
-    cf   = normalizza_piva(dati_anag.findtext(".//CodiceFiscale"))
-
-    # Sede (indirizzo)
-    sede = cedente.find(".//Sede")
-    indirizzo = None
-    cap       = None
-    comune    = None
-    provincia = None
-    if sede is not None:
-        indirizzo = sede.findtext("Indirizzo")
-        cap       = sede.findtext("CAP")
-        comune    = sede.findtext("Comune")
-        provincia = sede.findtext("Provincia")
+    piva = normalizza_piva(cedente.partita_iva)
+    cf   = normalizza_piva(cedente.codice_fiscale)
 
     return {
         "ragione_sociale": ragione_sociale.strip(),
         "partita_iva":     piva,
         "codice_fiscale":  cf,
-        "indirizzo":       indirizzo,
-        "cap":             cap,
-        "comune":          comune,
-        "provincia":       provincia,
+        "indirizzo":       cedente.indirizzo,
+        "cap":             cedente.cap,
+        "comune":          cedente.comune,
+        "provincia":       cedente.provincia,
         "tipo":            "fornitore",
     }
 
 
-def trova_soggetto(supabase: Client, piva: str | None, cf: str | None, ragione_sociale: str) -> str | None:
+def leggi_fornitore(percorso: str) -> tuple[str, tuple | str | None, str | None]:
     """
-    Cerca il soggetto in anagrafica_soggetti.
-    Priorità: P.IVA → CF → ragione_sociale esatta.
-    Restituisce l'ID se trovato, None altrimenti.
+    Legge un XML ed estrae il fornitore e la data della fattura. Gira anche
+    in un processo worker (--jobs): ritorna solo tuple piccole da passare al
+    processo principale, mai l'albero XML.
+      ("ok", valori nell'ordine di CAMPI, data) | ("saltato", None, None)
+      ("malformato", messaggio, None) | ("errore", traceback, None)
     """
-    if piva:
-        res = supabase.table("anagrafica_soggetti").select("id").eq("partita_iva", piva).execute()
-        if res.data:
-            return res.data[0]["id"]
-    if cf:
-        res = supabase.table("anagrafica_soggetti").select("id").eq("codice_fiscale", cf).execute()
-        if res.data:
-            return res.data[0]["id"]
-    res = supabase.table("anagrafica_soggetti").select("id").eq("ragione_sociale", ragione_sociale).execute()
-    if res.data:
-        return res.data[0]["id"]
-    return None
+    try:
+        fattura = leggi_fattura(percorso)
+        fornitore = estrai_fornitore(fattura)
+    except ET.ParseError as e:
+        return "malformato", str(e), None
+    except Exception:
+        return "errore", traceback.format_exc(), None
+    if not fornitore:
+        return "saltato", None, None
+    data = fattura.corpo.dati_generali.data if fattura.corpo else None
+    return "ok", tuple(fornitore[k] for k in CAMPI), data
 
 
-# ─── MAIN ─────────────────────────────────────────────────────────────────────
+def unisci_fornitore(attuale: dict, data_attuale: str, nuovo: dict, data_nuova: str) -> tuple[dict, str]:
+    """
+    Accorpa due fatture dello stesso fornitore: valgono i campi della
+    fattura piu' recente (a parita' di data quella letta dopo), quelli che
+    mancano li' restano dalla meno recente. Ritorna (fornitore, data).
+    """
+    if data_nuova >= data_attuale:
+        recente, precedente, data = nuovo, attuale, data_nuova
+    else:
+        recente, precedente, data = attuale, nuovo, data_attuale
+    return {k: recente[k] if recente[k] is not None else precedente[k] for k in CAMPI}, data
 
-def main():
-    dry_run = "--dry-run" in sys.argv
-    if dry_run:
-        print("🔍  MODALITÀ DRY-RUN — nessuna scrittura su Supabase\n")
 
-    # Carica .env
+class IndiceSoggetti:
+    """
+    anagrafica_soggetti pre-caricata in memoria. Stessa priorita' della
+    vecchia ricerca con 3 query: P.IVA -> CF -> ragione sociale esatta; a
+    parita' di chiave vince il primo caricato (id minore).
+    I fornitori nuovi vengono aggiunti (senza id) appena decisi, cosi' un
+    secondo file dello stesso fornitore li ritrova come faceva la query
+    dopo l'insert.
+    """
+
+    def __init__(self):
+        self._per_piva: dict[str, dict] = {}
+        self._per_cf: dict[str, dict] = {}
+        self._per_rs: dict[str, dict] = {}
+
+    def __len__(self):
+        return len({id(s) for s in (*self._per_piva.values(), *self._per_cf.values(), *self._per_rs.values())})
+
+    def aggiungi(self, soggetto: dict):
+        if soggetto.get("partita_iva"):
+            self._per_piva.setdefault(soggetto["partita_iva"], soggetto)
+        if soggetto.get("codice_fiscale"):
+            self._per_cf.setdefault(soggetto["codice_fiscale"], soggetto)
+        if soggetto.get("ragione_sociale"):
+            self._per_rs.setdefault(soggetto["ragione_sociale"], soggetto)
+
+    def trova(self, piva: str | None, cf: str | None, ragione_sociale: str) -> dict | None:
+        if piva and piva in self._per_piva:
+            return self._per_piva[piva]
+        if cf and cf in self._per_cf:
+            return self._per_cf[cf]
+        return self._per_rs.get(ragione_sociale)
+
+
+def carica_indice_soggetti(supabase: Client) -> IndiceSoggetti:
+    """Tutta anagrafica_soggetti (paginata per id) negli indici."""
+    indice = IndiceSoggetti()
+    for r in scorri_tabella(supabase, "anagrafica_soggetti", "id, " + ", ".join(CAMPI)):
+        indice.aggiungi(r)
+    return indice
+
+
+def differenze(attuale: dict, nuovi: dict) -> dict[str, tuple]:
+    """{campo: (valore attuale, valore dall'XML)} dei campi che cambierebbero."""
+    return {k: (attuale.get(k), v) for k, v in nuovi.items() if v is not None and attuale.get(k) != v}
+
+
+def scrivi_a_blocchi(supabase: Client, righe: list[dict], aggiorna: bool) -> int:
+    """
+    Insert delle righe a blocchi di BLOCCO_SCRITTURA oppure, con
+    aggiorna=True, update dei soli campi presenti in ogni riga ({"id", campi
+    cambiati}) con l'RPC aggiorna_anagrafiche_soggetti; senza la migrazione
+    ricade su un update per riga. Se un blocco fallisce lo riprova riga per
+    riga per isolare il record che da' errore. Ritorna il numero di righe scritte.
+    """
+    scritte = 0
+    usa_rpc = True
+    tabella = lambda: supabase.table("anagrafica_soggetti")
+    for blocco in a_blocchi(righe, BLOCCO_SCRITTURA):
+        try:
+            if not aggiorna:
+                tabella().insert(blocco).execute()
+                scritte += len(blocco)
+                continue
+            if usa_rpc:
+                res = supabase.rpc("aggiorna_anagrafiche_soggetti", {"p_righe": blocco}).execute()
+                scritte += len(res.data or [])
+                continue
+        except Exception as e:
+            if aggiorna and "aggiorna_anagrafiche_soggetti" in str(e):
+                usa_rpc = False
+            else:
+                print(f"  ⚠️  Scrittura di {len(blocco)} anagrafiche fallita ({e}) — riprovo una per una")
+        for riga in blocco:
+            try:
+                if aggiorna:
+                    campi = {k: v for k, v in riga.items() if k != "id"}
+                    tabella().update(campi).eq("id", riga["id"]).execute()
+                else:
+                    tabella().insert(riga).execute()
+                scritte += 1
+            except Exception as e:
+                print(f"  ❌  {riga.get('ragione_sociale')}: errore scrittura — {e}")
+    return scritte
+
+
+# ─── MAIN ─────────────────────────────────────────────────────────────────────
+
+def crea_client() -> Client | None:
+    """Client Supabase dalle variabili di .env.local / .env (None se mancanti)."""
     base_dir = Path(__file__).resolve().parent.parent
     for env_file in [".env.local", ".env"]:
         env_path = base_dir / env_file
@@ -162,22 +234,42 @@ def main():
             break
     else:
         print("❌  File .env.local / .env non trovato!")
-        sys.exit(1)
+        return None
 
     SUPABASE_URL = os.getenv("NEXT_PUBLIC_SUPABASE_URL")
     SUPABASE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
     if not SUPABASE_URL or not SUPABASE_KEY:
         print("❌  NEXT_PUBLIC_SUPABASE_URL o SUPABASE_SERVICE_ROLE_KEY mancanti nel .env")
-        sys.exit(1)
+        return None
 
     supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
     print(f"✅  Connesso a Supabase\n")
+    return supabase
+
+
+def esegui(client: Client | None = None, dry_run: bool = False,
+           progresso: Progresso | None = None, jobs: int = 1) -> dict:
+    """
+    Importa le anagrafiche fornitori da XML_DIR.
+    `client`: client Supabase gia' aperto (sync_agent); se None lo crea da .env.
+    `jobs`: processi per l'analisi degli XML (1 = nel processo corrente).
+    `progresso`: riceve l'avanzamento (file elaborati, errori).
+    Ritorna i contatori (con 'errore' se l'import non e' partito).
+    """
+    if dry_run:
+        print("🔍  MODALITÀ DRY-RUN — nessuna scrittura su Supabase\n")
+    progresso = progresso or Progresso()
+
+    supabase = client or crea_client()
+    if supabase is None:
+        return {"errore": "configurazione_mancante"}
 
     # Raccoglie tutti i file XML ricorsivamente
+    progresso.fase("scansione")
     xml_dir = Path(XML_DIR)
     if not xml_dir.exists():
         print(f"❌  Cartella non trovata: {XML_DIR}")
-        sys.exit(1)
+        return {"errore": "cartella_non_trovata"}
 
     file_xml = sorted(xml_dir.rglob("*.xml"))
     print(f"📁  Cartella: {XML_DIR}")
@@ -188,82 +280,170 @@ def main():
     n_aggiornati = 0
     n_presenti   = 0
     n_saltati    = 0
+    n_invariati  = 0
     n_errori     = 0
 
-    # Cache per evitare doppi upsert nella stessa sessione (chiave: piva o ragione_sociale)
-    processati: set[str] = set()
-
-    for fpath in file_xml:
+    # 1. Lettura: un fornitore per chiave (piva o cf o ragione_sociale),
+    #    accorpando le fatture per data. I risultati arrivano nell'ordine dei
+    #    file anche con --jobs (pool.map), quindi a parita' di data vince lo
+    #    stesso file in serie e in parallelo
+    fornitori: dict[str, dict] = {}
+    date_fornitori: dict[str, str] = {}
+    jobs = max(1, jobs)
+    if jobs > 1:
+        print(f"⚙️   Analisi XML su {jobs} processi\n")
+
+    progresso.fase("lettura", totale=len(file_xml), scansionati=len(file_xml))
+    with (ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else nullcontext()) as pool:
+        percorsi = [str(f) for f in file_xml]
+        if pool is None:
+            esiti = map(leggi_fornitore, percorsi)
+        else:
+            esiti = pool.map(leggi_fornitore, percorsi, chunksize=max(1, min(64, len(percorsi) // (jobs * 4))))
         try:
-            xml_raw = read_xml(str(fpath))
-            if not xml_raw:
-                print(f"  ⚠️  {fpath.name}: impossibile leggere")
-                n_errori += 1
-                continue
-
-            clean = strip_namespaces(xml_raw)
-            root  = ET.fromstring(clean)
-
-            fornitore = estrai_fornitore(root)
-            if not fornitore:
-                print(f"  ⚠️  {fpath.name}: CedentePrestatore non trovato — saltato")
-                n_saltati += 1
-                continue
-
-            rs   = fornitore["ragione_sociale"]
-            piva = fornitore["partita_iva"]
-            cf   = fornitore["codice_fiscale"]
-
-            # Chiave dedup in-memory
-            chiave = piva or cf or rs
-            if chiave in processati:
-                print(f"  ↩️   {rs} — già processato in questa sessione, skip")
-                n_presenti += 1
-                continue
-            processati.add(chiave)
-
-            soggetto_id = trova_soggetto(supabase, piva, cf, rs)
-
-            # Campi da scrivere (aggiorna solo se il valore è presente nell'XML)
-            campi_update = {k: v for k, v in fornitore.items() if v is not None}
+            for fpath, (esito, dati, data) in zip(file_xml, esiti):
+                progresso.avanza(errori=n_errori)
+                if esito == "malformato":
+                    print(f"  ❌  {fpath.name}: XML malformato — {dati}")
+                    n_errori += 1
+                    continue
+                if esito == "errore":
+                    print(f"  ❌  {fpath.name}: errore — {dati.strip().splitlines()[-1]}")
+                    print(dati, file=sys.stderr)
+                    n_errori += 1
+                    continue
+                if esito == "saltato":
+                    print(f"  ⚠️  {fpath.name}: CedentePrestatore non trovato — saltato")
+                    n_saltati += 1
+                    continue
+
+                fornitore = dict(zip(CAMPI, dati))
+                chiave = fornitore["partita_iva"] or fornitore["codice_fiscale"] or fornitore["ragione_sociale"]
+                if chiave in fornitori:
+                    n_presenti += 1
+                    fornitori[chiave], date_fornitori[chiave] = unisci_fornitore(
+                        fornitori[chiave], date_fornitori[chiave], fornitore, data or "")
+                    continue
+                fornitori[chiave] = fornitore
+                date_fornitori[chiave] = data or ""
+        except BaseException:
+            # Step annullato: i blocchi di file non ancora partiti non partono piu'
+            if pool is not None:
+                pool.shutdown(wait=False, cancel_futures=True)
+            raise
+
+    print(f"🏷️   Fornitori univoci: {len(fornitori)} ({n_presenti} fatture accorpate)\n")
+
+    # 2. Indici dell'anagrafica attuale
+    progresso.fase("indici")
+    try:
+        indice = carica_indice_soggetti(supabase)
+    except Exception as e:
+        print(f"❌  Caricamento anagrafica_soggetti fallito: {e}")
+        return {"errore": "indice_non_disponibile"}
+    print(f"📇  Anagrafiche esistenti: {len(indice)}\n")
+
+    # 3. Risoluzione in memoria
+    da_aggiornare: dict[str, dict] = {}   # id -> {"id", campi cambiati}
+    da_inserire: list[dict] = []
+    progresso.fase("confronto", totale=len(fornitori))
+    for fornitore in fornitori.values():
+        progresso.avanza()
+        rs   = fornitore["ragione_sociale"]
+        piva = fornitore["partita_iva"]
+        cf   = fornitore["codice_fiscale"]
+
+        soggetto = indice.trova(piva, cf, rs)
+
+        if soggetto is None:
+            # Soggetto nuovo → inserisce
+            print(f"  🌟  {rs} (P.IVA: {piva or cf}) — INSERITO")
+            nuovo = dict(fornitore)
+            da_inserire.append(nuovo)
+            indice.aggiungi(nuovo)
+            continue
 
-            if soggetto_id:
-                # Soggetto esistente → aggiorna i campi anagrafici
-                print(f"  🔄  {rs} (P.IVA: {piva or cf}) — AGGIORNATO")
-                if not dry_run:
-                    supabase.table("anagrafica_soggetti").update(campi_update).eq("id", soggetto_id).execute()
-                n_aggiornati += 1
-            else:
-                # Soggetto nuovo → inserisce
-                print(f"  🌟  {rs} (P.IVA: {piva or cf}) — INSERITO")
-                if not dry_run:
-                    supabase.table("anagrafica_soggetti").insert(fornitore).execute()
-                n_inseriti += 1
-
-        except ET.ParseError as e:
-            print(f"  ❌  {fpath.name}: XML malformato — {e}")
-            n_errori += 1
-        except Exception as e:
-            print(f"  ❌  {fpath.name}: errore — {e}")
-            traceback.print_exc()
-            n_errori += 1
+        # Soggetto esistente (o appena deciso da inserire) → aggiorna solo se
+        # qualche campo cambia davvero (niente scritture ne' trigger updated_at a vuoto).
+        # Solo i valori presenti nell'XML; tipo resta com'e' (un cliente non
+        # diventa fornitore perche' ha emesso una fattura)
+        campi_update = {k: v for k, v in fornitore.items() if v is not None and k != "tipo"}
+        diff = differenze(soggetto, campi_update)
+        if not diff:
+            n_invariati += 1
+            continue
+        print(f"  🔄  {rs} (P.IVA: {piva or cf}) — AGGIORNATO")
+        for campo, (prima, dopo) in diff.items():
+            print(f"        {campo}: {prima!r} → {dopo!r}")
+        soggetto.update(campi_update)
+        if soggetto.get("id"):
+            # Solo i campi cambiati (anche da piu' fatture dello stesso soggetto)
+            da_aggiornare.setdefault(soggetto["id"], {"id": soggetto["id"]}).update(
+                {campo: dopo for campo, (_, dopo) in diff.items()})
+        n_aggiornati += 1
+
+    n_inseriti = len(da_inserire)
+
+    # 4. Scrittura a blocchi
+    if not dry_run:
+        progresso.fase("scrittura", totale=len(da_aggiornare) + len(da_inserire))
+        scritte = scrivi_a_blocchi(supabase, list(da_aggiornare.values()), aggiorna=True)
+        n_errori += len(da_aggiornare) - scritte
+        progresso.avanza(len(da_aggiornare), errori=n_errori)
+        scritte = scrivi_a_blocchi(supabase, da_inserire, aggiorna=False)
+        n_errori += n_inseriti - scritte
+        n_inseriti = scritte
+        progresso.avanza(len(da_inserire), errori=n_errori)
 
     # Riepilogo finale
     print("\n" + "=" * 55)
     print("📊  RIEPILOGO IMPORTAZIONE ANAGRAFICHE FORNITORI")
     print("=" * 55)
     print(f"  File XML elaborati  : {len(file_xml)}")
-    print(f"  Fornitori univoci   : {len(processati)}")
+    print(f"  Fornitori univoci   : {len(fornitori)}")
     print(f"  🌟 Nuovi inseriti    : {n_inseriti}")
     print(f"  🔄 Aggiornati        : {n_aggiornati}")
-    print(f"  ↩️  Già presenti (dup): {n_presenti}")
+    print(f"  ✔️  Invariati         : {n_invariati}")
+    print(f"  ↩️  Fatture accorpate : {n_presenti}")
     print(f"  ⚠️  Saltati (no dati): {n_saltati}")
     print(f"  ❌ Errori            : {n_errori}")
     if dry_run:
         print("\n  ⚠️  DRY-RUN: nessuna modifica effettuata su Supabase")
     print("=" * 55)
 
+    progresso.fine(abbinati=n_aggiornati, errori=n_errori)
+    return {
+        "file_xml": len(file_xml),
+        "fornitori": len(fornitori),
+        "inseriti": n_inseriti,
+        "aggiornati": n_aggiornati,
+        "invariati": n_invariati,
+        "duplicati": n_presenti,
+        "saltati": n_saltati,
+        "errori": n_errori,
+        "dry_run": dry_run,
+    }
+
+
+def main():
+    jobs = 1
+    for i, arg in enumerate(sys.argv):
+        try:
+            if arg.startswith("--jobs="):
+                jobs = int(arg.split("=")[1])
+            elif arg == "--jobs" and i + 1 < len(sys.argv):
+                jobs = int(sys.argv[i + 1])
+        except ValueError:
+            pass
+
+    risultato = esegui(dry_run="--dry-run" in sys.argv, progresso=Progresso.da_cli(), jobs=jobs)
+    if "--json" in sys.argv:
+        print(f"###JSON_RESULT###{json.dumps(risultato)}")
+    elif "errore" in risultato:
+        sys.exit(1)
+
 
 if __name__ == "__main__":
     main()
-    input("\nPremi INVIO per chiudere...")
+    if "--json" not in sys.argv:
+        input("\nPremi INVIO per chiudere...")
@@ -7,23 +7,55 @@ Logica:
   1. Pre-carica in memoria: scadenze aperte (senza file_url) + mappa PIVA->soggetto
   2. Per ogni PDF in Archivio_pdf, estrae dal nome: numero, data, PIVA
      Pattern: Fatt.Acq._N.{numero}_del_{dd-mm-yyyy}_{PIVA}.pdf
-  3. Matching in memoria (0 query per-file):
+     I nomi gia' analizzati stanno nell'indice locale (IndiceCartella in
+     manifest_archivio.sqlite): la cartella viene riscansionata solo se il
+     suo mtime e' cambiato e i PDF recenti si scelgono con una query per data
+  3. Matching in memoria (0 query per-file, lookup per chiave):
      1) normalizza(fattura_riferimento) == normalizza(numero) + data esatta
-     2) PIVA soggetto + data esatta
-  4. Upload PDF su Storage + update file_url sulla scadenza
+     2) PIVA soggetto + data esatta (piu' candidati: prefisso comune col
+        numero piu' lungo, poi lunghezza piu' vicina, poi id)
+     3) sui soli PDF rimasti, punteggio fuzzy (abbinamento_fuzzy: numero
+        parziale, date vicine, PIVA): sopra soglia applicato, i casi dubbi
+        nel report import_fatture_pdf_revisione.csv (--no-fuzzy: disattivo)
+  4. Upload PDF su Storage in parallelo (--upload-workers N, default 4) con
+     retry e backoff sugli errori di rete; a fine run file_url scritto su
+     tutte le scadenze con una chiamata (RPC aggiorna_file_url_scadenze)
+  5. Prima di caricare, l'hash SHA-256 del PDF viene cercato nel registro
+     locale degli oggetti gia' su Storage (manifest_archivio.sqlite): se gli
+     stessi byte ci sono gia' si riusa il loro file_url senza upload. Per i
+     PDF grandi l'hash si calcola dai blocchi letti dall'upload; il file
+     viene letto due volte solo se nel registro c'e' un oggetto della stessa
+     dimensione (o sullo stesso percorso)
+  6. I PDF oltre --stream-soglia-mb (default 6) vengono caricati con
+     l'upload resumable (TUS) di Storage a blocchi di 6 MB letti dal file:
+     la memoria non cresce con la dimensione del PDF e un errore di rete
+     riprende dall'ultimo blocco confermato invece che da capo
+
+Dentro sync_agent (esegui(cache=True)) scadenze e mappa PIVA restano in
+memoria tra un run e l'altro (CacheIndici): ogni run scarica solo le righe
+nuove.
 
 Requisiti:
   pip install supabase python-dotenv
 
 Uso:
-  python scripts/import_fatture_pdf.py [--json] [--days N]
+  python scripts/import_fatture_pdf.py [--json] [--days N] [--upload-workers N] [--no-registro]
+                                       [--stream-soglia-mb N] [--no-fuzzy]
+
+Da codice (sync_agent in-process): esegui(client, giorni_recenti=7, cache=True) -> dict.
 """
 
+import base64
+import hashlib
 import os
 import re
+import sqlite3
 import sys
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
+from typing import Callable
 from datetime import datetime, timedelta
 from collections import defaultdict
 
@@ -33,8 +65,14 @@ except ImportError:
     print("supabase non installato. Esegui: pip install supabase")
     sys.exit(1)
 
+import httpx
 from dotenv import load_dotenv
 
+from supabase_utils import a_blocchi, scorri_tabella
+from progresso import Progresso
+from manifest_archivio import IndiceCartella, RegistroStorage
+from abbinamento_fuzzy import AbbinatoreFuzzy, scrivi_report
+
 # --- Configurazione ---
 _script_dir = os.path.dirname(os.path.abspath(__file__))
 _project_root = os.path.join(_script_dir, "..")
@@ -44,23 +82,33 @@ load_dotenv(os.path.join(_project_root, ".env"))
 SUPABASE_URL = os.getenv("NEXT_PUBLIC_SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
 BUCKET_NAME = "fatture-pdf"
+UPLOAD_WORKERS = 4        # upload contemporanei verso Storage
+UPLOAD_TENTATIVI = 4      # tentativi per file sugli errori transitori
+UPLOAD_ATTESA = 2.0       # secondi prima del primo retry (poi 4, 8...)
+STREAM_SOGLIA = 6 * 1024 * 1024   # oltre questa dimensione upload resumable a blocchi
+STREAM_BLOCCO = 6 * 1024 * 1024   # Storage accetta blocchi TUS da esattamente 6 MB (tranne l'ultimo)
 
 _base = Path(r"\\192.168.1.231\scambio\AMMINISTRAZIONE\Clienti e Fornitori\2025")
-_contab = next((d for d in _base.iterdir() if d.name.lower().startswith("contabilit")), None)
-if not _contab:
-    print("Cartella contabilita non trovata sotto", _base)
-    sys.exit(1)
 
-PDF_SOURCE_PATH = _contab / "Archivio_pdf"
 
-if not SUPABASE_URL or not SUPABASE_KEY:
-    print("Variabili d'ambiente NEXT_PUBLIC_SUPABASE_URL e SUPABASE_SERVICE_ROLE_KEY richieste.")
-    sys.exit(1)
+def trova_cartella_pdf() -> Path | None:
+    """Archivio_pdf sotto la cartella "contabilita'" (nome con accento variabile)."""
+    try:
+        contab = next((d for d in _base.iterdir() if d.name.lower().startswith("contabilit")), None)
+    except OSError:
+        contab = None
+    return contab / "Archivio_pdf" if contab else None
+
 
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+# Client e cartella risolti in esegui() (non all'import: sync_agent importa il modulo)
+PDF_SOURCE_PATH: Path | None = None
+supabase = None
+_registro: RegistroStorage | None = None   # hash dei PDF gia' su Storage, aperto da esegui()
+_cache = None   # CacheIndici tra un run e l'altro (solo con esegui(cache=True))
 
 # --- Log ---
 LOG_FILE = os.path.join(_project_root, "import_fatture_pdf_log.txt")
+REPORT_REVISIONE = os.path.join(_project_root, "import_fatture_pdf_revisione.csv")
 log_lines = []
 
 def log(msg: str):
@@ -95,6 +143,48 @@ def estrai_piva_da_nome(filename: str) -> str | None:
     return None
 
 
+def analizza_nome_pdf(filename: str) -> tuple[str | None, str | None, str | None]:
+    """(numero, data_iso, piva) dal nome file, None dove il pattern manca."""
+    numero, data_str = estrai_pattern_da_nome(filename)
+    try:
+        data_iso = datetime.strptime(data_str, "%d-%m-%Y").date().isoformat() if data_str else None
+    except ValueError:
+        data_iso = None
+    return numero, data_iso, estrai_piva_da_nome(filename)
+
+
+def pdf_recenti(cartella: Path, data_limite: str) -> tuple[list[tuple], int]:
+    """
+    PDF con data nel nome successiva a `data_limite` (ISO) come
+    [(nome, numero, data_iso, piva)] ordinati per nome, e totale PDF in
+    cartella. Usa l'indice locale; se non e' disponibile scansiona tutto.
+    """
+    try:
+        indice = IndiceCartella(str(cartella), analizza_nome_pdf)
+        try:
+            esito = indice.aggiorna()
+            if esito is None:
+                log("   Cartella invariata dall'ultima scansione, uso l'indice")
+            else:
+                log(f"   Indice aggiornato: {esito[0]} nuovi, {esito[1]} rimossi")
+            return indice.dal(data_limite), len(indice)
+        finally:
+            indice.close()
+    except sqlite3.Error as e:
+        log(f"   Indice cartella non disponibile ({e}), scansione completa")
+
+    righe, totale = [], 0
+    with os.scandir(cartella) as it:
+        for entry in it:
+            if not entry.name.lower().endswith(".pdf"):
+                continue
+            totale += 1
+            numero, data_iso, piva = analizza_nome_pdf(entry.name)
+            if data_iso and data_iso > data_limite:
+                righe.append((entry.name, numero, data_iso, piva))
+    return sorted(righe), totale
+
+
 def normalizza_num(s: str) -> str:
     """Normalizza numero fattura per confronto: rimuove separatori."""
     if not s:
@@ -102,29 +192,440 @@ def normalizza_num(s: str) -> str:
     return re.sub(r"[/\\\s\-._]", "", s).upper()
 
 
+class IndiceScadenzePdf:
+    """Scadenze senza file_url indicizzate per (numero normalizzato, data) e
+    (soggetto_id, data): il numero viene normalizzato una volta sola al
+    caricamento. Le scadenze abbinate vengono "consumate" e non possono
+    ricevere un secondo PDF."""
+
+    def __init__(self):
+        self._per_numero = defaultdict(list)    # (num_norm, data_emissione) -> [scadenza]
+        self._per_soggetto = defaultdict(list)  # (soggetto_id, data_emissione) -> [scadenza]
+        self._consumate = set()
+        self._totale = 0
+
+    def __len__(self):
+        return self._totale - len(self._consumate)
+
+    def aggiungi(self, sc):
+        if not sc.get("data_emissione"):
+            return
+        sc["_num"] = normalizza_num(sc.get("fattura_riferimento") or "")
+        self._totale += 1
+        if sc["_num"]:
+            self._per_numero[(sc["_num"], sc["data_emissione"])].append(sc)
+        if sc.get("soggetto_id"):
+            self._per_soggetto[(sc["soggetto_id"], sc["data_emissione"])].append(sc)
+
+    def cerca_e_consuma(self, num_norm: str, data_iso: str, soggetto_id: str | None) -> dict | None:
+        """1) stesso numero normalizzato e data; 2) stesso soggetto e data.
+        Con piu' scadenze del soggetto vince il prefisso comune piu' lungo col
+        numero del file, poi la lunghezza del numero piu' vicina, poi l'id
+        minore (stesso risultato a ogni run)."""
+        for sc in self._per_numero.get((num_norm, data_iso), []):
+            if sc["id"] not in self._consumate:
+                self._consumate.add(sc["id"])
+                return sc
+
+        if not soggetto_id:
+            return None
+        libere = [sc for sc in self._per_soggetto.get((soggetto_id, data_iso), [])
+                  if sc["id"] not in self._consumate]
+        if not libere:
+            return None
+        best = min(libere, key=lambda sc: (
+            -len(os.path.commonprefix([sc["_num"], num_norm])),
+            abs(len(sc["_num"]) - len(num_norm)),
+            str(sc["id"]),
+        ))
+        self._consumate.add(best["id"])
+        return best
+
+    def libere(self) -> list[dict]:
+        """Scadenze non ancora abbinate (per il passaggio fuzzy)."""
+        viste = set()
+        out = []
+        for lista in (*self._per_numero.values(), *self._per_soggetto.values()):
+            for sc in lista:
+                if sc["id"] not in self._consumate and sc["id"] not in viste:
+                    viste.add(sc["id"])
+                    out.append(sc)
+        return out
+
+    def consuma(self, sc: dict):
+        self._consumate.add(sc["id"])
+
+
+# --- Pre-caricamento ---
+def _creati_dopo(filtri: Callable, dopo: str | None) -> Callable:
+    """Aggiunge a `filtri` la condizione created_at > `dopo`, se dato."""
+    if dopo is None:
+        return filtri
+    return lambda q: filtri(q).gt("created_at", dopo)
+
+
+def _piu_recente(watermark: str | None, creato: str | None) -> str | None:
+    return creato if creato and (watermark is None or creato > watermark) else watermark
+
+
+def carica_scadenze(aperte: dict[str, dict], con_pdf: set[str], dopo: str | None = None) -> str | None:
+    """
+    Scadenze senza file_url in `aperte` (id -> riga) e chiavi
+    "numero_norm|data" di quelle con PDF in `con_pdf` (paginato, oltre 1000
+    righe non si perde nulla). Con `dopo` solo le scadenze create dopo
+    quell'istante. Ritorna il created_at piu' recente letto.
+    """
+    watermark = None
+    for r in scorri_tabella(supabase, "scadenze_pagamento",
+                            "id, fattura_riferimento, data_emissione, soggetto_id, importo_totale, created_at",
+                            filtri=_creati_dopo(lambda q: q.is_("file_url", "null"), dopo)):
+        aperte[r["id"]] = r
+        watermark = _piu_recente(watermark, r.get("created_at"))
+    for r in scorri_tabella(supabase, "scadenze_pagamento", "fattura_riferimento, data_emissione, created_at",
+                            filtri=_creati_dopo(lambda q: q.not_.is_("file_url", "null"), dopo)):
+        aperte.pop(r["id"], None)
+        if r.get("fattura_riferimento") and r.get("data_emissione"):
+            con_pdf.add(normalizza_num(r["fattura_riferimento"]) + "|" + r["data_emissione"])
+        watermark = _piu_recente(watermark, r.get("created_at"))
+    return watermark
+
+
+def carica_soggetti(piva_to_soggetto: dict[str, str], dopo: str | None = None,
+                    con_created_at: bool = False) -> str | None:
+    """Mappa PIVA/CF -> soggetto_id; con `dopo` solo i soggetti creati dopo
+    quell'istante. Ritorna il created_at piu' recente (se richiesto)."""
+    watermark = None
+    colonne = "id, partita_iva, codice_fiscale" + (", created_at" if con_created_at or dopo else "")
+    for r in scorri_tabella(supabase, "anagrafica_soggetti", colonne,
+                            filtri=_creati_dopo(lambda q: q, dopo)):
+        if r.get("partita_iva"):
+            piva_to_soggetto[r["partita_iva"]] = r["id"]
+            if len(r["partita_iva"]) > 11:
+                piva_to_soggetto[r["partita_iva"][:11]] = r["id"]
+        if r.get("codice_fiscale"):
+            piva_to_soggetto[r["codice_fiscale"]] = r["id"]
+        watermark = _piu_recente(watermark, r.get("created_at"))
+    return watermark
+
+
+def ancora_senza_pdf(ids: list[str]) -> set[str]:
+    """Tra gli id dati, le scadenze che esistono ancora e sono senza file_url."""
+    libere: set[str] = set()
+    for blocco in a_blocchi(ids, 100):
+        res = supabase.table("scadenze_pagamento").select("id") \
+            .in_("id", blocco).is_("file_url", "null").execute()
+        libere.update(r["id"] for r in res.data or [])
+    return libere
+
+
+class CacheIndici:
+    """
+    Scadenze e mappa PIVA tenute in memoria tra un run e l'altro quando lo
+    script gira dentro sync_agent (esegui(cache=True)), come gli indici di
+    riconciliazione_xml.
+
+    Ogni run scarica solo scadenze e soggetti creati dopo l'ultimo
+    created_at visto (meno SOVRAPPOSIZIONE, per le transazioni che hanno
+    fatto commit in ritardo). Le scadenze che ricevono il PDF da questo
+    script passano tra quelle con PDF; quelle che lo ricevono altrove
+    restano aperte in cache, per questo prima dell'upload le scadenze scelte
+    vengono riverificate (ancora_senza_pdf). Ogni RICARICA_COMPLETA_OGNI
+    secondi tutto viene ricaricato da zero.
+    """
+
+    RICARICA_COMPLETA_OGNI = 6 * 3600
+    SOVRAPPOSIZIONE = timedelta(minutes=5)
+
+    def __init__(self):
+        self.aperte: dict[str, dict] = {}
+        self.con_pdf: set[str] = set()
+        self.piva_to_soggetto: dict[str, str] = {}
+        self.watermark_scadenze: str | None = None
+        self.watermark_soggetti: str | None = None
+        self.caricata_il = 0.0
+
+    def _dopo(self, watermark):
+        if watermark is None:
+            return None
+        try:
+            return (datetime.fromisoformat(watermark) - self.SOVRAPPOSIZIONE).isoformat()
+        except ValueError:
+            return watermark
+
+    def aggiorna(self):
+        """Aggiorna la cache; ricarica tutto la prima volta o se l'ultima
+        ricarica completa e' piu' vecchia di RICARICA_COMPLETA_OGNI."""
+        if time.time() - self.caricata_il > self.RICARICA_COMPLETA_OGNI:
+            self.aperte, self.con_pdf, self.piva_to_soggetto = {}, set(), {}
+            self.watermark_scadenze = carica_scadenze(self.aperte, self.con_pdf)
+            self.watermark_soggetti = carica_soggetti(self.piva_to_soggetto, con_created_at=True)
+            self.caricata_il = time.time()
+            log(f"   Cache indici: ricarica completa ({len(self.aperte)} scadenze aperte, "
+                f"{len(self.piva_to_soggetto)} chiavi PIVA/CF)")
+            return
+        n_aperte, n_piva = len(self.aperte), len(self.piva_to_soggetto)
+        self.watermark_scadenze = _piu_recente(self.watermark_scadenze, carica_scadenze(
+            self.aperte, self.con_pdf, self._dopo(self.watermark_scadenze)))
+        self.watermark_soggetti = _piu_recente(self.watermark_soggetti, carica_soggetti(
+            self.piva_to_soggetto, self._dopo(self.watermark_soggetti)))
+        log(f"   Cache indici: {len(self.aperte) - n_aperte:+d} scadenze aperte, "
+            f"+{len(self.piva_to_soggetto) - n_piva} chiavi PIVA/CF dall'ultimo run")
+
+    def registra_pdf(self, ids: set[str]):
+        """Le scadenze che hanno ricevuto il file_url passano tra quelle con PDF."""
+        for id in ids:
+            sc = self.aperte.pop(id, None)
+            if sc and sc.get("fattura_riferimento") and sc.get("data_emissione"):
+                self.con_pdf.add(normalizza_num(sc["fattura_riferimento"]) + "|" + sc["data_emissione"])
+
+
 # --- Upload su Supabase Storage ---
-def upload_pdf(filepath: str, filename: str) -> str | None:
-    try:
-        anno = "2026"
-        match = re.search(r"(\d{4})", filename)
-        if match:
-            anno = match.group(1)
-        storage_path = f"{anno}/{filename}"
+def errore_transitorio(e: Exception) -> bool:
+    """Errori per cui ha senso ritentare: rete/timeout, 429 e 5xx di Storage."""
+    nome = type(e).__name__
+    if isinstance(e, (OSError, TimeoutError)) or any(t in nome for t in ("Timeout", "Connect", "Network", "Protocol")):
+        return True
+    testo = str(e)
+    return any(c in testo for c in ("429", "500", "502", "503", "504", "timed out"))
+
+
+def sha256_file(filepath: str) -> str:
+    """Hash del file letto a blocchi (memoria costante)."""
+    h = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        while blocco := f.read(STREAM_BLOCCO):
+            h.update(blocco)
+    return h.hexdigest()
+
+
+def _tus_headers(**extra) -> dict:
+    key = SUPABASE_KEY or getattr(supabase, "supabase_key", "")
+    return {"Authorization": f"Bearer {key}", "apikey": key, "Tus-Resumable": "1.0.0", **extra}
+
+
+def _allinea_hash(f, sessione: dict, offset: int):
+    """Porta l'hash incrementale di `sessione` esattamente a `offset` byte
+    (ripresa dopo un errore: Storage puo' aver ricevuto un blocco in piu' o
+    l'upload puo' ricominciare da zero)."""
+    if sessione["hash_offset"] > offset:
+        sessione["hash"], sessione["hash_offset"] = hashlib.sha256(), 0
+    f.seek(sessione["hash_offset"])
+    while sessione["hash_offset"] < offset:
+        blocco = f.read(min(STREAM_BLOCCO, offset - sessione["hash_offset"]))
+        if not blocco:
+            raise OSError(f"{f.name}: file piu' corto del previsto")
+        sessione["hash"].update(blocco)
+        sessione["hash_offset"] += len(blocco)
+    f.seek(offset)
+
+
+def upload_resumable(filepath: str, storage_path: str, dimensione: int, sessione: dict,
+                     battito: Callable[[], None] | None = None, calcola_hash: bool = False):
+    """
+    Upload TUS (/storage/v1/upload/resumable) a blocchi di STREAM_BLOCCO letti
+    direttamente dal file: in memoria c'e' al massimo un blocco. `battito`
+    viene chiamato dopo ogni blocco (un PDF grande non sembra uno step bloccato).
+    `sessione` conserva l'URL dell'upload tra un tentativo e l'altro di
+    upload_pdf: dopo un errore si chiede a Storage l'offset gia' ricevuto
+    (HEAD) e si riparte da li'. Con `calcola_hash` lo SHA-256 del file si
+    calcola dagli stessi blocchi e resta in sessione["hash"].
+    """
+    if calcola_hash and "hash" not in sessione:
+        sessione["hash"], sessione["hash_offset"] = hashlib.sha256(), 0
+    base = (SUPABASE_URL or str(getattr(supabase, "supabase_url", ""))).rstrip("/")
+    with httpx.Client(timeout=httpx.Timeout(60.0, connect=15.0)) as http:
+        offset = 0
+        if sessione.get("url"):
+            r = http.head(sessione["url"], headers=_tus_headers())
+            if r.status_code == 404:
+                sessione.pop("url")   # upload scaduto lato Storage: si ricomincia
+            else:
+                r.raise_for_status()
+                offset = int(r.headers["Upload-Offset"])
+        if not sessione.get("url"):
+            metadati = {"bucketName": BUCKET_NAME, "objectName": storage_path,
+                        "contentType": "application/pdf", "cacheControl": "3600"}
+            r = http.post(f"{base}/storage/v1/upload/resumable", headers=_tus_headers(**{
+                "Upload-Length": str(dimensione),
+                "Upload-Metadata": ",".join(f"{k} {base64.b64encode(v.encode()).decode()}"
+                                            for k, v in metadati.items()),
+                "x-upsert": "true",
+            }))
+            r.raise_for_status()
+            sessione["url"] = str(httpx.URL(base).join(r.headers["Location"]))
+
         with open(filepath, "rb") as f:
-            file_bytes = f.read()
-        supabase.storage.from_(BUCKET_NAME).upload(
-            storage_path,
-            file_bytes,
-            file_options={"content-type": "application/pdf", "upsert": "true"}
-        )
-        return supabase.storage.from_(BUCKET_NAME).get_public_url(storage_path)
-    except Exception as e:
-        log(f"  Errore upload {filename}: {e}")
-        return None
+            if "hash" in sessione:
+                _allinea_hash(f, sessione, offset)
+            f.seek(offset)
+            while offset < dimensione:
+                blocco = f.read(STREAM_BLOCCO)
+                if not blocco:
+                    raise OSError(f"{filepath}: file piu' corto del previsto ({offset}/{dimensione} byte)")
+                # Iteratore invece dei bytes: con content=bytes httpx tiene il
+                # blocco in un ciclo di riferimenti fino al passaggio del gc
+                r = http.patch(sessione["url"], content=iter((blocco,)), headers=_tus_headers(**{
+                    "Upload-Offset": str(offset),
+                    "Content-Length": str(len(blocco)),
+                    "Content-Type": "application/offset+octet-stream",
+                }))
+                r.raise_for_status()
+                if "hash" in sessione:
+                    sessione["hash"].update(blocco)
+                    sessione["hash_offset"] += len(blocco)
+                offset = int(r.headers.get("Upload-Offset", offset + len(blocco)))
+                if battito is not None:
+                    battito()
+
+
+def upload_pdf(filepath: str, filename: str, stream_soglia: int = STREAM_SOGLIA,
+               battito: Callable[[], None] | None = None) -> tuple[str | None, bool]:
+    """Carica il PDF su Storage; sugli errori transitori ritenta con backoff
+    esponenziale (UPLOAD_TENTATIVI volte). Thread-safe.
+    Se i byte sono gia' nel bucket (registro hash) non carica nulla; oltre
+    `stream_soglia` byte usa l'upload resumable senza leggere tutto il file.
+    Ritorna (file_url, riusato)."""
+    anno = "2026"
+    match = re.search(r"(\d{4})", filename)
+    if match:
+        anno = match.group(1)
+    storage_path = f"{anno}/{filename}"
+    attesa = UPLOAD_ATTESA
+    sessione: dict = {}
+    for tentativo in range(1, UPLOAD_TENTATIVI + 1):
+        try:
+            dimensione = os.path.getsize(filepath)
+            if dimensione > stream_soglia:
+                file_bytes = None
+                if _registro is None or not _registro.da_confrontare(dimensione, storage_path):
+                    # Nessun oggetto con cui confrontarlo: l'hash si calcola
+                    # durante l'upload invece di leggere il file due volte
+                    sha256 = None
+                else:
+                    sha256 = sessione.get("sha256") or sha256_file(filepath)
+                    sessione["sha256"] = sha256
+            else:
+                with open(filepath, "rb") as f:
+                    file_bytes = f.read()
+                sha256 = hashlib.sha256(file_bytes).hexdigest()
+            if _registro is not None and sha256 is not None:
+                file_url = _registro.cerca(sha256)
+                if file_url:
+                    return file_url, True
+                if _registro.percorso_occupato(storage_path, sha256):
+                    # Stesso nome, contenuto diverso: non sovrascrivere l'oggetto
+                    # (altre scadenze possono puntarci), caricalo accanto
+                    storage_path = f"{anno}/{Path(filename).stem}_{sha256[:8]}{Path(filename).suffix}"
+            if file_bytes is None:
+                upload_resumable(filepath, storage_path, dimensione, sessione, battito,
+                                 calcola_hash=sha256 is None)
+                sha256 = sha256 or sessione["hash"].hexdigest()
+            else:
+                supabase.storage.from_(BUCKET_NAME).upload(
+                    storage_path,
+                    file_bytes,
+                    file_options={"content-type": "application/pdf", "upsert": "true"}
+                )
+            file_url = supabase.storage.from_(BUCKET_NAME).get_public_url(storage_path)
+            if _registro is not None:
+                try:
+                    _registro.registra(sha256, storage_path, file_url, dimensione)
+                except Exception as e:
+                    log(f"  Registro hash non aggiornato per {filename}: {e}")
+            return file_url, False
+        except Exception as e:
+            if tentativo == UPLOAD_TENTATIVI or not errore_transitorio(e):
+                log(f"  Errore upload {filename}: {e}")
+                return None, False
+            log(f"  Upload {filename} fallito ({e}), nuovo tentativo tra {attesa:.0f}s")
+            time.sleep(attesa)
+            attesa *= 2
+    return None, False
+
+
+def aggiorna_file_url(abbinamenti: list[dict]) -> set[str]:
+    """Scrive file_url sulle scadenze [{"id", "file_url"}] a blocchi di 200
+    con l'RPC aggiorna_file_url_scadenze; senza la migrazione ricade su un
+    update per scadenza. Ritorna gli id aggiornati."""
+    aggiornati: set[str] = set()
+    usa_rpc = True
+    for blocco in a_blocchi(abbinamenti, 200):
+        if usa_rpc:
+            try:
+                res = supabase.rpc("aggiorna_file_url_scadenze", {"p_righe": blocco}).execute()
+                aggiornati.update(r if isinstance(r, str) else next(iter(r.values())) for r in res.data or [])
+                continue
+            except Exception as e:
+                if "aggiorna_file_url_scadenze" not in str(e):
+                    log(f"  Errore aggiornamento file_url ({len(blocco)} scadenze): {e} — riprovo una per una")
+                usa_rpc = False
+        for riga in blocco:
+            try:
+                supabase.table("scadenze_pagamento") \
+                    .update({"file_url": riga["file_url"]}) \
+                    .eq("id", riga["id"]) \
+                    .execute()
+                aggiornati.add(riga["id"])
+            except Exception as e:
+                log(f"  Errore update scadenza {riga['id']}: {e}")
+    return aggiornati
 
 
 # --- Main ---
-def main():
+def esegui(client=None, giorni_recenti: int = 7, upload_workers: int = UPLOAD_WORKERS,
+           progresso: Progresso | None = None, usa_registro: bool = True,
+           stream_soglia_mb: float | None = None, fuzzy: bool = True, cache: bool = False) -> dict:
+    """
+    Associa i PDF degli ultimi `giorni_recenti` giorni alle scadenze.
+    `client`: client Supabase gia' aperto (sync_agent); se None lo crea da .env.
+    `progresso`: riceve l'avanzamento (PDF scansionati/elaborati/associati).
+    `usa_registro`: False (--no-registro) ricarica sempre i byte su Storage.
+    `stream_soglia_mb`: PDF piu' grandi caricati a blocchi (default 6 MB).
+    `fuzzy`: False (--no-fuzzy) salta il passaggio fuzzy sui non abbinati.
+    `cache`: tiene scadenze e mappa PIVA in memoria per il run successivo (CacheIndici).
+    Ritorna i contatori (con 'errore' se l'import non e' partito).
+    """
+    global _registro, _cache
+    stream_soglia = STREAM_SOGLIA if stream_soglia_mb is None else int(stream_soglia_mb * 1024 * 1024)
+    if usa_registro:
+        try:
+            _registro = RegistroStorage(BUCKET_NAME)
+        except Exception as e:
+            print(f"Registro hash non disponibile ({e}): carico tutti i PDF")
+            _registro = None
+    ok = False
+    try:
+        risultato = _esegui(client, giorni_recenti, upload_workers, progresso, fuzzy, stream_soglia, cache)
+        ok = not risultato.get("errore") and not risultato.get("errori")
+        return risultato
+    finally:
+        if not ok:
+            # Dopo un errore la cache puo' non sapere quali scadenze hanno
+            # ricevuto il PDF: il prossimo run riparte da un caricamento completo
+            _cache = None
+        if _registro is not None:
+            _registro.close()
+            _registro = None
+
+
+def _esegui(client, giorni_recenti: int, upload_workers: int, progresso: Progresso | None,
+            fuzzy: bool, stream_soglia: int, usa_cache: bool) -> dict:
+    global supabase, PDF_SOURCE_PATH, _cache
+    log_lines.clear()
+    if not usa_cache:
+        _cache = None
+    progresso = progresso or Progresso()
+
+    if client is None and (not SUPABASE_URL or not SUPABASE_KEY):
+        print("Variabili d'ambiente NEXT_PUBLIC_SUPABASE_URL e SUPABASE_SERVICE_ROLE_KEY richieste.")
+        return {"errore": "configurazione_mancante"}
+    supabase = client or supabase or create_client(SUPABASE_URL, SUPABASE_KEY)
+
+    PDF_SOURCE_PATH = trova_cartella_pdf()
+    if PDF_SOURCE_PATH is None:
+        print("Cartella contabilita non trovata sotto", _base)
+        return {"errore": "cartella_non_trovata"}
+
     log("=" * 60)
     log("IMPORT FATTURE PDF -> Supabase Storage + Associazione Scadenze")
     log(f"Sorgente PDF: {PDF_SOURCE_PATH}")
@@ -133,115 +634,82 @@ def main():
 
     if not PDF_SOURCE_PATH.exists():
         log(f"Cartella PDF non trovata: {PDF_SOURCE_PATH}")
-        sys.exit(1)
-
-    # Flag --days
-    giorni_recenti = 7
-    for i, arg in enumerate(sys.argv):
-        if arg.startswith("--days="):
-            try:
-                giorni_recenti = int(arg.split("=")[1])
-            except ValueError:
-                pass
-        elif arg == "--days" and i + 1 < len(sys.argv):
-            try:
-                giorni_recenti = int(sys.argv[i + 1])
-            except ValueError:
-                pass
+        return {"errore": "cartella_non_trovata"}
 
     # 1. Pre-carica scadenze aperte (senza file_url) in memoria
-    log("Pre-caricamento scadenze aperte...")
-    scadenze_per_data: dict[str, list[dict]] = defaultdict(list)
-    scadenze_con_pdf: set[str] = set()  # set di (fattura_rif_norm, data_iso) gia' associati
-
-    try:
-        # Scadenze senza file_url (da associare)
-        res = supabase.table("scadenze_pagamento") \
-            .select("id, fattura_riferimento, data_emissione, soggetto_id") \
-            .is_("file_url", "null") \
-            .execute()
-        for r in (res.data or []):
-            if r.get("data_emissione"):
-                scadenze_per_data[r["data_emissione"]].append(r)
-        tot_aperte = sum(len(v) for v in scadenze_per_data.values())
-        log(f"   {tot_aperte} scadenze aperte (senza PDF)")
-
-        # Scadenze con file_url (per skip)
-        res2 = supabase.table("scadenze_pagamento") \
-            .select("fattura_riferimento, data_emissione") \
-            .not_.is_("file_url", "null") \
-            .execute()
-        for r in (res2.data or []):
-            if r.get("fattura_riferimento") and r.get("data_emissione"):
-                key = normalizza_num(r["fattura_riferimento"]) + "|" + r["data_emissione"]
-                scadenze_con_pdf.add(key)
-        log(f"   {len(scadenze_con_pdf)} scadenze gia' con PDF")
-    except Exception as e:
-        log(f"   Errore pre-caricamento scadenze: {e}")
-        sys.exit(1)
-
     # 2. Pre-carica mappa PIVA -> soggetto_id
-    log("Pre-caricamento mappa PIVA...")
+    log("Pre-caricamento scadenze aperte e mappa PIVA...")
+    aperte: dict[str, dict] = {}
+    scadenze_con_pdf: set[str] = set()  # set di (fattura_rif_norm, data_iso) gia' associati
     piva_to_soggetto: dict[str, str] = {}
-    try:
-        res = supabase.table("anagrafica_soggetti") \
-            .select("id, partita_iva, codice_fiscale") \
-            .execute()
-        for r in (res.data or []):
-            if r.get("partita_iva"):
-                piva_to_soggetto[r["partita_iva"]] = r["id"]
-                if len(r["partita_iva"]) > 11:
-                    piva_to_soggetto[r["partita_iva"][:11]] = r["id"]
-            if r.get("codice_fiscale"):
-                piva_to_soggetto[r["codice_fiscale"]] = r["id"]
-        log(f"   {len(piva_to_soggetto)} chiavi PIVA/CF mappate")
-    except Exception as e:
-        log(f"   Errore pre-caricamento soggetti: {e}")
-
-    # 3. Scansiona PDF recenti (filtro solo per data nel nome, zero stat() su rete)
+    if usa_cache:
+        try:
+            if _cache is None:
+                _cache = CacheIndici()
+            _cache.aggiorna()
+            # Copia: le chiavi aggiunte durante l'abbinamento valgono solo se l'upload riesce
+            aperte, scadenze_con_pdf, piva_to_soggetto = _cache.aperte, set(_cache.con_pdf), _cache.piva_to_soggetto
+        except Exception as e:
+            # Incrementale non riuscito (es. colonna created_at assente): cache scartata,
+            # si ricade sul caricamento completo qui sotto
+            _cache = None
+            log(f"   Cache indici non aggiornabile: {e}")
+    if _cache is None:
+        try:
+            carica_scadenze(aperte, scadenze_con_pdf)
+        except Exception as e:
+            log(f"   Errore pre-caricamento scadenze: {e}")
+            return {"errore": "indice_non_disponibile"}
+        try:
+            carica_soggetti(piva_to_soggetto)
+        except Exception as e:
+            log(f"   Errore pre-caricamento soggetti: {e}")
+    indice = IndiceScadenzePdf()
+    for sc in aperte.values():
+        indice.aggiungi(sc)
+    log(f"   {len(indice)} scadenze aperte (senza PDF)")
+    log(f"   {len(scadenze_con_pdf)} scadenze gia' con PDF")
+    log(f"   {len(piva_to_soggetto)} chiavi PIVA/CF mappate")
+
+    # 3. PDF recenti dall'indice della cartella (filtro solo per data nel nome,
+    #    zero stat() su rete; scansione solo se la cartella e' cambiata)
     log(f"Scansione PDF (ultimi {giorni_recenti} giorni)...")
-    data_limite = datetime.now() - timedelta(days=giorni_recenti)
-    all_pdf_files = list(PDF_SOURCE_PATH.glob("*.pdf")) + list(PDF_SOURCE_PATH.glob("*.PDF"))
-    # Deduplica case-insensitive senza resolve() (evita stat su rete)
+    progresso.fase("scansione")
+    data_limite = (datetime.now() - timedelta(days=giorni_recenti)).date().isoformat()
+    try:
+        recenti, totale_pdf = pdf_recenti(PDF_SOURCE_PATH, data_limite)
+    except OSError as e:
+        log(f"   Errore scansione {PDF_SOURCE_PATH}: {e}")
+        return {"errore": "cartella_non_leggibile"}
+    # Deduplica case-insensitive (stesso file visto come .pdf e .PDF)
+    pdf_files: list[tuple] = []
     seen_names: set[str] = set()
-    unique_pdfs: list[Path] = []
-    for p in all_pdf_files:
-        low = p.name.lower()
-        if low not in seen_names:
-            seen_names.add(low)
-            unique_pdfs.append(p)
-    all_pdf_files = unique_pdfs
-
-    pdf_files = []
-    for p in all_pdf_files:
-        _, data_str = estrai_pattern_da_nome(p.name)
-        if not data_str:
-            continue  # skip file senza pattern data nel nome
-        try:
-            data_file = datetime.strptime(data_str, "%d-%m-%Y")
-            if data_file >= data_limite:
-                pdf_files.append(p)
-        except ValueError:
-            pass
+    for riga in recenti:
+        if riga[0].lower() not in seen_names:
+            seen_names.add(riga[0].lower())
+            pdf_files.append(riga)
 
-    log(f"   Totale PDF su disco: {len(all_pdf_files)}, recenti ({giorni_recenti}gg): {len(pdf_files)}")
+    log(f"   Totale PDF su disco: {totale_pdf}, recenti ({giorni_recenti}gg): {len(pdf_files)}")
 
-    stats = {"uploadati": 0, "matchati": 0, "non_matchati": 0, "errori": 0, "gia_presenti": 0, "no_pattern": 0}
+    stats = {"uploadati": 0, "riusati": 0, "matchati": 0, "non_matchati": 0, "errori": 0, "gia_presenti": 0,
+             "no_pattern": 0, "fuzzy": 0, "da_revisionare": 0}
     non_matchati_list = []
-
-    # 4. Processa ogni PDF
-    for pdf_path in sorted(pdf_files):
-        filename = pdf_path.name
-        num_file, data_file = estrai_pattern_da_nome(filename)
+    residui: list[tuple[str, str, str, str | None]] = []   # per il passaggio fuzzy
+
+    # 4. Abbina ogni PDF a una scadenza (in memoria, sequenziale): la scadenza
+    #    scelta viene consumata nell'indice, quindi due PDF non possono prendere
+    #    la stessa anche se gli upload poi girano in parallelo
+    da_caricare: list[tuple[Path, dict]] = []
+    progresso.fase("abbinamento", totale=len(pdf_files), scansionati=totale_pdf)
+    for filename, num_file, data_iso, piva in pdf_files:
+        progresso.avanza(errori=stats["errori"])
+        pdf_path = PDF_SOURCE_PATH / filename
         if not num_file:
             stats["no_pattern"] += 1
             non_matchati_list.append(f"  - {filename} -> (pattern non riconosciuto)")
             continue
 
-        parts = data_file.split("-")
-        data_iso = f"{parts[2]}-{parts[1]}-{parts[0]}"
         num_norm = normalizza_num(num_file)
-        piva = estrai_piva_da_nome(filename)
 
         # Skip se gia' associato
         skip_key = num_norm + "|" + data_iso
@@ -249,62 +717,97 @@ def main():
             stats["gia_presenti"] += 1
             continue
 
-        # Matching in memoria
-        candidati = scadenze_per_data.get(data_iso, [])
-        target = None
-
-        # Strategia 1: numero normalizzato + data
-        for sc in candidati:
-            if normalizza_num(sc.get("fattura_riferimento", "")) == num_norm:
-                target = sc
-                break
-
-        # Strategia 2: PIVA + data
-        if not target and piva:
+        # Matching in memoria: numero+data, poi soggetto (da PIVA)+data
+        soggetto_id = None
+        if piva:
             soggetto_id = piva_to_soggetto.get(piva)
             if not soggetto_id and len(piva) > 11:
                 soggetto_id = piva_to_soggetto.get(piva[:11])
-            if soggetto_id:
-                matches_piva = [sc for sc in candidati if sc.get("soggetto_id") == soggetto_id]
-                if len(matches_piva) == 1:
-                    target = matches_piva[0]
-                elif len(matches_piva) > 1:
-                    # Scegli quello con fattura_riferimento piu' simile
-                    best = max(matches_piva, key=lambda s: (
-                        1000 if normalizza_num(s.get("fattura_riferimento", "")) == num_norm else
-                        len(os.path.commonprefix([normalizza_num(s.get("fattura_riferimento", "")), num_norm]))
-                    ))
-                    target = best
+        target = indice.cerca_e_consuma(num_norm, data_iso, soggetto_id)
 
         if not target:
-            stats["non_matchati"] += 1
-            non_matchati_list.append(f"  - {filename} -> num={num_file!r} del {data_iso} piva={piva}")
+            residui.append((filename, num_file, data_iso, soggetto_id))
             continue
 
-        # Upload PDF
         log(f"\n  {filename}")
         log(f"  -> scadenza {target['id']} (fatt: {target.get('fattura_riferimento', '?')})")
-
-        file_url = upload_pdf(str(pdf_path), filename)
-        if not file_url:
-            stats["errori"] += 1
-            continue
-
-        stats["uploadati"] += 1
-
-        # Update file_url sulla scadenza
+        scadenze_con_pdf.add(skip_key)
+        da_caricare.append((pdf_path, target))
+
+    # 4b. Passaggio fuzzy solo sui PDF rimasti senza scadenza
+    if residui and fuzzy:
+        automatici, da_revisionare = AbbinatoreFuzzy(indice.libere()).abbina(residui)
+        abbinati_fuzzy = {p.nome_file for p in automatici}
+        for p in automatici:
+            indice.consuma(p.scadenza)
+            log(f"\n  {p.nome_file}")
+            log(f"  -> scadenza {p.scadenza['id']} (fatt: {p.scadenza.get('fattura_riferimento', '?')}, "
+                f"fuzzy {p.punteggio})")
+            da_caricare.append((PDF_SOURCE_PATH / p.nome_file, p.scadenza))
+        stats["fuzzy"] = len(automatici)
+        stats["da_revisionare"] = len(da_revisionare)
+        if da_revisionare:
+            try:
+                scrivi_report(REPORT_REVISIONE, da_revisionare)
+                log(f"\n{len(da_revisionare)} abbinamenti incerti da controllare in {REPORT_REVISIONE}")
+            except OSError as e:
+                log(f"\nReport revisione non scritto: {e}")
+        elif os.path.exists(REPORT_REVISIONE):
+            os.remove(REPORT_REVISIONE)   # report del run precedente non piu' attuale
+        residui = [r for r in residui if r[0] not in abbinati_fuzzy]
+
+    for filename, num_file, data_iso, soggetto_id in residui:
+        stats["non_matchati"] += 1
+        non_matchati_list.append(f"  - {filename} -> num={num_file!r} del {data_iso} "
+                                 f"piva={estrai_piva_da_nome(filename)}")
+
+    # Con la cache una scadenza "aperta" puo' aver ricevuto il PDF altrove (app,
+    # altro agent) o essere stata cancellata: verifica mirata sulle sole scelte
+    if da_caricare and _cache is not None:
         try:
-            supabase.table("scadenze_pagamento") \
-                .update({"file_url": file_url}) \
-                .eq("id", target["id"]) \
-                .execute()
-            stats["matchati"] += 1
-            # Rimuovi dalla lista aperte (evita doppi match)
-            candidati.remove(target)
-            scadenze_con_pdf.add(skip_key)
+            libere = ancora_senza_pdf([target["id"] for _, target in da_caricare])
         except Exception as e:
-            log(f"  Errore update scadenza {target['id']}: {e}")
-            stats["errori"] += 1
+            log(f"   Errore verifica scadenze scelte: {e}")
+            return {"errore": "indice_non_disponibile"}
+        superate = [(p, target) for p, target in da_caricare if target["id"] not in libere]
+        if superate:
+            # Cache non piu' allineata: i PDF restano da associare e il
+            # prossimo run ricarica tutto da zero
+            _cache.caricata_il = 0.0
+            for p, target in superate:
+                stats["non_matchati"] += 1
+                non_matchati_list.append(f"  - {p.name} -> scadenza {target['id']} non piu' senza PDF, "
+                                         f"riprovo al prossimo run")
+            da_caricare = [(p, target) for p, target in da_caricare if target["id"] in libere]
+
+    # 5. Upload in parallelo; ogni upload riuscito produce il suo abbinamento
+    abbinamenti: list[dict] = []
+    progresso.fase("upload", totale=len(da_caricare))
+    if da_caricare:
+        log(f"\nUpload di {len(da_caricare)} PDF ({max(1, upload_workers)} in parallelo)...")
+    with ThreadPoolExecutor(max_workers=max(1, upload_workers), thread_name_prefix="pdf-upload") as pool:
+        futures = {pool.submit(upload_pdf, str(p), p.name, stream_soglia, progresso.battito): target for p, target in da_caricare}
+        try:
+            for fut in as_completed(futures):
+                file_url, riusato = fut.result()
+                if file_url:
+                    stats["riusati" if riusato else "uploadati"] += 1
+                    abbinamenti.append({"id": futures[fut]["id"], "file_url": file_url})
+                else:
+                    stats["errori"] += 1
+                progresso.avanza(errori=stats["errori"])
+        except BaseException:
+            # Step annullato: gli upload non ancora partiti non partono piu'
+            for fut in futures:
+                fut.cancel()
+            raise
+
+    # 6. file_url su tutte le scadenze abbinate in un colpo solo
+    aggiornati = aggiorna_file_url(abbinamenti) if abbinamenti else set()
+    if _cache is not None:
+        _cache.registra_pdf(aggiornati)
+    stats["matchati"] = len(aggiornati)
+    stats["errori"] += len(abbinamenti) - len(aggiornati)
 
     # Riepilogo
     log("\n" + "=" * 60)
@@ -313,7 +816,10 @@ def main():
     log(f"  Gia' con PDF (skip):     {stats['gia_presenti']}")
     log(f"  Pattern non riconosciuto: {stats['no_pattern']}")
     log(f"  Nuovi caricati:           {stats['uploadati']}")
+    log(f"  Gia' su Storage (riusati): {stats['riusati']}")
     log(f"  Associati a scadenze:     {stats['matchati']}")
+    log(f"  di cui con match fuzzy:   {stats['fuzzy']}")
+    log(f"  Da revisionare (report):  {stats['da_revisionare']}")
     log(f"  Non associati:            {stats['non_matchati']}")
     log(f"  Errori:                   {stats['errori']}")
 
@@ -327,8 +833,53 @@ def main():
     with open(LOG_FILE, "a", encoding="utf-8") as f:
         f.write("\n".join(log_lines) + "\n\n")
 
+    progresso.fine(abbinati=stats["matchati"], errori=stats["errori"])
+    return stats
+
+
+def main():
+    # Flag --days
+    giorni_recenti = 7
+    for i, arg in enumerate(sys.argv):
+        if arg.startswith("--days="):
+            try:
+                giorni_recenti = int(arg.split("=")[1])
+            except ValueError:
+                pass
+        elif arg == "--days" and i + 1 < len(sys.argv):
+            try:
+                giorni_recenti = int(sys.argv[i + 1])
+            except ValueError:
+                pass
+
+    upload_workers = UPLOAD_WORKERS
+    for i, arg in enumerate(sys.argv):
+        try:
+            if arg.startswith("--upload-workers="):
+                upload_workers = int(arg.split("=")[1])
+            elif arg == "--upload-workers" and i + 1 < len(sys.argv):
+                upload_workers = int(sys.argv[i + 1])
+        except ValueError:
+            pass
+
+    stream_soglia_mb = None
+    for i, arg in enumerate(sys.argv):
+        try:
+            if arg.startswith("--stream-soglia-mb="):
+                stream_soglia_mb = float(arg.split("=")[1])
+            elif arg == "--stream-soglia-mb" and i + 1 < len(sys.argv):
+                stream_soglia_mb = float(sys.argv[i + 1])
+        except ValueError:
+            pass
+
+    stats = esegui(giorni_recenti=giorni_recenti, upload_workers=upload_workers,
+                   progresso=Progresso.da_cli(), usa_registro="--no-registro" not in sys.argv,
+                   stream_soglia_mb=stream_soglia_mb, fuzzy="--no-fuzzy" not in sys.argv)
+
     if "--json" in sys.argv:
         print(f"###JSON_RESULT###{json.dumps(stats)}")
+    elif "errore" in stats:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
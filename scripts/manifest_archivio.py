@@ -0,0 +1,412 @@
+"""
+manifest_archivio.py
+====================
+Manifest locale (SQLite, accanto agli script) dei file gia' visti negli
+archivi sulla share di rete.
+
+Per ogni file registra dimensione, mtime, hash SHA-256 del contenuto ed
+esito dell'ultima importazione, cosi' ogni run elabora solo:
+  - i file nuovi,
+  - i file cambiati (dimensione/mtime diversi e hash diverso),
+  - i file il cui import precedente e' fallito o si e' interrotto a meta'.
+
+Il costo di avvio dipende dai file nuovi, non dalla dimensione dell'archivio:
+se l'mtime della cartella non e' cambiato (nessun file aggiunto, rinominato
+o tolto) basta una stat() della cartella e i file sono quelli gia' nel
+manifest. La lista viene riletta (os.scandir: su Windows dimensione e mtime
+arrivano con la lista, senza una stat() per file) solo quando la cartella
+cambia, ogni RISCANSIONE_OGNI secondi o su richiesta (--full).
+
+Nello stesso database RegistroStorage tiene l'hash SHA-256 dei file gia'
+caricati su Supabase Storage, per non ricaricare byte identici, e
+IndiceCartella i nomi dei file di una cartella (es. Archivio_pdf) gia'
+analizzati, per selezionarli per data senza riscansionare la share.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from typing import Callable
+
+MANIFEST_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "manifest_archivio.sqlite")
+
+# Esiti registrati
+IMPORTATO = "importato"        # scritto in DB da questo script
+GIA_PRESENTE = "gia_presente"  # trovato gia' in DB (importato altrove / prima del manifest)
+IGNORATO = "ignorato"          # file senza dati utili (es. CedentePrestatore mancante)
+IN_CORSO = "in_corso"          # scrittura avviata ma non confermata: da riprendere
+ERRORE = "errore"              # da ritentare al prossimo run
+
+ESITI_CONCLUSI = (IMPORTATO, GIA_PRESENTE, IGNORATO)
+
+# Ogni quanto riscansionare comunque una cartella con mtime invariato
+# (share che non aggiornano l'mtime, file modificati sul posto)
+RISCANSIONE_OGNI = 24 * 3600
+
+
+def _apri_db(percorso_db: str) -> sqlite3.Connection:
+    """Connessione al database del manifest, condivisa tra thread (gli
+    accessi passano dal lock dell'oggetto che la usa)."""
+    conn = sqlite3.connect(percorso_db, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def _crea_cartelle_scansionate(conn: sqlite3.Connection):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS cartelle_scansionate (
+            cartella       TEXT PRIMARY KEY,
+            mtime          REAL,
+            scansionata_il REAL
+        )
+    """)
+
+
+def _scansione_superflua(conn: sqlite3.Connection, chiave: str, mtime: float) -> bool:
+    """True se la cartella ha lo stesso mtime dell'ultima scansione e la
+    riscansione periodica non e' ancora dovuta."""
+    precedente = conn.execute(
+        "SELECT mtime, scansionata_il FROM cartelle_scansionate WHERE cartella = ?", (chiave,)
+    ).fetchone()
+    return bool(precedente and precedente[0] == mtime
+                and time.time() - precedente[1] < RISCANSIONE_OGNI)
+
+
+def _segna_scansionata(conn: sqlite3.Connection, chiave: str, mtime: float):
+    conn.execute(
+        """INSERT INTO cartelle_scansionate (cartella, mtime, scansionata_il) VALUES (?, ?, ?)
+           ON CONFLICT (cartella) DO UPDATE SET
+             mtime = excluded.mtime, scansionata_il = excluded.scansionata_il""",
+        (chiave, mtime, time.time()),
+    )
+
+
+class ManifestArchivio:
+
+    def __init__(self, cartella: str, percorso_db: str = MANIFEST_PATH):
+        self.cartella = cartella
+        self._lock = threading.Lock()
+        self._conn = _apri_db(percorso_db)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS file_archivio (
+                cartella      TEXT NOT NULL,
+                nome          TEXT NOT NULL,
+                dimensione    INTEGER,
+                mtime         REAL,
+                sha256        TEXT,
+                esito         TEXT,
+                errore        TEXT,
+                aggiornato_il TEXT,
+                PRIMARY KEY (cartella, nome)
+            )
+        """)
+        _crea_cartelle_scansionate(self._conn)
+        self._conn.commit()
+        self._noti: dict[str, tuple] = {
+            nome: (dimensione, mtime, sha256, esito)
+            for nome, dimensione, mtime, sha256, esito in self._conn.execute(
+                "SELECT nome, dimensione, mtime, sha256, esito FROM file_archivio WHERE cartella = ?",
+                (cartella,),
+            )
+        }
+
+    def __len__(self):
+        return len(self._noti)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    # ─── SCANSIONE ────────────────────────────────────────────────────────────
+
+    def scansiona(self, estensione: str = ".xml", forza: bool = False) -> dict[str, tuple[int, float]]:
+        """
+        Ritorna {nome: (dimensione, mtime)} dei file della cartella.
+
+        Se la cartella non e' cambiata dall'ultima scansione la lista non viene
+        riletta: i file sono quelli del manifest, con dimensione e mtime
+        registrati. Un file modificato sul posto (mtime della cartella
+        invariato) viene quindi visto alla riscansione periodica o con forza.
+        """
+        estensione = estensione.lower()
+        chiave = os.path.join(self.cartella, "*" + estensione)
+        mtime_cartella = os.stat(self.cartella).st_mtime
+        with self._lock:
+            superflua = not forza and _scansione_superflua(self._conn, chiave, mtime_cartella)
+        if superflua:
+            return {nome: (noto[0], noto[1]) for nome, noto in self._noti.items()
+                    if nome.lower().endswith(estensione)}
+
+        voci = {}
+        with os.scandir(self.cartella) as it:
+            for entry in it:
+                if not entry.name.lower().endswith(estensione):
+                    continue
+                try:
+                    if not entry.is_file():
+                        continue
+                    st = entry.stat()
+                except OSError:
+                    continue
+                voci[entry.name] = (st.st_size, st.st_mtime)
+
+        # I file mai visti entrano subito nel manifest senza esito (= da
+        # processare), cosi' le scansioni saltate li ritrovano anche se questo
+        # run si interrompe; i file tolti dalla cartella escono dal manifest
+        nuovi = [(nome, dimensione, mtime) for nome, (dimensione, mtime) in voci.items()
+                 if nome not in self._noti]
+        tolti = [nome for nome in self._noti if nome.lower().endswith(estensione) and nome not in voci]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO file_archivio (cartella, nome, dimensione, mtime) VALUES (?, ?, ?, ?)",
+                [(self.cartella, *riga) for riga in nuovi],
+            )
+            self._conn.executemany(
+                "DELETE FROM file_archivio WHERE cartella = ? AND nome = ?",
+                [(self.cartella, nome) for nome in tolti],
+            )
+            _segna_scansionata(self._conn, chiave, mtime_cartella)
+            self._conn.commit()
+            for nome, dimensione, mtime in nuovi:
+                self._noti[nome] = (dimensione, mtime, None, None)
+            for nome in tolti:
+                del self._noti[nome]
+        return voci
+
+    def da_processare(self, voci: dict[str, tuple[int, float]]) -> list[str]:
+        """Filtra i file nuovi, modificati o con import non concluso."""
+        out = []
+        for nome, (dimensione, mtime) in voci.items():
+            noto = self._noti.get(nome)
+            if noto is None or noto[3] not in ESITI_CONCLUSI:
+                out.append(nome)
+            elif noto[0] != dimensione or noto[1] != mtime:
+                out.append(nome)
+        return sorted(out)
+
+    def esito(self, nome: str) -> str | None:
+        noto = self._noti.get(nome)
+        return noto[3] if noto else None
+
+    def stesso_contenuto(self, nome: str, sha256: str | None) -> bool:
+        """True se l'hash coincide con quello di un import gia' concluso
+        (file "toccato" ma non cambiato: basta aggiornare dimensione/mtime)."""
+        noto = self._noti.get(nome)
+        return bool(sha256 and noto and noto[2] == sha256 and noto[3] in ESITI_CONCLUSI)
+
+    # ─── REGISTRAZIONE ────────────────────────────────────────────────────────
+
+    def registra(self, nome: str, dimensione: int | None, mtime: float | None,
+                 sha256: str | None, esito: str, errore: str | None = None):
+        """Salva l'esito di un file (thread-safe, commit immediato)."""
+        self.registra_molti([(nome, dimensione, mtime, sha256, esito, errore)])
+
+    def registra_molti(self, righe: list[tuple]):
+        """Come registra() per piu' file in una sola transazione.
+        Ogni riga: (nome, dimensione, mtime, sha256, esito, errore)."""
+        if not righe:
+            return
+        adesso = datetime.now().isoformat(timespec="seconds")
+        with self._lock:
+            valori = []
+            for nome, dimensione, mtime, sha256, esito, errore in righe:
+                precedente = self._noti.get(nome)
+                if sha256 is None and precedente:
+                    sha256 = precedente[2]
+                valori.append((self.cartella, nome, dimensione, mtime, sha256, esito,
+                               (str(errore)[:500] if errore else None), adesso))
+                self._noti[nome] = (dimensione, mtime, sha256, esito)
+            self._conn.executemany(
+                """INSERT INTO file_archivio (cartella, nome, dimensione, mtime, sha256, esito, errore, aggiornato_il)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT (cartella, nome) DO UPDATE SET
+                     dimensione = excluded.dimensione, mtime = excluded.mtime, sha256 = excluded.sha256,
+                     esito = excluded.esito, errore = excluded.errore, aggiornato_il = excluded.aggiornato_il""",
+                valori,
+            )
+            self._conn.commit()
+
+
+class RegistroStorage:
+    """
+    Oggetti gia' caricati in un bucket di Supabase Storage, per hash SHA-256
+    del contenuto. Se lo stesso PDF va ricollegato (file_url azzerato, nuovo
+    abbinamento, run con --days ampio, copia con altro nome) si riusa il
+    percorso esistente invece di ricaricare i byte sulla linea dell'ufficio.
+    """
+
+    def __init__(self, bucket: str, percorso_db: str = MANIFEST_PATH):
+        self.bucket = bucket
+        self._lock = threading.Lock()
+        self._conn = _apri_db(percorso_db)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS oggetti_storage (
+                bucket        TEXT NOT NULL,
+                sha256        TEXT NOT NULL,
+                storage_path  TEXT NOT NULL,
+                file_url      TEXT NOT NULL,
+                dimensione    INTEGER,
+                caricato_il   TEXT,
+                PRIMARY KEY (bucket, sha256)
+            )
+        """)
+        self._conn.commit()
+        self._noti: dict[str, str] = {
+            sha256: file_url
+            for sha256, file_url in self._conn.execute(
+                "SELECT sha256, file_url FROM oggetti_storage WHERE bucket = ?", (bucket,)
+            )
+        }
+
+    def __len__(self):
+        return len(self._noti)
+
+    def cerca(self, sha256: str) -> str | None:
+        """file_url di un oggetto gia' caricato con lo stesso contenuto."""
+        return self._noti.get(sha256)
+
+    def da_confrontare(self, dimensione: int, storage_path: str) -> bool:
+        """True se c'e' un oggetto della stessa dimensione o sullo stesso
+        percorso: solo allora serve l'hash del file prima dell'upload (byte
+        di dimensione diversa non possono essere gli stessi)."""
+        with self._lock:
+            return self._conn.execute(
+                """SELECT 1 FROM oggetti_storage
+                   WHERE bucket = ? AND (dimensione = ? OR storage_path = ?) LIMIT 1""",
+                (self.bucket, dimensione, storage_path),
+            ).fetchone() is not None
+
+    def percorso_occupato(self, storage_path: str, sha256: str) -> bool:
+        """True se `storage_path` contiene gia' byte diversi da `sha256`:
+        sovrascriverlo romperebbe i file_url che lo riusano."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT 1 FROM oggetti_storage WHERE bucket = ? AND storage_path = ? AND sha256 <> ? LIMIT 1",
+                (self.bucket, storage_path, sha256),
+            ).fetchone() is not None
+
+    def registra(self, sha256: str, storage_path: str, file_url: str, dimensione: int | None):
+        """Registra un upload riuscito. Un upload con upsert sovrascrive il
+        percorso: gli hash registrati prima sullo stesso percorso non sono
+        piu' validi e vengono tolti."""
+        with self._lock:
+            superati = [r[0] for r in self._conn.execute(
+                "SELECT sha256 FROM oggetti_storage WHERE bucket = ? AND storage_path = ? AND sha256 <> ?",
+                (self.bucket, storage_path, sha256),
+            )]
+            if superati:
+                self._conn.execute(
+                    "DELETE FROM oggetti_storage WHERE bucket = ? AND storage_path = ? AND sha256 <> ?",
+                    (self.bucket, storage_path, sha256),
+                )
+                for h in superati:
+                    self._noti.pop(h, None)
+            self._conn.execute(
+                """INSERT INTO oggetti_storage (bucket, sha256, storage_path, file_url, dimensione, caricato_il)
+                   VALUES (?, ?, ?, ?, ?, ?)
+                   ON CONFLICT (bucket, sha256) DO UPDATE SET
+                     storage_path = excluded.storage_path, file_url = excluded.file_url,
+                     dimensione = excluded.dimensione, caricato_il = excluded.caricato_il""",
+                (self.bucket, sha256, storage_path, file_url, dimensione,
+                 datetime.now().isoformat(timespec="seconds")),
+            )
+            self._conn.commit()
+            self._noti[sha256] = file_url
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class IndiceCartella:
+    """
+    Indice persistente dei nomi file di una cartella con i campi estratti dal
+    nome (numero, data, partita IVA) e la data in cui il file e' stato visto
+    la prima volta.
+
+    aggiorna() riscansiona la cartella (os.scandir, solo nomi: nessuna stat()
+    per file) soltanto se l'mtime della cartella e' cambiato, cioe' se sono
+    stati aggiunti, rinominati o tolti file; ogni RISCANSIONE_OGNI secondi
+    la scansione viene comunque ripetuta (share che non aggiornano l'mtime).
+    I nomi nuovi vengono analizzati una volta sola con `analizza`.
+    """
+
+    def __init__(self, cartella: str, analizza: Callable[[str], tuple],
+                 estensione: str = ".pdf", percorso_db: str = MANIFEST_PATH):
+        """`analizza(nome)` -> (numero, data_iso, piva), None dove mancano."""
+        self.cartella = cartella
+        self.analizza = analizza
+        self.estensione = estensione.lower()
+        self._lock = threading.Lock()
+        self._conn = _apri_db(percorso_db)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS indice_cartella (
+                cartella   TEXT NOT NULL,
+                nome       TEXT NOT NULL,
+                numero     TEXT,
+                data_iso   TEXT,
+                piva       TEXT,
+                visto_il   TEXT,
+                PRIMARY KEY (cartella, nome)
+            )
+        """)
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS indice_cartella_data ON indice_cartella (cartella, data_iso)"
+        )
+        _crea_cartelle_scansionate(self._conn)
+        self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT count(*) FROM indice_cartella WHERE cartella = ?", (self.cartella,)
+            ).fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def aggiorna(self, forza: bool = False) -> tuple[int, int] | None:
+        """Allinea l'indice alla cartella. Ritorna (aggiunti, tolti), oppure
+        None se la cartella non e' cambiata e la scansione e' stata saltata."""
+        mtime = os.stat(self.cartella).st_mtime
+        with self._lock:
+            if not forza and _scansione_superflua(self._conn, self.cartella, mtime):
+                return None
+
+        with os.scandir(self.cartella) as it:
+            presenti = {e.name for e in it if e.name.lower().endswith(self.estensione)}
+
+        adesso = datetime.now().isoformat(timespec="seconds")
+        with self._lock:
+            noti = {r[0] for r in self._conn.execute(
+                "SELECT nome FROM indice_cartella WHERE cartella = ?", (self.cartella,)
+            )}
+            nuovi = presenti - noti
+            tolti = noti - presenti
+            self._conn.executemany(
+                """INSERT INTO indice_cartella (cartella, nome, numero, data_iso, piva, visto_il)
+                   VALUES (?, ?, ?, ?, ?, ?)""",
+                [(self.cartella, nome, *self.analizza(nome), adesso) for nome in sorted(nuovi)],
+            )
+            self._conn.executemany(
+                "DELETE FROM indice_cartella WHERE cartella = ? AND nome = ?",
+                [(self.cartella, nome) for nome in tolti],
+            )
+            _segna_scansionata(self._conn, self.cartella, mtime)
+            self._conn.commit()
+        return len(nuovi), len(tolti)
+
+    def dal(self, data_iso: str) -> list[tuple[str, str, str, str | None]]:
+        """File con data nel nome successiva a `data_iso` (esclusa), ordinati
+        per nome: [(nome, numero, data_iso, piva)]. I file senza data non
+        vengono mai selezionati."""
+        with self._lock:
+            return self._conn.execute(
+                """SELECT nome, numero, data_iso, piva FROM indice_cartella
+                   WHERE cartella = ? AND data_iso > ? ORDER BY nome""",
+                (self.cartella, data_iso),
+            ).fetchall()
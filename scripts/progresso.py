@@ -0,0 +1,153 @@
+"""
+progresso.py
+============
+Avanzamento degli script di importazione, letto da sync_agent mentre lo step
+e' ancora in corso (prima si vedeva solo il risultato finale).
+
+Lo script aggiorna un oggetto Progresso (file scansionati, da elaborare,
+elaborati, abbinati, errori); ogni `intervallo` secondi al massimo l'istantanea
+viene passata alla callback:
+  - in-process sync_agent passa una callback che la scrive su sync_tasks,
+  - da riga di comando con --json viene stampata su stdout dopo il marker
+    ###PROGRESS### (sync_agent in modalita' subprocess legge lo stdout riga
+    per riga).
+
+Annullamento: sync_agent in-process non puo' interrompere il thread di uno
+step andato in timeout, quindi chiama annulla() e alla successiva chiamata
+di fase/avanza/battito/controlla lo script riceve StepAnnullato. E' una
+BaseException: gli `except Exception` degli script non la fermano e lo step
+termina davvero invece di continuare in background.
+
+Uso:
+    progresso = progresso or Progresso.da_cli()
+    progresso.fase("elaborazione", totale=len(files), scansionati=len(tutti))
+    for f in files:
+        ...
+        progresso.avanza(abbinati=stats["matchati"], errori=stats["errori"])
+    progresso.fine()
+"""
+
+import json
+import sys
+import threading
+import time
+from typing import Callable
+
+MARKER = "###PROGRESS###"
+
+
+class StepAnnullato(BaseException):
+    """Sollevata dentro lo script quando sync_agent ha annullato lo step."""
+
+
+class Progresso:
+
+    def __init__(self, callback: Callable[[dict], None] | None = None, intervallo: float = 2.0):
+        self.callback = callback
+        self.intervallo = intervallo
+        self._lock = threading.Lock()
+        self._inizio = time.time()
+        self._ultimo_invio = 0.0
+        self._fase = None
+        self._inizio_fase = self._inizio
+        self._contatori = {"scansionati": 0, "totale": None, "elaborati": 0, "abbinati": 0, "errori": 0}
+        self._annullato: str | None = None
+
+    @classmethod
+    def da_cli(cls) -> "Progresso":
+        """Con --json stampa l'avanzamento su stdout, altrimenti non emette nulla."""
+        return cls(stampa_progresso if "--json" in sys.argv else None)
+
+    # ─── ANNULLAMENTO ─────────────────────────────────────────────────────────
+
+    def annulla(self, motivo: str = "Step annullato"):
+        """Chiesto da sync_agent (altro thread): lo script si ferma al
+        prossimo aggiornamento."""
+        self._annullato = motivo
+
+    def controlla(self):
+        """Solleva StepAnnullato se lo step e' stato annullato."""
+        if self._annullato is not None:
+            raise StepAnnullato(self._annullato)
+
+    # ─── AGGIORNAMENTO ────────────────────────────────────────────────────────
+
+    def fase(self, nome: str, totale: int | None = None, **contatori):
+        """Inizia una fase (es. "scansione", "elaborazione"): velocita' ed ETA
+        sono calcolate dall'inizio della fase. Emette subito."""
+        self.controlla()
+        with self._lock:
+            self._fase = nome
+            self._inizio_fase = time.time()
+            self._contatori["totale"] = totale
+            self._contatori["elaborati"] = 0
+            self._contatori.update(contatori)
+        self._emetti(forza=True)
+
+    def avanza(self, n: int = 1, **contatori):
+        """Aggiunge `n` elementi elaborati e imposta i contatori passati
+        (valori assoluti, es. abbinati=stats["matchati"])."""
+        self.controlla()
+        with self._lock:
+            self._contatori["elaborati"] += n
+            self._contatori.update(contatori)
+        self._emetti()
+
+    def battito(self):
+        """Segnale di vita durante un'operazione lunga che non completa
+        elementi (blocco di un upload, passo di un batch): sync_agent conta
+        lo stallo dall'ultima istantanea ricevuta. Limitato da `intervallo`."""
+        self.controlla()
+        self._emetti()
+
+    def fine(self, **contatori):
+        with self._lock:
+            self._contatori.update(contatori)
+            self._fase = "completato"
+        self._emetti(forza=True)
+
+    # ─── LETTURA ──────────────────────────────────────────────────────────────
+
+    def istantanea(self) -> dict:
+        with self._lock:
+            adesso = time.time()
+            c = dict(self._contatori)
+            durata_fase = max(adesso - self._inizio_fase, 1e-6)
+            velocita = c["elaborati"] / durata_fase if c["elaborati"] else 0.0
+            eta = None
+            if c["totale"] is not None and velocita > 0:
+                eta = max(c["totale"] - c["elaborati"], 0) / velocita
+            return {
+                "fase": self._fase,
+                **c,
+                "velocita": round(velocita, 2),              # elementi/s nella fase corrente
+                "eta_s": round(eta) if eta is not None else None,
+                "trascorso_s": round(adesso - self._inizio),
+            }
+
+    def _emetti(self, forza: bool = False):
+        if self.callback is None:
+            return
+        adesso = time.time()
+        with self._lock:
+            if not forza and adesso - self._ultimo_invio < self.intervallo:
+                return
+            self._ultimo_invio = adesso
+        try:
+            self.callback(self.istantanea())
+        except Exception:
+            pass  # l'avanzamento non deve mai far fallire l'import
+
+
+def stampa_progresso(istantanea: dict):
+    print(f"{MARKER}{json.dumps(istantanea)}", flush=True)
+
+
+def leggi_progresso(riga: str) -> dict | None:
+    """Istantanea da una riga di stdout, None se la riga non e' un avanzamento."""
+    if not riga.startswith(MARKER):
+        return None
+    try:
+        return json.loads(riga[len(MARKER):])
+    except ValueError:
+        return None
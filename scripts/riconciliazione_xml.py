@@ -2,12 +2,23 @@ import os
 import re
 import sys
 import json
-import xml.etree.ElementTree as ET
+import queue
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta
 import calendar
 from dotenv import load_dotenv
 from supabase import create_client, Client
 
+from fattura_pa import ddt_per_linea, leggi_fattura
+from supabase_utils import a_blocchi, scorri_tabella
+from progresso import Progresso, StepAnnullato
+import manifest_archivio
+from manifest_archivio import ManifestArchivio
+
 # ================= CONFIGURAZIONE =================
 # Carichiamo le chiavi dal file .env.local per sicurezza
 load_dotenv(dotenv_path="../.env.local")
@@ -24,60 +35,9 @@ def safe_print(msg):
     except UnicodeEncodeError:
         print(msg.encode('ascii', 'replace').decode())
 
-try:
-    supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-except Exception as e:
-    safe_print(f"[ERR] Errore connessione Supabase: {e}")
-    exit()
-
-def pulisci_namespace(xml_content):
-    xml_content = re.sub(r'\sxmlns="[^"]+"', '', xml_content, count=1)
-    xml_content = re.sub(r'(<\/?)[a-zA-Z0-9]+:', r'\1', xml_content)
-    return xml_content
-
-def estrai_ddt_da_descrizione(descrizione):
-    if not descrizione: return None
-    match = re.search(r'(?:DDT|DOT|Doc|Bolla|Rif)\.?\s*(?:n\.?|nr\.?|n\s)?\s*0*(\d+)', descrizione, re.IGNORECASE)
-    if match: return match.group(1)
-    return None
-
-
-def assegna_ddt_da_header_descrizioni(dettaglio_linee, ddt_globali):
-    """
-    Quando i DatiDDT non hanno RiferimentoNumeroLinea, le righe nell'XML
-    spesso contengono header con prezzo 0 tipo 'DOT 13176 del 01-12-2025'.
-    Le righe successive con prezzo > 0 appartengono a quel DDT.
-    Ritorna dict {numero_linea: ddt_singolo}.
-    """
-    ddt_per_linea = {}
-    current_ddt = None
-
-    for linea in dettaglio_linee:
-        num_linea_tag = linea.find("NumeroLinea")
-        desc_tag = linea.find("Descrizione")
-        prezzo_tag = linea.find("PrezzoTotale")
-
-        if num_linea_tag is None:
-            continue
-
-        num_linea = num_linea_tag.text
-        desc = desc_tag.text if desc_tag is not None else ""
-        prezzo = float(prezzo_tag.text) if prezzo_tag is not None else 0.0
-
-        header_ddt = estrai_ddt_da_descrizione(desc)
-        if header_ddt and prezzo == 0.0:
-            current_ddt = header_ddt
-            ddt_per_linea[num_linea] = current_ddt
-        elif current_ddt:
-            ddt_per_linea[num_linea] = current_ddt
-
-    if len(ddt_per_linea) > 0:
-        righe_con_ddt = sum(1 for v in ddt_per_linea.values() if v)
-        ddt_unici = set(ddt_per_linea.values())
-        if righe_con_ddt > 0 and len(ddt_unici) > 1:
-            return ddt_per_linea
-
-    return {}
+# Client Supabase: creato alla prima esecuzione (o passato da sync_agent,
+# che lo tiene aperto tra un task e l'altro), non all'import del modulo.
+supabase: Client | None = None
 
 def calcola_data_scadenza(data_emissione_str, condizioni):
     """Calcola la scadenza basata su stringhe tipo '30gg DFFM' o '60gg'"""
@@ -98,9 +58,248 @@ def calcola_data_scadenza(data_emissione_str, condizioni):
     except:
         return (datetime.now() + timedelta(days=30)).strftime("%Y-%m-%d")
 
+class IndiceScadenze:
+    """Scadenze senza fattura_fornitore_id pre-caricate in memoria (1 fetch paginata
+    invece di 2 query per ogni rata). Stessa strategia di _cerca_scadenza_esistente:
+      1) (soggetto_id, fattura_riferimento) esatto
+      2) stesso soggetto + stesso importo + data_emissione entro +-15 giorni
+    Le scadenze trovate vengono "consumate": non possono essere collegate due volte."""
+
+    TOLLERANZA_GIORNI = 15
+
+    def __init__(self):
+        self._per_numero = defaultdict(list)    # (soggetto_id, fattura_riferimento) -> [scadenza]
+        self._per_importo = defaultdict(list)   # (soggetto_id, importo) -> [scadenza] ordinate per data
+        self._consumate = set()
+        self._ids = set()
+        self._totale = 0
+        self._lock = threading.Lock()
+        self.watermark = None                   # created_at piu' recente caricato
+
+    def __len__(self):
+        return self._totale - len(self._consumate)
+
+    @staticmethod
+    def _chiave_importo(importo):
+        return round(float(importo or 0), 2)
+
+    def aggiungi(self, sc):
+        if sc.get("created_at") and (self.watermark is None or sc["created_at"] > self.watermark):
+            self.watermark = sc["created_at"]
+        if not sc.get("soggetto_id") or sc["id"] in self._ids:
+            return
+        self._ids.add(sc["id"])
+        self._totale += 1
+        if sc.get("fattura_riferimento"):
+            self._per_numero[(sc["soggetto_id"], sc["fattura_riferimento"])].append(sc)
+        if sc.get("data_emissione"):
+            self._per_importo[(sc["soggetto_id"], self._chiave_importo(sc.get("importo_totale")))].append(sc)
+
+    def prepara(self):
+        """Ordina le liste per data (da chiamare dopo il caricamento)."""
+        for lista in self._per_importo.values():
+            lista.sort(key=lambda s: s["data_emissione"])
+
+    def cerca_e_consuma(self, soggetto_id, numero_fattura, importo, data_fattura):
+        with self._lock:
+            for sc in self._per_numero.get((soggetto_id, numero_fattura), []):
+                if sc["id"] not in self._consumate:
+                    self._consumate.add(sc["id"])
+                    return sc
+
+            try:
+                data_base = datetime.strptime(data_fattura, "%Y-%m-%d")
+            except (TypeError, ValueError):
+                return None
+            data_min = (data_base - timedelta(days=self.TOLLERANZA_GIORNI)).strftime("%Y-%m-%d")
+            data_max = (data_base + timedelta(days=self.TOLLERANZA_GIORNI)).strftime("%Y-%m-%d")
+            # A parita' di importo vince la data_emissione piu' vicina a quella della fattura
+            vicine = [
+                sc for sc in self._per_importo.get((soggetto_id, self._chiave_importo(importo)), [])
+                if data_min <= sc["data_emissione"][:10] <= data_max and sc["id"] not in self._consumate
+            ]
+            if not vicine:
+                return None
+            best = min(vicine, key=lambda sc: abs((datetime.strptime(sc["data_emissione"][:10], "%Y-%m-%d") - data_base).days))
+            self._consumate.add(best["id"])
+            return best
+
+
+def _senza_fattura(q):
+    return q.is_("fattura_fornitore_id", "null")
+
+
+def _creati_dopo(dopo):
+    """Filtro scadenze/movimenti senza fattura, opzionalmente solo creati dopo `dopo`."""
+    if dopo is None:
+        return _senza_fattura
+    return lambda q: _senza_fattura(q).gt("created_at", dopo)
+
+
+def _carica_indice_scadenze(indice=None, dopo=None):
+    """Pre-carica tutte le scadenze senza fattura_fornitore_id (paginato).
+    Con `indice` e `dopo` (created_at) aggiunge all'indice esistente solo le
+    scadenze create dopo quell'istante (aggiornamento incrementale)."""
+    indice = indice if indice is not None else IndiceScadenze()
+    for r in scorri_tabella(supabase, "scadenze_pagamento",
+                            "id, file_url, soggetto_id, fattura_riferimento, importo_totale, data_emissione, created_at",
+                            filtri=_creati_dopo(dopo)):
+        indice.aggiungi(r)
+    indice.prepara()
+    return indice
+
+
+def normalizza_ddt(numero):
+    """Normalizza un numero DDT per il confronto: senza separatori e zeri iniziali."""
+    if not numero:
+        return ""
+    n = re.sub(r"[\s/\\\-._]", "", str(numero)).upper()
+    return n.lstrip("0") or n
+
+
+def normalizza_fornitore(nome):
+    """Nome fornitore in maiuscolo, solo lettere/cifre separate da spazio."""
+    return " ".join(re.sub(r"[^A-Z0-9]", " ", (nome or "").upper()).split())
+
+
+# Parole che non identificano il fornitore (forme societarie, "F.LLI" -> "F LLI")
+PAROLE_GENERICHE = {"LLI", "FLLI", "FRATELLI", "DITTA", "SOC", "SOCIETA", "COOP",
+                    "SRL", "SRLS", "SNC", "SAS", "SPA", "SCARL", "STUDIO"}
+
+
+def token_fornitore(nome_norm):
+    """Prima parola significativa del nome normalizzato (almeno 3 caratteri,
+    non generica): "D ANGELO COSTRUZIONI SRL" -> "ANGELO", "F LLI ROSSI" ->
+    "ROSSI". None se non ce n'e' (es. "C M B")."""
+    for parola in nome_norm.split():
+        if len(parola) >= 3 and parola not in PAROLE_GENERICHE:
+            return parola
+    return None
+
+
+class IndiceMovimentiDDT:
+    """Movimenti (DDT) ancora senza fattura_fornitore_id pre-caricati in memoria,
+    indicizzati per numero_documento normalizzato con il fornitore normalizzato.
+    Sostituisce la query ilike('%token%') per ogni DDT di ogni fattura.
+    Se per un DDT ci sono piu' movimenti compatibili non si collega nulla e
+    il caso viene riportato in `ambigui` (prima si prendeva limit(1) a caso)."""
+
+    def __init__(self):
+        self._per_numero = defaultdict(list)   # numero normalizzato -> [(id, fornitore_norm, numero_documento, parole)]
+        self._consumati = set()
+        self._ids = set()
+        self._lock = threading.Lock()
+        self.ambigui = []
+        self.watermark = None                  # created_at piu' recente caricato
+
+    def __len__(self):
+        return sum(len(v) for v in self._per_numero.values()) - len(self._consumati)
+
+    def aggiungi(self, mov):
+        if mov.get("created_at") and (self.watermark is None or mov["created_at"] > self.watermark):
+            self.watermark = mov["created_at"]
+        num = normalizza_ddt(mov.get("numero_documento"))
+        if num and mov["id"] not in self._ids:
+            self._ids.add(mov["id"])
+            fornitore = normalizza_fornitore(mov.get("fornitore"))
+            self._per_numero[num].append((mov["id"], fornitore, mov.get("numero_documento"),
+                                          frozenset(fornitore.split())))
+
+    @staticmethod
+    def _stesso_fornitore(nome_norm, token, candidato):
+        """Il fornitore del movimento contiene `token` come parola intera; senza
+        token significativo deve coincidere il nome intero (spazi esclusi)."""
+        if not nome_norm:
+            return True
+        if token:
+            return token in candidato[3]
+        return nome_norm.replace(" ", "") == candidato[1].replace(" ", "")
+
+    def cerca_e_consuma(self, ddt_num, ragione_sociale, rif_fattura):
+        """Ritorna l'id del movimento da collegare, oppure None (nessuno o ambiguo)."""
+        nome_norm = normalizza_fornitore(ragione_sociale)
+        token = token_fornitore(nome_norm)
+        with self._lock:
+            candidati = [
+                c for c in self._per_numero.get(normalizza_ddt(ddt_num), [])
+                if c[0] not in self._consumati and self._stesso_fornitore(nome_norm, token, c)
+            ]
+            if len(candidati) == 1:
+                self._consumati.add(candidati[0][0])
+                return candidati[0][0]
+            if len(candidati) > 1:
+                self.ambigui.append(
+                    f"  - DDT {ddt_num} (fattura {rif_fattura}, {ragione_sociale}) -> "
+                    f"{len(candidati)} movimenti: " + ", ".join(f"{c[0]} [{c[2]}]" for c in candidati)
+                )
+            return None
+
+
+def _carica_indice_movimenti(indice=None, dopo=None):
+    """Pre-carica i movimenti senza fattura_fornitore_id (paginato).
+    Con `indice` e `dopo` aggiunge solo i movimenti creati dopo (incrementale)."""
+    indice = indice if indice is not None else IndiceMovimentiDDT()
+    for r in scorri_tabella(supabase, "movimenti", "id, numero_documento, fornitore, created_at",
+                            filtri=_creati_dopo(dopo)):
+        indice.aggiungi(r)
+    return indice
+
+
+class CacheIndici:
+    """
+    Indici scadenze/movimenti tenuti in memoria tra un run e l'altro quando lo
+    script gira dentro sync_agent (esegui(cache=True)).
+
+    Ogni run scarica solo le righe senza fattura create dopo l'ultimo
+    created_at visto (meno SOVRAPPOSIZIONE, per le transazioni che hanno
+    fatto commit in ritardo); le righe gia' in indice vengono scartate per id.
+    Le righe collegate o cancellate da altri nel frattempo restano in indice
+    ma il collegamento e' condizionato a fattura_fornitore_id ancora null, quindi
+    non vengono sovrascritte. Per il resto (importi o soggetti modificati)
+    ogni RICARICA_COMPLETA_OGNI secondi gli indici vengono ricostruiti da zero.
+    """
+
+    RICARICA_COMPLETA_OGNI = 6 * 3600
+    SOVRAPPOSIZIONE = timedelta(minutes=5)
+
+    def __init__(self):
+        self.scadenze: IndiceScadenze | None = None
+        self.movimenti: IndiceMovimentiDDT | None = None
+        self.caricata_il = 0.0
+
+    def _dopo(self, watermark):
+        if watermark is None:
+            return None
+        try:
+            return (datetime.fromisoformat(watermark) - self.SOVRAPPOSIZIONE).isoformat()
+        except ValueError:
+            return watermark
+
+    def aggiorna(self, completa=False):
+        """Aggiorna gli indici; ricarica tutto se richiesto, se mancano o se
+        l'ultima ricarica completa e' piu' vecchia di RICARICA_COMPLETA_OGNI."""
+        scaduta = time.time() - self.caricata_il > self.RICARICA_COMPLETA_OGNI
+        if completa or scaduta or self.scadenze is None or self.movimenti is None:
+            self.scadenze = _carica_indice_scadenze()
+            self.movimenti = _carica_indice_movimenti()
+            self.caricata_il = time.time()
+            safe_print(f"   Cache indici: ricarica completa ({len(self.scadenze)} scadenze, {len(self.movimenti)} movimenti)")
+            return
+        n_sc, n_mov = self.scadenze._totale, len(self.movimenti._ids)
+        _carica_indice_scadenze(self.scadenze, self._dopo(self.scadenze.watermark))
+        _carica_indice_movimenti(self.movimenti, self._dopo(self.movimenti.watermark))
+        self.movimenti.ambigui = []
+        safe_print(f"   Cache indici: +{self.scadenze._totale - n_sc} scadenze, "
+                   f"+{len(self.movimenti._ids) - n_mov} movimenti dall'ultimo run")
+
+
 def _cerca_scadenza_esistente(soggetto_id, numero_fattura, importo, data_fattura):
     """Cerca una scadenza creata da WhatsApp (senza fattura_fornitore_id) che corrisponde.
-    Strategia: 1) numero fattura esatto, 2) importo + data approssimata."""
+    Strategia: 1) numero fattura esatto, 2) importo + data approssimata.
+    Se l'indice e' stato pre-caricato in run() il match avviene in memoria."""
+    if _indice_scadenze is not None:
+        return _indice_scadenze.cerca_e_consuma(soggetto_id, numero_fattura, importo, data_fattura)
+
     try:
         res = supabase.table("scadenze_pagamento") \
             .select("id, file_url") \
@@ -135,59 +334,67 @@ def _cerca_scadenza_esistente(soggetto_id, numero_fattura, importo, data_fattura
 
 
 def _collega_scadenza_esistente(scadenza_id, fattura_id):
-    """Collega una scadenza esistente (da WhatsApp) alla fattura XML."""
-    supabase.table("scadenze_pagamento") \
+    """Collega una scadenza esistente (da WhatsApp) alla fattura XML.
+    Solo se e' ancora senza fattura: False se nel frattempo e' stata collegata
+    altrove o cancellata (indice in cache non piu' aggiornato)."""
+    res = supabase.table("scadenze_pagamento") \
         .update({"fattura_fornitore_id": fattura_id, "fonte": "fattura"}) \
-        .eq("id", scadenza_id).execute()
-    _stats["scadenze_recuperate"] += 1
+        .eq("id", scadenza_id) \
+        .is_("fattura_fornitore_id", "null") \
+        .execute()
+    if not res.data:
+        return False
+    _incr("scadenze_recuperate")
+    return True
+
+
+def _collega_scadenza_trovata(soggetto_id, numero_fattura, importo, data_fattura, fattura_id, tentativi=3):
+    """Cerca una scadenza esistente e la collega; se il candidato non e' piu'
+    disponibile passa al successivo. True se ne ha collegata una."""
+    for _ in range(tentativi):
+        existing = _cerca_scadenza_esistente(soggetto_id, numero_fattura, importo, data_fattura)
+        if not existing:
+            return False
+        if _collega_scadenza_esistente(existing["id"], fattura_id):
+            return True
+    return False
 
 
-def _crea_scadenze_da_xml(percorso_file, fattura_id, soggetto_id, numero_fattura, data_fattura, importo_totale, condizioni_pag):
-    """Crea scadenze_pagamento leggendo i dettagli pagamento dall'XML.
+def _inserisci_scadenza(scadenza_data, nuove_scadenze=None):
+    if nuove_scadenze is None:
+        supabase.table("scadenze_pagamento").insert(scadenza_data).execute()
+    else:
+        nuove_scadenze.append(scadenza_data)
+
+
+def _crea_scadenze_da_xml(fattura, fattura_id, soggetto_id, numero_fattura, data_fattura, importo_totale, condizioni_pag, nuove_scadenze=None):
+    """Crea scadenze_pagamento dai DettaglioPagamento della fattura gia' analizzata.
     Se trova scadenze esistenti (da WhatsApp), le collega invece di crearne di nuove.
+    Se `nuove_scadenze` e' una lista, le righe da inserire vi vengono accodate
+    (insert multi-riga a carico del chiamante) invece di essere scritte subito.
     Ritorna il numero di scadenze create (nuove)."""
-    try:
-        with open(percorso_file, 'r', encoding='utf-8', errors='ignore') as f:
-            xml_raw = f.read()
-        xml_clean = pulisci_namespace(xml_raw)
-        root = ET.fromstring(xml_clean)
-        body = root.find(".//FatturaElettronicaBody")
-        if body is None:
-            return 0
-    except Exception as e:
-        safe_print(f"   [ERR] Errore lettura XML per scadenze: {e}")
+    body = fattura.corpo
+    if body is None:
         return 0
 
     # Recupera ragione_sociale per la descrizione
-    try:
-        header = root.find(".//FatturaElettronicaHeader")
-        anag = header.find(".//CedentePrestatore/DatiAnagrafici")
-        ragione_sociale = anag.find(".//Denominazione").text if anag.find(".//Denominazione") is not None else None
-        if not ragione_sociale:
-            n = anag.find(".//Nome").text if anag.find(".//Nome") is not None else ""
-            c = anag.find(".//Cognome").text if anag.find(".//Cognome") is not None else ""
-            ragione_sociale = f"{c} {n}".strip() or "Sconosciuto"
-    except:
-        ragione_sociale = "Sconosciuto"
+    ragione_sociale = (fattura.cedente.nominativo(cognome_prima=True) if fattura.cedente else None) or "Sconosciuto"
 
-    rate_xml = body.findall(".//DettaglioPagamento")
-    modalita_pag_xml = body.findall(".//DettaglioPagamento/ModalitaPagamento")
-    is_domiciliazione = any(mp.text in ('MP19', 'MP20') for mp in modalita_pag_xml if mp.text)
+    rate_xml = body.pagamenti
+    is_domiciliazione = any(p.modalita in ('MP19', 'MP20') for p in rate_xml if p.modalita)
     scadenze_create = 0
 
     if rate_xml:
         for i, rata in enumerate(rate_xml):
-            importo_rata = float(rata.findtext('ImportoPagamento', '0'))
-            data_scad_rata = rata.findtext('DataScadenzaPagamento')
-            modalita_rata = rata.findtext('ModalitaPagamento', '')
+            importo_rata = rata.importo or 0.0
+            data_scad_rata = rata.data_scadenza
+            modalita_rata = rata.modalita or ''
             is_domiciliazione_rata = modalita_rata in ('MP19', 'MP20') or is_domiciliazione
             if not data_scad_rata:
                 data_scad_rata = calcola_data_scadenza(data_fattura, condizioni_pag)
 
             # Anti-duplicato: cerca scadenza esistente da WhatsApp
-            existing = _cerca_scadenza_esistente(soggetto_id, numero_fattura, importo_rata, data_fattura)
-            if existing:
-                _collega_scadenza_esistente(existing["id"], fattura_id)
+            if _collega_scadenza_trovata(soggetto_id, numero_fattura, importo_rata, data_fattura, fattura_id):
                 safe_print(f"   [MATCH] Rata {i+1}/{len(rate_xml)}: scadenza esistente collegata a XML")
                 continue
 
@@ -207,15 +414,13 @@ def _crea_scadenze_da_xml(percorso_file, fattura_id, soggetto_id, numero_fattura
             }
             if is_domiciliazione_rata:
                 scadenza_data["auto_domiciliazione"] = True
-            supabase.table("scadenze_pagamento").insert(scadenza_data).execute()
+            _inserisci_scadenza(scadenza_data, nuove_scadenze)
             scadenze_create += 1
             dom_label = " [SDD]" if is_domiciliazione_rata else ""
             safe_print(f"   Rata {i+1}/{len(rate_xml)}: EUR {importo_rata} scade {data_scad_rata}{dom_label}")
     else:
         # Anti-duplicato: cerca scadenza esistente da WhatsApp
-        existing = _cerca_scadenza_esistente(soggetto_id, numero_fattura, importo_totale, data_fattura)
-        if existing:
-            _collega_scadenza_esistente(existing["id"], fattura_id)
+        if _collega_scadenza_trovata(soggetto_id, numero_fattura, importo_totale, data_fattura, fattura_id):
             safe_print(f"   [MATCH] Scadenza esistente collegata a fattura XML")
             return 0
 
@@ -236,7 +441,7 @@ def _crea_scadenze_da_xml(percorso_file, fattura_id, soggetto_id, numero_fattura
         }
         if is_domiciliazione:
             scadenza_data["auto_domiciliazione"] = True
-        supabase.table("scadenze_pagamento").insert(scadenza_data).execute()
+        _inserisci_scadenza(scadenza_data, nuove_scadenze)
         scadenze_create += 1
         dom_label = " [SDD]" if is_domiciliazione else ""
         safe_print(f"   Scadenziario: Scadenza {data_scad} generata.{dom_label}")
@@ -244,214 +449,694 @@ def _crea_scadenze_da_xml(percorso_file, fattura_id, soggetto_id, numero_fattura
     return scadenze_create
 
 
-# Contatori globali per output JSON
-_stats = {"nuove": 0, "fatture_aggiornate": 0, "scadenze_create": 0, "scadenze_recuperate": 0, "skipped": 0, "errori": 0}
+# Contatori globali per output JSON (azzerati a ogni esegui())
+_STATS_VUOTE = {"nuove": 0, "fatture_aggiornate": 0, "scadenze_create": 0, "scadenze_recuperate": 0,
+                "ddt_collegati": 0, "ddt_ambigui": 0, "skipped": 0, "errori": 0}
+_stats = dict(_STATS_VUOTE)
+_stats_lock = threading.Lock()
+
+
+def _incr(chiave, n=1):
+    """Incrementa un contatore di _stats (thread-safe in modalita' --workers)."""
+    with _stats_lock:
+        _stats[chiave] += n
 
 # Set pre-caricato di nome_file_xml gia' importati (popolato in run())
 _xml_gia_importati: set = set()
 
+# Indice anti-duplicato delle scadenze senza fattura (popolato in run())
+_indice_scadenze: IndiceScadenze | None = None
 
-def parse_and_upload(percorso_file):
-    nome_file = os.path.basename(percorso_file)
+# Indice dei movimenti DDT senza fattura (popolato in run())
+_indice_movimenti: IndiceMovimentiDDT | None = None
 
-    # Skip rapido: se il file e' gia' stato importato, non fare query
-    if nome_file in _xml_gia_importati:
-        _stats["skipped"] += 1
-        return
+# Manifest locale dei file gia' elaborati + dimensione/mtime dalla scansione (popolati in run())
+_manifest: ManifestArchivio | None = None
+_info_file: dict = {}
 
-    safe_print(f"[NEW] Nuova fattura: {nome_file}")
+# Import interrotti da completare: nome_file -> (fattura_id, ha_scadenze, ha_righe)
+_da_riprendere: dict = {}
+
+# Indici conservati tra un esegui(cache=True) e l'altro (sync_agent in-process)
+_cache: "CacheIndici | None" = None
 
+# Avanzamento letto da sync_agent (impostato in esegui())
+_progresso = Progresso()
+
+
+def _avanza(n=1):
+    """Segna `n` file come elaborati (importati, saltati, ignorati o in errore)."""
+    _progresso.avanza(n, abbinati=_stats["scadenze_recuperate"] + _stats["ddt_collegati"],
+                      errori=_stats["errori"])
+
+
+def _registra_esiti(esiti):
+    """Aggiorna il manifest: esiti = [(voce o nome_file, esito, errore)]."""
+    if _manifest is None:
+        return
+    righe = []
+    for voce, esito, errore in esiti:
+        if isinstance(voce, FatturaDaScrivere):
+            nome, sha = voce.nome_file, voce.fattura.sha256
+        else:
+            nome, sha = voce, None
+        dimensione, mtime = _info_file.get(nome, (None, None))
+        righe.append((nome, dimensione, mtime, sha, esito, errore))
     try:
-        with open(percorso_file, 'r', encoding='utf-8', errors='ignore') as f:
-            xml_raw = f.read()
-        
-        xml_clean = pulisci_namespace(xml_raw)
-        root = ET.fromstring(xml_clean)
+        _manifest.registra_molti(righe)
+    except Exception as e:
+        safe_print(f"   [WARN] Errore aggiornamento manifest: {e}")
 
-        header = root.find(".//FatturaElettronicaHeader")
-        body = root.find(".//FatturaElettronicaBody")
-        if header is None or body is None: return
 
-        # --- ESTRAZIONE DATI FORNITORE ---
-        cedente = header.find(".//CedentePrestatore")
-        anag = cedente.find(".//DatiAnagrafici")
-        
-        # Gestione Denominazione vs Nome+Cognome (Professionisti)
-        ragione_sociale = anag.find(".//Denominazione").text if anag.find(".//Denominazione") is not None else None
-        if not ragione_sociale:
-            n = anag.find(".//Nome").text if anag.find(".//Nome") is not None else ""
-            c = anag.find(".//Cognome").text if anag.find(".//Cognome") is not None else ""
-            ragione_sociale = f"{c} {n}".strip() or "Sconosciuto"
-
-        id_fiscale = anag.find(".//IdFiscaleIVA/IdCodice")
-        piva = id_fiscale.text if id_fiscale is not None else "00000000000"
-
-        # --- UPSERT ANAGRAFICA ---
-        # Recuperiamo anche condizioni_pagamento per lo scadenziario
-        res_anag = supabase.table("anagrafica_soggetti").upsert({
-            "partita_iva": piva,
-            "ragione_sociale": ragione_sociale,
-            "tipo": "fornitore"
-        }, on_conflict="partita_iva").execute()
-        
-        soggetto_id = res_anag.data[0]['id']
-        condizioni_pag = res_anag.data[0].get('condizioni_pagamento', '30gg DFFM')
-
-        # --- DATI GENERALI FATTURA ---
-        dati_gen = body.find(".//DatiGeneraliDocumento")
-        numero_fattura = dati_gen.find("Numero").text
-        data_fattura = dati_gen.find("Data").text
-        importo_tag = dati_gen.find("ImportoTotaleDocumento")
-        importo_totale = float(importo_tag.text) if importo_tag is not None else 0.0
-
-        # --- UPSERT TESTATA FATTURA (anti-duplicato WhatsApp) ---
-        # Se esiste gia' una fattura con stesso numero+PIVA creata da WhatsApp
-        # (senza nome_file_xml), la "promuoviamo" aggiungendo il file XML
-        fattura_id = None
+@dataclass
+class FatturaDaScrivere:
+    """Fattura analizzata e pronta per la scrittura (nessuna query ancora fatta)."""
+    nome_file: str
+    fattura: object
+    ragione_sociale: str
+    piva: str
+    numero_fattura: str
+    data_fattura: str
+    importo_totale: float
+    righe: list = field(default_factory=list)   # fatture_dettaglio_righe senza fattura_id
+    soggetto_id: str | None = None
+    condizioni_pag: str | None = None
+    fattura_id: str | None = None
+    # Ripresa di un import interrotto: fattura gia' in DB, si scrive solo cio' che manca
+    ha_scadenze: bool = False
+    ha_righe: bool = False
+
+
+def _prepara_fattura(fattura, nome_file):
+    """Estrae dalla fattura analizzata tutto cio' che serve per la scrittura.
+    Ritorna None se mancano cedente o body (come prima: file ignorato)."""
+    body = fattura.corpo
+    if fattura.cedente is None or body is None: return None
+
+    # --- ESTRAZIONE DATI FORNITORE ---
+    # Gestione Denominazione vs Nome+Cognome (Professionisti)
+    ragione_sociale = fattura.cedente.nominativo(cognome_prima=True) or "Sconosciuto"
+    piva = fattura.cedente.partita_iva or "00000000000"
+
+    # --- DATI GENERALI FATTURA ---
+    dati_gen = body.dati_generali
+    numero_fattura = dati_gen.numero
+    data_fattura = dati_gen.data
+    if not numero_fattura or not data_fattura:
+        raise ValueError("Numero/Data documento mancanti in DatiGeneraliDocumento")
+    importo_totale = dati_gen.importo_totale or 0.0
+
+    # --- DETTAGLIO RIGHE ---
+    righe_da_caricare = []
+    dettaglio_linee = body.linee
+    # Priorita': 1) RiferimentoNumeroLinea, 2) header-descrizione, 3) globale, 4) regex descrizione
+    ddt_righe = ddt_per_linea(body)
+
+    for linea in dettaglio_linee:
+        try:
+            num_linea = linea.numero_linea
+            if num_linea is None: continue
+            desc = linea.descrizione or ""
+            qty = linea.quantita or 0.0
+            prezzo = linea.prezzo_totale or 0.0
+            um = linea.unita_misura or ""
+
+            righe_da_caricare.append({
+                "numero_linea": int(num_linea) if num_linea.isdigit() else 0,
+                "descrizione": desc,
+                "quantita": qty,
+                "unita_misura": um,
+                "prezzo_totale": prezzo,
+                "ddt_riferimento": ddt_righe.get(num_linea)
+            })
+        except: continue
+
+    voce = FatturaDaScrivere(
+        nome_file=nome_file,
+        fattura=fattura,
+        ragione_sociale=ragione_sociale,
+        piva=piva,
+        numero_fattura=numero_fattura,
+        data_fattura=data_fattura,
+        importo_totale=importo_totale,
+        righe=righe_da_caricare,
+    )
+    ripresa = _da_riprendere.get(nome_file)
+    if ripresa:
+        voce.fattura_id, voce.ha_scadenze, voce.ha_righe = ripresa
+    return voce
+
+
+def _collega_ddt_movimenti(voce):
+    """Cerca i movimenti DDT della fattura ancora senza fattura collegata.
+    Ritorna la lista degli id movimento da collegare."""
+    ddt_numeri = set(r["ddt_riferimento"] for r in voce.righe if r.get("ddt_riferimento"))
+    mov_ids = []
+    if ddt_numeri and _indice_movimenti is not None:
+        # Match in memoria; i DDT globali sono salvati come "13176,13177"
+        singoli = {d.strip() for ddt in ddt_numeri for d in ddt.split(",") if d.strip()}
+        for ddt_num in sorted(singoli):
+            mov_id = _indice_movimenti.cerca_e_consuma(ddt_num, voce.ragione_sociale, voce.numero_fattura)
+            if mov_id:
+                mov_ids.append(mov_id)
+                safe_print(f"   [DDT-LINK] Movimento DDT {ddt_num} collegato a fattura {voce.numero_fattura}")
+    elif ddt_numeri:
+        primo_token = voce.ragione_sociale.split()[0] if voce.ragione_sociale else ""
+        for ddt_num in ddt_numeri:
+            try:
+                q = supabase.table("movimenti") \
+                    .select("id") \
+                    .eq("numero_documento", ddt_num) \
+                    .is_("fattura_fornitore_id", "null")
+                if primo_token:
+                    q = q.ilike("fornitore", f"%{primo_token}%")
+                existing_mov = q.limit(1).execute()
+                if existing_mov.data:
+                    mov_ids.append(existing_mov.data[0]["id"])
+                    safe_print(f"   [DDT-LINK] Movimento DDT {ddt_num} collegato a fattura {voce.numero_fattura}")
+            except Exception:
+                pass
+    return mov_ids
+
+
+def _inserisci_multi(tabella, righe, chiave_voce, descrizione):
+    """Insert multi-riga; se il batch fallisce ripiega su insert riga per riga
+    cosi' una sola riga sbagliata non fa perdere le altre.
+    Ritorna (righe_inserite, chiavi_voce_fallite)."""
+    if not righe:
+        return [], set()
+    try:
+        res = supabase.table(tabella).insert(righe).execute()
+        return res.data or [], set()
+    except Exception as e:
+        safe_print(f"   [WARN] Insert batch {descrizione} fallito ({e}) — ripiego riga per riga")
+    inserite, fallite = [], set()
+    for riga in righe:
         try:
-            existing_fatt = supabase.table("fatture_fornitori") \
-                .select("id") \
-                .eq("numero_fattura", numero_fattura) \
-                .eq("piva_fornitore", piva) \
-                .is_("nome_file_xml", "null") \
-                .limit(1).execute()
-            if existing_fatt.data:
-                fattura_id = existing_fatt.data[0]["id"]
+            res = supabase.table(tabella).insert(riga).execute()
+            inserite.extend(res.data or [])
+        except Exception as e:
+            fallite.add(chiave_voce(riga))
+            safe_print(f"   [ERR] Insert {descrizione} fallito: {e}")
+    return inserite, fallite
+
+
+def _scrivi_batch(voci):
+    """Scrive un gruppo di fatture con richieste multi-riga:
+    1 upsert anagrafiche, 1 select fatture WhatsApp, 1 insert fatture,
+    1 insert scadenze, 1 insert righe, 1 update movimenti per fattura."""
+    fallite = set()   # nome_file con errori (contati una sola volta)
+    _registra_esiti([(v, manifest_archivio.IN_CORSO, None) for v in voci])
+
+    def errore(nome_file, msg):
+        if nome_file not in fallite:
+            fallite.add(nome_file)
+            _incr("errori")
+        safe_print(f"   [ERR] Errore su {nome_file}: {msg}")
+
+    # --- UPSERT ANAGRAFICA (1 riga per PIVA distinta) ---
+    # Recuperiamo anche condizioni_pagamento per lo scadenziario
+    per_piva = {}
+    for v in voci:
+        per_piva[v.piva] = {"partita_iva": v.piva, "ragione_sociale": v.ragione_sociale, "tipo": "fornitore"}
+    soggetti = {}
+    try:
+        res_anag = supabase.table("anagrafica_soggetti").upsert(list(per_piva.values()), on_conflict="partita_iva").execute()
+        soggetti = {r["partita_iva"]: r for r in (res_anag.data or [])}
+    except Exception as e:
+        safe_print(f"   [WARN] Upsert anagrafiche batch fallito ({e}) — ripiego riga per riga")
+        for piva, riga in per_piva.items():
+            try:
+                res_anag = supabase.table("anagrafica_soggetti").upsert(riga, on_conflict="partita_iva").execute()
+                soggetti[piva] = res_anag.data[0]
+            except Exception:
+                pass
+    _progresso.battito()
+
+    pronte = []
+    for v in voci:
+        sogg = soggetti.get(v.piva)
+        if not sogg:
+            errore(v.nome_file, f"anagrafica non salvata per P.IVA {v.piva}")
+            continue
+        v.soggetto_id = sogg["id"]
+        v.condizioni_pag = sogg.get("condizioni_pagamento", "30gg DFFM")
+        pronte.append(v)
+    if not pronte:
+        return
+
+    # --- UPSERT TESTATA FATTURA (anti-duplicato WhatsApp) ---
+    # Se esiste gia' una fattura con stesso numero+PIVA creata da WhatsApp
+    # (senza nome_file_xml), la "promuoviamo" aggiungendo il file XML
+    whatsapp = {}
+    try:
+        res = supabase.table("fatture_fornitori") \
+            .select("id, numero_fattura, piva_fornitore") \
+            .in_("piva_fornitore", list({v.piva for v in pronte})) \
+            .in_("numero_fattura", list({v.numero_fattura for v in pronte})) \
+            .is_("nome_file_xml", "null") \
+            .execute()
+        for r in (res.data or []):
+            whatsapp.setdefault((r["numero_fattura"], r["piva_fornitore"]), r["id"])
+    except Exception:
+        pass
+
+    da_inserire = []
+    for v in pronte:
+        if v.fattura_id:
+            safe_print(f"   [RIPRESA] {v.nome_file}: fattura gia' in DB, completo scadenze/righe mancanti")
+            continue
+        fattura_id = whatsapp.pop((v.numero_fattura, v.piva), None)
+        if fattura_id:
+            try:
                 supabase.table("fatture_fornitori") \
-                    .update({"nome_file_xml": nome_file}) \
+                    .update({"nome_file_xml": v.nome_file}) \
                     .eq("id", fattura_id).execute()
-                _stats["fatture_aggiornate"] += 1
-                safe_print(f"   [LINK] Fattura esistente (da WhatsApp) collegata a XML")
+                v.fattura_id = fattura_id
+                _incr("fatture_aggiornate")
+                safe_print(f"   [LINK] Fattura esistente (da WhatsApp) collegata a XML {v.nome_file}")
+                continue
+            except Exception:
+                pass
+        da_inserire.append(v)
+
+    per_nome = {v.nome_file: v for v in da_inserire}
+    inserite, _ = _inserisci_multi("fatture_fornitori", [{
+        "ragione_sociale": v.ragione_sociale,
+        "piva_fornitore": v.piva,
+        "numero_fattura": v.numero_fattura,
+        "data_fattura": v.data_fattura,
+        "importo_totale": v.importo_totale,
+        "soggetto_id": v.soggetto_id,
+        "nome_file_xml": v.nome_file
+    } for v in da_inserire], lambda r: r["nome_file_xml"], "fatture_fornitori")
+    # FK risolte dalle righe ritornate (chiave: nome_file_xml, univoco per file)
+    for r in inserite:
+        v = per_nome.get(r.get("nome_file_xml"))
+        if v and not v.fattura_id:
+            v.fattura_id = r["id"]
+            _incr("nuove")
+    for v in da_inserire:
+        if not v.fattura_id:
+            errore(v.nome_file, "insert fattura non riuscito")
+    _progresso.battito()
+
+    scritte = [v for v in pronte if v.fattura_id]
+    per_fattura_id = {v.fattura_id: v for v in scritte}
+
+    # --- AUTO-GENERAZIONE SCADENZE (delega a funzione riutilizzabile) ---
+    nuove_scadenze = []
+    for v in scritte:
+        if v.ha_scadenze:
+            continue
+        try:
+            _crea_scadenze_da_xml(v.fattura, v.fattura_id, v.soggetto_id, v.numero_fattura, v.data_fattura,
+                                  v.importo_totale, v.condizioni_pag, nuove_scadenze)
+        except Exception as e:
+            errore(v.nome_file, e)
+    scad_inserite, scad_fallite = _inserisci_multi(
+        "scadenze_pagamento", nuove_scadenze, lambda r: r["fattura_fornitore_id"], "scadenze_pagamento")
+    _incr("scadenze_create", len(scad_inserite))
+    for fid in scad_fallite:
+        errore(per_fattura_id[fid].nome_file, "insert scadenza non riuscito")
+    _progresso.battito()
+
+    # --- DETTAGLIO RIGHE ---
+    righe = [{"fattura_id": v.fattura_id, **r} for v in scritte if not v.ha_righe for r in v.righe]
+    righe_inserite, righe_fallite = _inserisci_multi(
+        "fatture_dettaglio_righe", righe, lambda r: r["fattura_id"], "fatture_dettaglio_righe")
+    for fid in righe_fallite:
+        errore(per_fattura_id[fid].nome_file, "insert righe dettaglio non riuscito")
+    _progresso.battito()
+
+    # --- COLLEGAMENTO DDT (movimenti) A FATTURA ---
+    n_mov = 0
+    for v in scritte:
+        mov_ids = _collega_ddt_movimenti(v)
+        if not mov_ids:
+            continue
+        try:
+            res = supabase.table("movimenti") \
+                .update({"fattura_fornitore_id": v.fattura_id}) \
+                .in_("id", mov_ids) \
+                .is_("fattura_fornitore_id", "null") \
+                .execute()
+            n_mov += len(res.data or [])
         except Exception:
             pass
+        _progresso.battito()
+    _incr("ddt_collegati", n_mov)
 
-        if not fattura_id:
-            res_insert = supabase.table("fatture_fornitori").insert({
-                "ragione_sociale": ragione_sociale,
-                "piva_fornitore": piva,
-                "numero_fattura": numero_fattura,
-                "data_fattura": data_fattura,
-                "importo_totale": importo_totale,
-                "soggetto_id": soggetto_id,
-                "nome_file_xml": nome_file
-            }).execute()
-            if not res_insert.data: return
-            fattura_id = res_insert.data[0]['id']
-            _stats["nuove"] += 1
-
-        # --- AUTO-GENERAZIONE SCADENZE (delega a funzione riutilizzabile) ---
-        n = _crea_scadenze_da_xml(percorso_file, fattura_id, soggetto_id, numero_fattura, data_fattura, importo_totale, condizioni_pag)
-        _stats["scadenze_create"] += n
-
-        # --- LOGICA DDT (Mantenuta integra) ---
-        ddt_line_map = {}
-        ddt_globali = []
-        dati_ddt_list = body.findall(".//DatiDDT")
-        for ddt_block in dati_ddt_list:
-            num_ddt_tag = ddt_block.find("NumeroDDT")
-            if num_ddt_tag is not None:
-                valore_ddt = num_ddt_tag.text
-                rifs = ddt_block.findall("RiferimentoNumeroLinea")
-                if not rifs: ddt_globali.append(valore_ddt)
-                else:
-                    for r in rifs: ddt_line_map[r.text] = valore_ddt
-        
-        stringa_ddt_globali = ",".join(ddt_globali) if ddt_globali else None
+    _registra_esiti([
+        (v, manifest_archivio.ERRORE, "scrittura non completata") if v.nome_file in fallite
+        else (v, manifest_archivio.IMPORTATO, None)
+        for v in voci
+    ])
 
-        # --- DETTAGLIO RIGHE ---
-        righe_da_caricare = []
-        dettaglio_linee = body.findall(".//DettaglioLinee")
+    safe_print(f"   [BATCH] {len(scritte)} fatture, {len(scad_inserite)} scadenze, "
+               f"{len(righe_inserite)} righe dettaglio, {n_mov} DDT collegati")
+    _avanza(len(voci))
 
-        # Se i DDT sono globali (no RiferimentoNumeroLinea), prova ad assegnare
-        # ciascuna riga al DDT corretto analizzando le righe-header con prezzo 0
-        ddt_header_map = {}
-        if ddt_globali and not ddt_line_map:
-            ddt_header_map = assegna_ddt_da_header_descrizioni(dettaglio_linee, ddt_globali)
-            if ddt_header_map:
-                safe_print(f"   [DDT] Assegnazione per header-descrizione: {len(set(ddt_header_map.values()))} DDT distinti")
 
-        for linea in dettaglio_linee:
-            try:
-                num_linea = linea.find("NumeroLinea").text
-                desc = linea.find("Descrizione").text or ""
-                qty = float(linea.find("Quantita").text) if linea.find("Quantita") is not None else 0.0
-                prezzo = float(linea.find("PrezzoTotale").text) if linea.find("PrezzoTotale") is not None else 0.0
-                um = linea.find("UnitaMisura").text if linea.find("UnitaMisura") is not None else ""
-
-                # Priorita': 1) RiferimentoNumeroLinea, 2) header-descrizione, 3) globale, 4) regex descrizione
-                ddt_assegnato = ddt_line_map.get(num_linea) or ddt_header_map.get(num_linea) or stringa_ddt_globali or estrai_ddt_da_descrizione(desc)
-
-                righe_da_caricare.append({
-                    "fattura_id": fattura_id,
-                    "numero_linea": int(num_linea) if num_linea.isdigit() else 0,
-                    "descrizione": desc,
-                    "quantita": qty,
-                    "unita_misura": um,
-                    "prezzo_totale": prezzo,
-                    "ddt_riferimento": ddt_assegnato
-                })
-            except: continue
-
-        if righe_da_caricare:
-            supabase.table("fatture_dettaglio_righe").insert(righe_da_caricare).execute()
-            safe_print(f"   [OK] Caricate {len(righe_da_caricare)} righe dettaglio.")
-
-        # --- COLLEGAMENTO DDT (movimenti) A FATTURA ---
-        ddt_numeri = set(r["ddt_riferimento"] for r in righe_da_caricare if r.get("ddt_riferimento"))
-        if ddt_numeri:
-            primo_token = ragione_sociale.split()[0] if ragione_sociale else ""
-            for ddt_num in ddt_numeri:
-                try:
-                    q = supabase.table("movimenti") \
-                        .select("id") \
-                        .eq("numero_documento", ddt_num) \
-                        .is_("fattura_fornitore_id", "null")
-                    if primo_token:
-                        q = q.ilike("fornitore", f"%{primo_token}%")
-                    existing_mov = q.limit(1).execute()
-                    if existing_mov.data:
-                        supabase.table("movimenti") \
-                            .update({"fattura_fornitore_id": fattura_id}) \
-                            .eq("id", existing_mov.data[0]["id"]).execute()
-                        safe_print(f"   [DDT-LINK] Movimento DDT {ddt_num} collegato a fattura")
-                except Exception:
-                    pass
+class ScrittoreBatch:
+    """Accumula le fatture analizzate e le scrive ogni `dimensione` fatture
+    con _scrivi_batch. Una istanza per thread scrittore (non condivisa)."""
+
+    def __init__(self, dimensione=25):
+        self.dimensione = max(1, dimensione)
+        self._voci = []
+
+    def aggiungi(self, voce):
+        self._voci.append(voce)
+        if len(self._voci) >= self.dimensione:
+            self.flush()
+
+    def flush(self):
+        voci, self._voci = self._voci, []
+        if not voci:
+            return
+        try:
+            _scrivi_batch(voci)
+        except Exception as e:
+            # Errore imprevisto: conta le fatture del batch come errori senza fermare il run
+            _incr("errori", len(voci))
+            safe_print(f"   [ERR] Errore scrittura batch ({len(voci)} fatture): {e}")
+
+
+def parse_and_upload(percorso_file, fattura=None, scrittore=None):
+    """Importa una fattura XML. Se `fattura` e' gia' stata letta (pipeline
+    --workers) salta la lettura dal disco; se c'e' uno `scrittore` la fattura
+    viene accodata al batch invece di essere scritta subito."""
+    nome_file = os.path.basename(percorso_file)
+
+    # Skip rapido: se il file e' gia' stato importato, non fare query
+    if nome_file in _xml_gia_importati:
+        _incr("skipped")
+        return
+
+    safe_print(f"[NEW] Nuova fattura: {nome_file}")
 
+    try:
+        # Lettura + parsing in un solo passaggio (il file non viene piu' riletto)
+        if fattura is None:
+            fattura = leggi_fattura(percorso_file)
+        if _manifest is not None and nome_file not in _da_riprendere \
+                and _manifest.stesso_contenuto(nome_file, fattura.sha256):
+            # File solo "toccato" (mtime cambiato, contenuto identico): nulla da fare
+            _registra_esiti([(nome_file, _manifest.esito(nome_file), None)])
+            _incr("skipped")
+            _avanza()
+            return
+        voce = _prepara_fattura(fattura, nome_file)
     except Exception as e:
-        _stats["errori"] += 1
+        _incr("errori")
+        _registra_esiti([(nome_file, manifest_archivio.ERRORE, e)])
         safe_print(f"   [ERR] Errore su {nome_file}: {e}")
+        _avanza()
+        return
 
-def run():
-    global _xml_gia_importati
+    if voce is None:
+        _registra_esiti([(nome_file, manifest_archivio.IGNORATO, None)])
+        _avanza()
+        return
+    if scrittore is not None:
+        scrittore.aggiungi(voce)
+    else:
+        _scrivi_batch([voce])
+
+
+def _run_pipeline(percorsi, workers, batch=25):
+    """Modalita' --workers N a tre stadi:
+    1) pool di lettori: legge e analizza gli XML dalla share SMB,
+    2) coda limitata: passa le fatture analizzate (backpressure se il DB e' lento),
+    3) pool di scrittori: esegue le operazioni su Supabase."""
+    coda = queue.Queue(maxsize=workers * 4)
+    fine = object()
+
+    def lettore(percorso):
+        _progresso.controlla()   # step annullato: i file rimasti non vengono letti
+        try:
+            fattura = leggi_fattura(percorso)
+            coda.put((percorso, fattura, None))
+        except Exception as e:
+            coda.put((percorso, None, e))
+        _progresso.battito()   # i file contano come elaborati solo a batch scritto
+
+    def scrittore():
+        batch_locale = ScrittoreBatch(batch)
+        annullato = None
+        try:
+            while True:
+                item = coda.get()
+                if item is fine:
+                    break
+                if annullato is not None:
+                    continue   # step annullato: svuota la coda senza scrivere, i lettori non restano bloccati
+                percorso, fattura, errore = item
+                try:
+                    if errore is not None:
+                        _incr("errori")
+                        _registra_esiti([(os.path.basename(percorso), manifest_archivio.ERRORE, errore)])
+                        safe_print(f"   [ERR] Errore su {os.path.basename(percorso)}: {errore}")
+                        _avanza()
+                        continue
+                    parse_and_upload(percorso, fattura, batch_locale)
+                except StepAnnullato as e:
+                    annullato = e
+        finally:
+            if annullato is None:
+                batch_locale.flush()
+        if annullato is not None:
+            raise annullato
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="xml-write") as scrittori:
+        futures = [scrittori.submit(scrittore) for _ in range(workers)]
+        try:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="xml-read") as lettori:
+                list(lettori.map(lettore, percorsi))
+        finally:
+            for _ in futures:
+                coda.put(fine)
+        for fut in futures:
+            fut.result()
+
+
+def _arg_int(nome, default):
+    """Legge un flag intero da sys.argv (--nome N oppure --nome=N)."""
+    for i, arg in enumerate(sys.argv):
+        try:
+            if arg.startswith(nome + "="):
+                return int(arg.split("=")[1])
+            if arg == nome and i + 1 < len(sys.argv):
+                return int(sys.argv[i + 1])
+        except ValueError:
+            pass
+    return default
+
+
+def _carica_gia_importati(nomi):
+    """nome_file_xml gia' presenti in fatture_fornitori, cercati solo tra i
+    file candidati (query a blocchi) invece di scaricare tutto l'archivio."""
+    presenti = {}
+    for blocco in a_blocchi(nomi):
+        for r in scorri_tabella(supabase, "fatture_fornitori", "id, nome_file_xml",
+                                filtri=lambda q: q.in_("nome_file_xml", blocco)):
+            presenti[r["nome_file_xml"]] = r["id"]
+    return presenti
+
+
+def _verifica_incompleti(fatture):
+    """Per le fatture {nome_file: fattura_id} di import interrotti controlla se
+    scadenze e righe dettaglio sono state scritte. Ritorna
+    {nome_file: (fattura_id, ha_scadenze, ha_righe)} dei soli casi incompleti."""
+    con_scadenze, con_righe = set(), set()
+    for blocco in a_blocchi(list(fatture.values())):
+        con_scadenze.update(r["fattura_fornitore_id"] for r in scorri_tabella(
+            supabase, "scadenze_pagamento", "fattura_fornitore_id",
+            filtri=lambda q: q.in_("fattura_fornitore_id", blocco)))
+        con_righe.update(r["fattura_id"] for r in scorri_tabella(
+            supabase, "fatture_dettaglio_righe", "fattura_id",
+            filtri=lambda q: q.in_("fattura_id", blocco)))
+    return {
+        nome: (fid, fid in con_scadenze, fid in con_righe)
+        for nome, fid in fatture.items()
+        if fid not in con_scadenze or fid not in con_righe
+    }
+
+
+def _azzera_stato():
+    """Riporta contatori e indici allo stato iniziale: esegui() puo' essere
+    chiamata piu' volte nello stesso processo (sync_agent in-process)."""
+    global _stats, _xml_gia_importati, _indice_scadenze, _indice_movimenti, _manifest, _info_file, _da_riprendere, _progresso
+    _stats = dict(_STATS_VUOTE)
+    _progresso = Progresso()
+    _xml_gia_importati = set()
+    _indice_scadenze = None
+    _indice_movimenti = None
+    _manifest = None
+    _info_file = {}
+    _da_riprendere = {}
+
+
+def esegui(client: Client | None = None, workers: int = 1, batch: int = 25,
+           full: bool = False, usa_manifest: bool = True, cache: bool = False,
+           progresso: Progresso | None = None) -> dict:
+    """
+    Entry point importabile (usato da sync_agent senza subprocess).
+    `client`: client Supabase gia' aperto; se None ne crea uno da .env.local.
+    `full`: ignora il manifest in lettura e ricarica da zero gli indici;
+    `usa_manifest=False` disattiva il manifest.
+    `cache`: tiene gli indici in memoria per il run successivo (CacheIndici).
+    `progresso`: riceve l'avanzamento (file scansionati/elaborati, errori...).
+    Ritorna il dict dei contatori (con 'errore' se il run non e' partito).
+    """
+    global supabase, _manifest, _cache, _progresso
+    supabase = client or supabase or create_client(SUPABASE_URL, SUPABASE_KEY)
+    _azzera_stato()
+    if progresso is not None:
+        _progresso = progresso
+    ok = False
+    try:
+        risultato = _esegui(max(1, workers), max(1, batch), full, usa_manifest, cache)
+        ok = not risultato.get("errori")
+        return risultato
+    finally:
+        if not ok:
+            # Dopo un errore gli indici possono avere righe "consumate" ma non
+            # collegate davvero: il prossimo run riparte da un caricamento completo
+            _cache = None
+        if _manifest is not None:
+            _manifest.close()
+            _manifest = None
+
+
+def _esegui(workers, batch, full, usa_manifest, usa_cache):
+    global _xml_gia_importati, _indice_scadenze, _indice_movimenti, _manifest, _info_file, _da_riprendere, _cache
     safe_print(f"AVVIO IMPORTAZIONE E SCADENZIARIO DA: {CARTELLA_ARCHIVIO}")
+    _progresso.fase("scansione")
     if not os.path.exists(CARTELLA_ARCHIVIO):
         safe_print(f"[ERR] Cartella non trovata: {CARTELLA_ARCHIVIO}")
-        if "--json" in sys.argv:
-            print(f"###JSON_RESULT###{json.dumps({'errore': 'cartella_non_trovata', **_stats})}")
-        return
+        return {"errore": "cartella_non_trovata", **_stats}
+
+    # Manifest locale: elabora solo file nuovi/modificati/falliti
+    # (full ignora il manifest in lettura, usa_manifest=False lo disattiva del tutto)
+    if usa_manifest:
+        try:
+            _manifest = ManifestArchivio(CARTELLA_ARCHIVIO)
+        except Exception as e:
+            _manifest = None
+            safe_print(f"[WARN] Manifest locale non disponibile: {e} — scansione completa")
 
-    # Pre-carica lista XML gia' importati (1 sola query invece di 683)
+    if _manifest is not None:
+        _info_file = _manifest.scansiona(".xml", forza=full)
+        files = list(_info_file)
+        candidati = list(files) if full else _manifest.da_processare(_info_file)
+        safe_print(f"   Manifest: {len(_manifest)} file noti, {len(candidati)} nuovi/modificati/da riprendere")
+    else:
+        files = [f for f in os.listdir(CARTELLA_ARCHIVIO) if f.lower().endswith('.xml')]
+        candidati = files
+
+    # XML gia' importati: query solo sui candidati (a blocchi da 100)
     try:
-        res = supabase.table("fatture_fornitori").select("nome_file_xml").execute()
-        _xml_gia_importati = {r["nome_file_xml"] for r in (res.data or []) if r.get("nome_file_xml")}
-        safe_print(f"   {len(_xml_gia_importati)} fatture gia' importate in DB")
+        presenti = _carica_gia_importati(candidati)
     except Exception as e:
-        safe_print(f"[WARN] Errore pre-caricamento indice: {e} — procedo con check per-file")
+        # Senza indice si rischierebbe di reimportare fatture gia' presenti
+        safe_print(f"[ERR] Errore pre-caricamento indice: {e}")
+        return {"errore": "indice_non_disponibile", **_stats}
+
+    # Import interrotti in un run precedente: fattura in DB ma scadenze/righe forse mancanti
+    interrotti = {}
+    if _manifest is not None:
+        interrotti = {n: fid for n, fid in presenti.items()
+                      if _manifest.esito(n) in (manifest_archivio.IN_CORSO, manifest_archivio.ERRORE)}
+    if interrotti:
+        try:
+            _da_riprendere = _verifica_incompleti(interrotti)
+        except Exception as e:
+            safe_print(f"[WARN] Verifica import interrotti fallita: {e}")
+        if _da_riprendere:
+            safe_print(f"   {len(_da_riprendere)} import interrotti da completare")
+
+    _xml_gia_importati = {n for n in presenti if n not in _da_riprendere}
+    if _manifest is not None:
+        # Gia' in DB: conclusi (se erano interrotti, la verifica li ha trovati completi)
+        _registra_esiti([
+            (n, manifest_archivio.IMPORTATO if _manifest.esito(n) in
+                (manifest_archivio.IMPORTATO, manifest_archivio.IN_CORSO, manifest_archivio.ERRORE)
+             else manifest_archivio.GIA_PRESENTE, None)
+            for n in _xml_gia_importati
+        ])
 
-    files = [f for f in os.listdir(CARTELLA_ARCHIVIO) if f.lower().endswith('.xml')]
-    nuovi = [f for f in files if f not in _xml_gia_importati]
+    nuovi = [f for f in candidati if f not in _xml_gia_importati]
     safe_print(f"   {len(files)} XML su disco, {len(nuovi)} da processare")
+    _progresso.fase("indici", totale=len(nuovi), scansionati=len(files))
+
+    # Pre-carica scadenze senza fattura (anti-duplicato in memoria invece di 2 query per rata)
+    if nuovi and usa_cache:
+        try:
+            if _cache is None:
+                _cache = CacheIndici()
+            _cache.aggiorna(completa=full)
+            _indice_scadenze, _indice_movimenti = _cache.scadenze, _cache.movimenti
+        except Exception as e:
+            # Incrementale non riuscito (es. colonna created_at assente): cache scartata,
+            # si ricade sul caricamento completo qui sotto
+            _cache = None
+            safe_print(f"[WARN] Cache indici non aggiornabile: {e}")
+    if nuovi and _indice_scadenze is None:
+        try:
+            _indice_scadenze = _carica_indice_scadenze()
+            safe_print(f"   {len(_indice_scadenze)} scadenze senza fattura pre-caricate")
+        except Exception as e:
+            _indice_scadenze = None
+            safe_print(f"[WARN] Errore pre-caricamento scadenze: {e} — procedo con check per-rata")
+    if nuovi and _indice_movimenti is None:
+        try:
+            _indice_movimenti = _carica_indice_movimenti()
+            safe_print(f"   {len(_indice_movimenti)} movimenti DDT senza fattura pre-caricati")
+        except Exception as e:
+            _indice_movimenti = None
+            safe_print(f"[WARN] Errore pre-caricamento movimenti: {e} — procedo con check per-DDT")
 
-    for f in nuovi:
-        parse_and_upload(os.path.join(CARTELLA_ARCHIVIO, f))
-    _stats["skipped"] = len(files) - len(nuovi)
+    percorsi = [os.path.join(CARTELLA_ARCHIVIO, f) for f in nuovi]
+    _progresso.fase("elaborazione", totale=len(nuovi))
+    if workers > 1 and len(percorsi) > 1:
+        safe_print(f"   Pipeline parallela: {workers} lettori + {workers} scrittori (batch {batch})")
+        _run_pipeline(percorsi, workers, batch)
+    else:
+        scrittore = ScrittoreBatch(batch)
+        for percorso in percorsi:
+            parse_and_upload(percorso, scrittore=scrittore)
+        scrittore.flush()
+    # Si somma ai file "toccati" ma identici gia' contati durante l'elaborazione
+    _incr("skipped", len(files) - len(nuovi))
+    if _indice_movimenti is not None and _indice_movimenti.ambigui:
+        _stats["ddt_ambigui"] = len(_indice_movimenti.ambigui)
+        safe_print(f"DDT ambigui, non collegati ({len(_indice_movimenti.ambigui)}):")
+        for riga in _indice_movimenti.ambigui:
+            safe_print(riga)
     safe_print(f"ELABORAZIONE COMPLETATA.")
     safe_print(f"   Nuove fatture: {_stats['nuove']}, Fatture collegate (WhatsApp): {_stats['fatture_aggiornate']}, "
           f"Scadenze create: {_stats['scadenze_create']}, Scadenze collegate: {_stats['scadenze_recuperate']}, "
+          f"DDT collegati: {_stats['ddt_collegati']}, DDT ambigui: {_stats['ddt_ambigui']}, "
           f"Skip: {_stats['skipped']}, Errori: {_stats['errori']}")
+    _progresso.fine(errori=_stats["errori"])
+    return dict(_stats)
+
 
+def run():
+    """Uso da riga di comando (o da sync_agent in modalita' subprocess).
+    Flag: --workers N (default 1 = sequenziale), --batch N (fatture per scrittura),
+    --full, --no-manifest, --json (stampa il risultato dopo ###JSON_RESULT###)."""
+    risultato = esegui(
+        workers=_arg_int("--workers", 1),
+        batch=_arg_int("--batch", 25),
+        full="--full" in sys.argv,
+        usa_manifest="--no-manifest" not in sys.argv,
+        progresso=Progresso.da_cli(),
+    )
     if "--json" in sys.argv:
-        print(f"###JSON_RESULT###{json.dumps(_stats)}")
+        print(f"###JSON_RESULT###{json.dumps(risultato)}")
 
 if __name__ == "__main__":
     run()
\ No newline at end of file
@@ -0,0 +1,56 @@
+"""
+supabase_utils.py
+=================
+Helper condivisi dagli script per leggere tabelle grandi da Supabase.
+
+PostgREST tronca ogni select al limite max-rows del server (1000 di default):
+un `select(...).execute()` senza paginazione oltre quella soglia perde righe
+in silenzio. `scorri_tabella` pagina per chiave (keyset: order by id, id > ultimo)
+invece che per offset, quindi ogni pagina costa uguale anche a fine tabella,
+e restituisce le righe una pagina alla volta: la memoria resta limitata a una
+pagina piu' le strutture indice che il chiamante costruisce.
+
+Uso:
+    for r in scorri_tabella(supabase, "scadenze_pagamento", "id, soggetto_id",
+                            filtri=lambda q: q.is_("file_url", "null")):
+        ...
+"""
+
+from typing import Callable, Iterator
+
+PAGE_SIZE = 1000
+
+
+def scorri_tabella(client, tabella: str, colonne: str = "*",
+                   filtri: Callable | None = None,
+                   page_size: int = PAGE_SIZE, chiave: str = "id") -> Iterator[dict]:
+    """
+    Itera tutte le righe di `tabella` che rispettano `filtri`, a pagine di
+    `page_size` ordinate per `chiave` (deve essere univoca, default id).
+    `filtri` riceve la query builder e ritorna la query con i filtri applicati.
+    """
+    campi = [c.strip() for c in colonne.split(",")]
+    if colonne.strip() != "*" and chiave not in campi:
+        colonne = f"{chiave}, {colonne}"
+
+    ultimo = None
+    while True:
+        q = client.table(tabella).select(colonne)
+        if filtri is not None:
+            q = filtri(q)
+        if ultimo is not None:
+            q = q.gt(chiave, ultimo)
+        res = q.order(chiave).limit(page_size).execute()
+        rows = res.data or []
+        # Una pagina corta non basta per fermarsi: se il max-rows del server
+        # e' sotto page_size ogni pagina torna "corta". Fine solo a pagina vuota.
+        if not rows:
+            return
+        yield from rows
+        ultimo = rows[-1][chiave]
+
+
+def a_blocchi(valori: list, dimensione: int = 100) -> Iterator[list]:
+    """Spezza una lista in blocchi (per filtri in_() che finiscono nell'URL)."""
+    for i in range(0, len(valori), dimensione):
+        yield valori[i:i + dimensione]
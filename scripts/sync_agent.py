@@ -1,11 +1,43 @@
 """
 sync_agent.py — Agent locale per la pipeline di sincronizzazione dati.
 
-Gira in background sul PC dell'ufficio. Poll ogni 5s su Supabase per task
-pending, li esegue in sequenza e scrive i risultati.
+Gira in background sul PC dell'ufficio. Preleva i task pending da Supabase,
+li esegue e scrive i risultati.
+
+Ogni task esegue il grafo STEPS: anagrafiche fornitori -> importazione XML
+fornitori -> associazione PDF, e in parallelo le fatture di vendita. Ogni step
+ha timeout e tentativi propri; lo stato di ogni step viene scritto in
+sync_tasks.results appena cambia, non solo a fine task.
+
+Presa in carico atomica (RPC claim_sync_task, migrazione 20260315): piu'
+agent o piu' worker possono drenare la stessa coda senza eseguire due volte
+lo stesso task, e i task pending accumulati durante un run vengono accorpati
+in un'unica esecuzione successiva. Con --workers N (o SYNC_AGENT_WORKERS) fino
+a N task girano in parallelo; lo stesso step non gira mai due volte insieme
+nello stesso agent (lock per step).
+
+Gli step girano nel processo dell'agent: ogni script espone esegui(client, ...)
+che ritorna il dict dei risultati, e l'agent lo chiama con il suo client
+Supabase (niente avvio interprete, import e create_client a ogni task).
+Con --subprocess (o SYNC_AGENT_SUBPROCESS=1, o "isolato": True sullo step)
+si torna a lanciare lo script come processo separato e leggere
+###JSON_RESULT### dallo stdout.
+
+In-process gli step con "cache": True tengono i propri indici in memoria tra
+un task e l'altro e a ogni sync scaricano solo le righe nuove (vedi
+CacheIndici in riconciliazione_xml e import_fatture_pdf), con una ricarica
+completa periodica.
+
+Modalita' push: se in .env.local c'e' SUPABASE_DB_URL (connessione Postgres
+diretta o session pooler, NON il transaction pooler che non supporta LISTEN)
+e psycopg2 e' installato, l'agent resta in LISTEN sul canale 'sync_tasks'
+(trigger della migrazione 20260314_sync_tasks_notify.sql) e preleva i task
+appena creati, con un poll di sicurezza ogni SAFETY_POLL_INTERVAL secondi.
+Se il canale cade si torna al polling con backoff adattivo
+(POLL_INTERVAL -> POLL_MAX_INTERVAL) e si ritenta la connessione.
 
 Uso:
-  python scripts/sync_agent.py
+  python scripts/sync_agent.py [--workers N] [--subprocess]
   (oppure doppio click su run_sync_agent.bat)
 """
 
@@ -14,7 +46,14 @@ import re
 import sys
 import json
 import time
+import inspect
+import select
+import socket
+import threading
+import importlib
 import subprocess
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime, timezone
 from pathlib import Path
 from dotenv import load_dotenv
@@ -25,8 +64,14 @@ load_dotenv(ROOT / '.env.local')
 
 from supabase import create_client, Client
 
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None  # modalita' push non disponibile: solo polling
+
 SUPABASE_URL = os.getenv("NEXT_PUBLIC_SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
+SUPABASE_DB_URL = os.getenv("SUPABASE_DB_URL")
 
 if not SUPABASE_URL or not SUPABASE_KEY:
     print("❌ NEXT_PUBLIC_SUPABASE_URL e SUPABASE_SERVICE_ROLE_KEY devono essere in .env.local")
@@ -36,12 +81,61 @@ supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 
 SCRIPTS_DIR = Path(__file__).resolve().parent
 PYTHON = sys.executable  # usa lo stesso python del venv
-
+if str(SCRIPTS_DIR) not in sys.path:
+    sys.path.insert(0, str(SCRIPTS_DIR))
+
+from progresso import Progresso, leggi_progresso
+
+# Grafo degli step. module/kwargs: esecuzione in-process; script/args: modalita'
+# subprocess. dipende_da: step che devono essere terminati con successo prima
+# (se uno fallisce i dipendenti vengono saltati); i rami indipendenti girano in
+# parallelo. timeout in secondi per tentativo, tentativi = esecuzioni massime
+# in caso di errore, con attesa_retry secondi (raddoppiata a ogni tentativo).
+# stallo: secondi senza avanzamento dopo i quali lo step e' considerato bloccato
+# (conta ogni istantanea, anche i battiti emessi dentro upload e batch lunghi).
 STEPS = [
-    {"name": "riconciliazione_xml",  "script": "riconciliazione_xml.py",  "args": ["--json"], "label": "Importazione XML Fornitori"},
+    {"name": "import_anagrafiche_fornitori_xml", "module": "import_anagrafiche_fornitori_xml", "kwargs": {},
+     "script": "import_anagrafiche_fornitori_xml.py", "args": ["--json"], "label": "Anagrafiche Fornitori",
+     "dipende_da": [], "timeout": 300, "tentativi": 2, "stallo": 120},
+    {"name": "riconciliazione_xml",  "module": "riconciliazione_xml", "kwargs": {"workers": 4, "cache": True},
+     "script": "riconciliazione_xml.py",  "args": ["--json", "--workers", "4"], "label": "Importazione XML Fornitori",
+     "dipende_da": ["import_anagrafiche_fornitori_xml"], "timeout": 180, "tentativi": 2, "stallo": 120},
+    {"name": "import_fatture_pdf", "module": "import_fatture_pdf", "kwargs": {"cache": True},
+     "script": "import_fatture_pdf.py", "args": ["--json"], "label": "Associazione PDF Fatture",
+     "dipende_da": ["riconciliazione_xml"], "timeout": 300, "tentativi": 2, "stallo": 120},
+    {"name": "fatture_vendita_xml", "module": "fatture_vendita_xml", "kwargs": {},
+     "script": "fatture_vendita_xml.py", "args": ["--json"], "label": "Fatture di Vendita",
+     "dipende_da": [], "timeout": 180, "tentativi": 2, "stallo": 120},
 ]
+ATTESA_RETRY = 10  # secondi prima del secondo tentativo di uno step fallito
+INTERVALLO_PROGRESSO = 3  # secondi minimi tra due scritture di avanzamento su sync_tasks
+
+POLL_INTERVAL = 5            # secondi, primo intervallo di polling
+POLL_MAX_INTERVAL = 60       # secondi, tetto del backoff quando la coda e' vuota
+SAFETY_POLL_INTERVAL = 300   # secondi, poll di sicurezza in modalita' push
+RECONNECT_INTERVAL = 60      # secondi tra due tentativi di riaprire il canale
+NOTIFY_CHANNEL = "sync_tasks"
+
+
+def _arg_int(nome, default):
+    """Legge un flag intero da sys.argv (--nome N oppure --nome=N)."""
+    for i, arg in enumerate(sys.argv):
+        try:
+            if arg.startswith(nome + "="):
+                return int(arg.split("=")[1])
+            if arg == nome and i + 1 < len(sys.argv):
+                return int(sys.argv[i + 1])
+        except ValueError:
+            pass
+    return default
+
 
-POLL_INTERVAL = 5  # secondi
+WORKERS = max(1, _arg_int("--workers", int(os.getenv("SYNC_AGENT_WORKERS") or 1)))
+AGENT_ID = f"{socket.gethostname()}:{os.getpid()}"
+SUBPROCESS = "--subprocess" in sys.argv or os.getenv("SYNC_AGENT_SUBPROCESS") == "1"
+
+# Uno script di import non e' pensato per girare in due copie sugli stessi file
+_step_locks: dict[str, threading.Lock] = defaultdict(threading.Lock)
 
 
 def now_iso() -> str:
@@ -59,10 +153,56 @@ def parse_json_result(stdout: str) -> dict:
     return {}
 
 
-def run_step(step: dict) -> dict:
-    """Esegue uno script Python e ritorna il risultato."""
+class Sorveglianza:
+    """Ultimo avanzamento di uno step in corso: inoltra le istantanee alla
+    callback e permette di accorgersi di uno step bloccato prima del timeout."""
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.ultimo = None   # time.time() dell'ultimo avanzamento ricevuto
+
+    def ricevi(self, istantanea: dict):
+        self.ultimo = time.time()
+        if self.callback is not None:
+            self.callback(istantanea)
+
+    def motivo_stop(self, start: float, step_timeout: int, stallo: int | None) -> str | None:
+        """Messaggio d'errore se lo step va fermato (timeout o stallo), altrimenti None.
+        Lo stallo conta solo dopo il primo avanzamento: prima vale il timeout."""
+        adesso = time.time()
+        if adesso - start > step_timeout:
+            return f"Timeout ({step_timeout}s superato)"
+        if stallo and self.ultimo is not None and adesso - self.ultimo > stallo:
+            return f"Step bloccato: nessun avanzamento da {stallo}s"
+        return None
+
+
+def run_step(step: dict, on_progresso=None) -> dict:
+    """Esegue uno step (in-process o come subprocess) e ritorna il risultato.
+    `on_progresso` riceve le istantanee di avanzamento emesse dallo script."""
+    step_timeout = step.get("timeout", 180)
+    isolato = SUBPROCESS or step.get("isolato") or not step.get("module")
+    lock = _step_locks[step["name"]]
+    sorveglianza = Sorveglianza(on_progresso)
+
+    # Lo stesso step di un altro task (o un tentativo andato in timeout che
+    # gira ancora in background) tiene il lock: si aspetta al massimo un timeout
+    if not lock.acquire(timeout=step_timeout):
+        return {
+            "name": step["name"],
+            "label": step["label"],
+            "status": "error",
+            "duration_ms": step_timeout * 1000,
+            "error": "Step ancora in esecuzione da un run precedente",
+        }
+
+    if not isolato:
+        # Il lock viene rilasciato dal thread dello step quando termina davvero
+        return _esegui_in_processo(step, step_timeout, lock, sorveglianza)
+
     script_path = SCRIPTS_DIR / step["script"]
     if not script_path.exists():
+        lock.release()
         return {
             "name": step["name"],
             "label": step["label"],
@@ -70,28 +210,121 @@ def run_step(step: dict) -> dict:
             "duration_ms": 0,
             "error": f"Script non trovato: {step['script']}",
         }
+    try:
+        return _esegui_subprocess(step, script_path, step_timeout, sorveglianza)
+    finally:
+        lock.release()
+
+
+def _esegui_in_processo(step: dict, step_timeout: int, lock: threading.Lock,
+                        sorveglianza: Sorveglianza) -> dict:
+    """
+    Chiama modulo.esegui(client=supabase, progresso=..., **kwargs) in un thread
+    dedicato. Stessa semantica del subprocess: dict dei risultati in "data",
+    eccezione -> status error, oltre il timeout (o senza avanzamento per
+    step["stallo"] secondi) -> status error. Un thread non si puo' interrompere
+    dall'esterno: lo step fermato viene annullato tramite il suo Progresso e
+    termina al prossimo aggiornamento di avanzamento (StepAnnullato); fino ad
+    allora tiene il lock, quindi lo stesso step non riparte prima.
+    """
+    esito: dict = {}
+    progresso = Progresso(sorveglianza.ricevi, INTERVALLO_PROGRESSO)
+
+    def target():
+        try:
+            modulo = importlib.import_module(step["module"])
+            kwargs = dict(step.get("kwargs", {}))
+            if "progresso" in inspect.signature(modulo.esegui).parameters:
+                kwargs["progresso"] = progresso
+            esito["data"] = modulo.esegui(client=supabase, **kwargs) or {}
+        except BaseException as e:
+            esito["errore"] = e
+        finally:
+            lock.release()
 
-    step_timeout = step.get("timeout", 180)
+    start = time.time()
+    t = threading.Thread(target=target, name=f"step-{step['name']}", daemon=True)
+    t.start()
+    motivo = None
+    while t.is_alive() and motivo is None:
+        t.join(1)
+        if t.is_alive():
+            motivo = sorveglianza.motivo_stop(start, step_timeout, step.get("stallo"))
+    duration_ms = int((time.time() - start) * 1000)
+
+    base = {"name": step["name"], "label": step["label"], "duration_ms": duration_ms}
+    if motivo is not None:
+        progresso.annulla(motivo)
+        return {**base, "status": "error", "error": motivo}
+    if "errore" in esito:
+        e = esito["errore"]
+        return {**base, "status": "error", "error": (str(e) or type(e).__name__)[-500:]}
+    return {**base, "status": "success", "data": esito["data"]}
+
+
+def _esegui_subprocess(step: dict, script_path: Path, step_timeout: int,
+                       sorveglianza: Sorveglianza) -> dict:
+    """Lancia lo script e ne legge lo stdout riga per riga: le righe
+    ###PROGRESS### vanno alla sorveglianza, il resto resta per ###JSON_RESULT###."""
     start = time.time()
     try:
-        result = subprocess.run(
+        proc = subprocess.Popen(
             [str(PYTHON), str(script_path)] + step["args"],
             cwd=str(SCRIPTS_DIR),
-            capture_output=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
             text=True,
-            timeout=step_timeout,
         )
+        righe_out: list[str] = []
+        righe_err: list[str] = []
+
+        def leggi_stdout():
+            for riga in proc.stdout:
+                istantanea = leggi_progresso(riga)
+                if istantanea is not None:
+                    sorveglianza.ricevi(istantanea)
+                else:
+                    righe_out.append(riga)
+
+        def leggi_stderr():
+            righe_err.extend(proc.stderr)
+
+        lettori = [threading.Thread(target=f, daemon=True) for f in (leggi_stdout, leggi_stderr)]
+        for t in lettori:
+            t.start()
+
+        motivo = None
+        while proc.poll() is None:
+            motivo = sorveglianza.motivo_stop(start, step_timeout, step.get("stallo"))
+            if motivo is not None:
+                proc.kill()
+                break
+            time.sleep(0.5)
+        proc.wait()
+        for t in lettori:
+            t.join(5)
         duration_ms = int((time.time() - start) * 1000)
-        data = parse_json_result(result.stdout)
 
-        if result.returncode != 0:
+        if motivo is not None:
+            return {
+                "name": step["name"],
+                "label": step["label"],
+                "status": "error",
+                "duration_ms": duration_ms,
+                "error": motivo,
+            }
+
+        stdout, stderr = "".join(righe_out), "".join(righe_err)
+        data = parse_json_result(stdout)
+
+        if proc.returncode != 0:
             return {
                 "name": step["name"],
                 "label": step["label"],
                 "status": "error",
                 "duration_ms": duration_ms,
                 "data": data,
-                "error": (result.stderr or result.stdout or "Exit code non zero")[-500:],
+                "error": (stderr or stdout or "Exit code non zero")[-500:],
             }
 
         return {
@@ -101,14 +334,6 @@ def run_step(step: dict) -> dict:
             "duration_ms": duration_ms,
             "data": data,
         }
-    except subprocess.TimeoutExpired:
-        return {
-            "name": step["name"],
-            "label": step["label"],
-            "status": "error",
-            "duration_ms": int((time.time() - start) * 1000),
-            "error": f"Timeout ({step_timeout}s superato)",
-        }
     except Exception as e:
         return {
             "name": step["name"],
@@ -119,24 +344,199 @@ def run_step(step: dict) -> dict:
         }
 
 
-def process_task(task: dict):
-    task_id = task["id"]
-    print(f"\n🚀 [{now_iso()}] Avvio task {task_id}")
+def claim_task() -> list[dict]:
+    """
+    Prende in carico il task pending piu' vecchio e accorpa gli altri pending.
+    Ritorna le righe prese in carico (prima il task principale), [] se la coda
+    e' vuota.
 
-    # Segna come running
-    supabase.table("sync_tasks").update({
-        "status": "running",
-        "started_at": now_iso(),
-    }).eq("id", task_id).execute()
-
-    step_results = []
+    Usa l'RPC claim_sync_task (FOR UPDATE SKIP LOCKED, migrazione 20260315);
+    se la migrazione non e' applicata ricade su un UPDATE condizionato su
+    status = 'pending': solo uno tra piu' agent/worker concorrenti lo vede
+    riuscire, gli altri passano oltre.
+    """
     try:
-        for step in STEPS:
-            print(f"  ▶ {step['label']}...")
-            res = run_step(step)
-            step_results.append(res)
-            icon = "✅" if res["status"] == "success" else "❌"
-            print(f"  {icon} {step['label']} — {res['duration_ms']}ms")
+        res = supabase.rpc("claim_sync_task", {"p_agent": AGENT_ID}).execute()
+        return res.data or []
+    except Exception as e:
+        if "claim_sync_task" not in str(e):
+            raise
+
+    res = supabase.table("sync_tasks") \
+        .select("id") \
+        .eq("status", "pending") \
+        .order("created_at") \
+        .execute()
+    ids = [r["id"] for r in res.data or []]
+    if not ids:
+        return []
+
+    running = {"status": "running", "started_at": now_iso()}
+    presi = supabase.table("sync_tasks").update(running) \
+        .eq("id", ids[0]).eq("status", "pending").execute().data or []
+    if not presi:
+        return []  # preso da un altro agent nel frattempo
+    if len(ids) > 1:
+        presi += supabase.table("sync_tasks").update(running) \
+            .in_("id", ids[1:]).eq("status", "pending").execute().data or []
+    return presi
+
+
+def verifica_grafo(steps: list[dict]):
+    """Controlla che le dipendenze esistano e che il grafo non abbia cicli."""
+    nomi = {st["name"] for st in steps}
+    for st in steps:
+        for dip in st.get("dipende_da", []):
+            if dip not in nomi:
+                raise ValueError(f"Step {st['name']}: dipendenza sconosciuta {dip}")
+    risolti: set[str] = set()
+    while len(risolti) < len(steps):
+        pronti = {st["name"] for st in steps
+                  if st["name"] not in risolti and set(st.get("dipende_da", [])) <= risolti}
+        if not pronti:
+            raise ValueError(f"Ciclo nelle dipendenze degli step: {sorted(nomi - risolti)}")
+        risolti |= pronti
+
+
+def run_step_con_retry(step: dict, on_progresso=None) -> dict:
+    """run_step ripetuto fino a step["tentativi"] volte finche' fallisce."""
+    tentativi = max(1, step.get("tentativi", 1))
+    attesa = step.get("attesa_retry", ATTESA_RETRY)
+    for n in range(1, tentativi + 1):
+        res = run_step(step, on_progresso)
+        if res["status"] == "success" or n == tentativi:
+            break
+        print(f"  ↻ {step['label']}: tentativo {n}/{tentativi} fallito ({res.get('error')}), riprovo tra {attesa}s")
+        time.sleep(attesa)
+        attesa *= 2
+    res["tentativi"] = n
+    return res
+
+
+class StatoTask:
+    """
+    Risultati degli step di un task (in ordine di STEPS) e loro scrittura su
+    sync_tasks.results. I cambi di stato vengono scritti subito, l'avanzamento
+    interno degli step al massimo ogni INTERVALLO_PROGRESSO secondi.
+    """
+
+    def __init__(self, task_ids: list[str]):
+        self.task_ids = task_ids
+        self.risultati = {st["name"]: {"name": st["name"], "label": st["label"], "status": "pending", "duration_ms": 0}
+                          for st in STEPS}
+        self._lock = threading.Lock()        # stato in memoria
+        self._scrittura = threading.Lock()   # una scrittura su sync_tasks alla volta, in ordine
+        self._ultima_scrittura = 0.0
+        self.chiuso = False
+
+    def lista(self) -> list[dict]:
+        return [self.risultati[st["name"]] for st in STEPS]
+
+    def avanzamento(self, nome: str, istantanea: dict):
+        """Callback di avanzamento di uno step (chiamata dal suo thread)."""
+        with self._lock:
+            if self.chiuso or self.risultati[nome]["status"] != "running":
+                return  # step gia' concluso (es. fermato per timeout ma ancora vivo)
+            self.risultati[nome]["progress"] = istantanea
+        self.scrivi(forza=False)
+
+    def concludi_step(self, nome: str, risultato: dict):
+        with self._lock:
+            self.risultati[nome] = risultato
+
+    def scrivi(self, forza: bool = True):
+        """Scrive su sync_tasks un'istantanea presa sotto _lock; la richiesta
+        parte fuori da _lock, cosi' una scrittura lenta non ferma gli altri
+        step. Un aggiornamento di avanzamento (forza=False) con una scrittura
+        gia' in corso viene saltato: il prossimo la recupera."""
+        if not self._scrittura.acquire(blocking=forza):
+            return
+        try:
+            with self._lock:
+                if self.chiuso:
+                    return
+                adesso = time.time()
+                if not forza and adesso - self._ultima_scrittura < INTERVALLO_PROGRESSO:
+                    return
+                self._ultima_scrittura = adesso
+                risultati = [dict(r) for r in self.lista()]
+            try:
+                supabase.table("sync_tasks").update({"results": risultati}) \
+                    .in_("id", self.task_ids).execute()
+            except Exception as e:
+                print(f"⚠️  Errore scrittura progresso: {e}")
+        finally:
+            self._scrittura.release()
+
+    def chiudi(self):
+        """Da qui in poi scrive solo process_task (stato finale): aspetta la
+        scrittura in corso, che altrimenti potrebbe arrivare dopo."""
+        with self._scrittura, self._lock:
+            self.chiuso = True
+
+
+def esegui_grafo(stato: StatoTask) -> list[dict]:
+    """
+    Esegue STEPS rispettando dipende_da: ogni step parte appena le sue
+    dipendenze sono terminate con successo, i rami indipendenti in parallelo.
+    Ogni cambio di stato (running / success / error / skipped) viene scritto
+    subito su sync_tasks.results, insieme all'avanzamento degli step in corso.
+    Ritorna i risultati nell'ordine di STEPS.
+    """
+    risultati = stato.risultati
+    da_avviare = list(STEPS)
+    in_corso = {}
+
+    with ThreadPoolExecutor(max_workers=len(STEPS), thread_name_prefix="step") as pool:
+        while da_avviare or in_corso:
+            cambiati = False
+            for st in list(da_avviare):
+                stati_dip = [risultati[d]["status"] for d in st.get("dipende_da", [])]
+                if any(s in ("error", "skipped") for s in stati_dip):
+                    falliti = [d for d in st.get("dipende_da", []) if risultati[d]["status"] != "success"]
+                    risultati[st["name"]].update(status="skipped", error=f"Dipendenza non riuscita: {', '.join(falliti)}")
+                    print(f"  ⏭ {st['label']} saltato (dipende da {', '.join(falliti)})")
+                elif all(s == "success" for s in stati_dip):
+                    print(f"  ▶ {st['label']}...")
+                    risultati[st["name"]]["status"] = "running"
+                    on_progresso = lambda ist, nome=st["name"]: stato.avanzamento(nome, ist)
+                    in_corso[pool.submit(run_step_con_retry, st, on_progresso)] = st
+                else:
+                    continue
+                da_avviare.remove(st)
+                cambiati = True
+            if cambiati:
+                stato.scrivi()
+            if not in_corso:
+                continue
+
+            finiti, _ = wait(in_corso, return_when=FIRST_COMPLETED)
+            for fut in finiti:
+                st = in_corso.pop(fut)
+                try:
+                    res = fut.result()
+                except Exception as e:
+                    res = {"name": st["name"], "label": st["label"], "status": "error",
+                           "duration_ms": 0, "error": str(e)}
+                stato.concludi_step(st["name"], res)
+                icon = "✅" if res["status"] == "success" else "❌"
+                print(f"  {icon} {st['label']} — {res['duration_ms']}ms")
+            stato.scrivi()
+
+    return stato.lista()
+
+
+def process_task(tasks: list[dict]):
+    """Esegue la pipeline per il task principale e scrive l'esito anche sugli accorpati."""
+    task_id = tasks[0]["id"]
+    task_ids = [t["id"] for t in tasks]
+    accorpati = f" (+{len(task_ids) - 1} accorpati)" if len(task_ids) > 1 else ""
+    print(f"\n🚀 [{now_iso()}] Avvio task {task_id}{accorpati}")
+
+    stato = StatoTask(task_ids)
+    try:
+        step_results = esegui_grafo(stato)
+        stato.chiudi()
 
         all_success = all(r["status"] == "success" for r in step_results)
 
@@ -144,54 +544,158 @@ def process_task(task: dict):
             "status": "completed",
             "completed_at": now_iso(),
             "results": step_results,
-        }).eq("id", task_id).execute()
+        }).in_("id", task_ids).execute()
 
         label = "COMPLETATO" if all_success else "COMPLETATO CON ERRORI"
         print(f"✅ Task {task_id} {label}")
 
     except Exception as e:
         print(f"❌ Errore fatale nel task {task_id}: {e}")
+        stato.chiudi()
+        # results resta quello scritto come progresso fino all'errore
         supabase.table("sync_tasks").update({
             "status": "error",
             "completed_at": now_iso(),
-            "results": step_results,
             "error": str(e),
-        }).eq("id", task_id).execute()
+        }).in_("id", task_ids).execute()
 
 
-def poll_once():
-    """Cerca il primo task pending e lo esegue."""
+def poll_once(pool: ThreadPoolExecutor, in_corso: set) -> bool:
+    """
+    Prende in carico task pending finche' ci sono worker liberi e li passa al
+    pool. True se ha avviato almeno un task.
+    """
+    avviato = False
     try:
-        res = supabase.table("sync_tasks") \
-            .select("id") \
-            .eq("status", "pending") \
-            .order("created_at") \
-            .limit(1) \
-            .execute()
-
-        if res.data:
-            process_task(res.data[0])
-            return True
+        while len(in_corso) < WORKERS:
+            tasks = claim_task()
+            if not tasks:
+                break
+            in_corso.add(pool.submit(process_task, tasks))
+            avviato = True
     except Exception as e:
         print(f"⚠️  Errore poll: {e}")
-    return False
+    return avviato
+
+
+class CanaleNotifiche:
+    """LISTEN Postgres su NOTIFY_CHANNEL (connessione diretta con psycopg2)."""
+
+    def __init__(self, dsn: str, canale: str = NOTIFY_CHANNEL):
+        self.dsn = dsn
+        self.canale = canale
+        self.conn = None
+
+    @property
+    def attivo(self) -> bool:
+        return self.conn is not None and not self.conn.closed
+
+    def connetti(self) -> bool:
+        try:
+            self.conn = psycopg2.connect(self.dsn)
+            self.conn.autocommit = True
+            with self.conn.cursor() as cur:
+                cur.execute(f"LISTEN {self.canale};")
+            print(f"📡 In ascolto push su '{self.canale}'")
+            return True
+        except Exception as e:
+            print(f"⚠️  Canale push non disponibile: {e}")
+            self.chiudi()
+            return False
+
+    def attendi(self, timeout: float) -> bool:
+        """Attende una notifica fino a `timeout` secondi.
+        True se e' arrivata almeno una notifica, False al timeout.
+        Solleva eccezione se la connessione cade."""
+        pronti, _, _ = select.select([self.conn], [], [], timeout)
+        arrivate = False
+        if pronti:
+            self.conn.poll()
+            arrivate = bool(self.conn.notifies)
+            self.conn.notifies.clear()
+        if not arrivate:
+            # Verifica che la connessione sia ancora viva: cadute "silenziose"
+            # del TCP, oppure socket pronto per il messaggio di chiusura del
+            # server (poll() lo consuma senza sollevare eccezione)
+            with self.conn.cursor() as cur:
+                cur.execute("SELECT 1")
+        return arrivate
+
+    def chiudi(self):
+        try:
+            if self.conn is not None:
+                self.conn.close()
+        except Exception:
+            pass
+        self.conn = None
 
 
 def main():
+    verifica_grafo(STEPS)
+    canale = None
+    if SUPABASE_DB_URL and psycopg2 is not None:
+        canale = CanaleNotifiche(SUPABASE_DB_URL)
+        canale.connetti()
+    if canale and canale.attivo:
+        modalita = "push (LISTEN/NOTIFY)"
+    elif canale:
+        modalita = f"polling {POLL_INTERVAL}-{POLL_MAX_INTERVAL}s (canale push non raggiungibile)"
+    else:
+        modalita = f"polling ogni {POLL_INTERVAL}s"
+
     print("=" * 50)
     print("  Edil CRM — Sync Agent")
     print(f"  Root: {ROOT}")
     print(f"  Python: {PYTHON}")
-    print(f"  Poll interval: {POLL_INTERVAL}s")
+    print(f"  Modalita': {modalita}")
+    print(f"  Worker: {WORKERS}")
+    print(f"  Esecuzione step: {'subprocess' if SUBPROCESS else 'in-process'}")
     print("=" * 50)
     print("In ascolto per task di sincronizzazione... (Ctrl+C per fermare)\n")
 
+    pool = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="task")
+    in_corso: set = set()
+    attesa = POLL_INTERVAL
+    ultimo_tentativo = time.time()
     while True:
         try:
-            found = poll_once()
-            if not found:
-                time.sleep(POLL_INTERVAL)
+            for f in [f for f in in_corso if f.done()]:
+                in_corso.discard(f)
+                if f.exception():
+                    print(f"⚠️  Errore worker: {f.exception()}")
+            if poll_once(pool, in_corso):
+                attesa = POLL_INTERVAL
+            if len(in_corso) >= WORKERS:
+                # Tutti i worker occupati: si riprova appena uno si libera
+                wait(in_corso, return_when=FIRST_COMPLETED)
+                continue
+
+            if canale and canale.attivo:
+                try:
+                    # Nessuna query mentre si aspetta: si riparte alla notifica
+                    # (o al poll di sicurezza, per notifiche perse)
+                    canale.attendi(SAFETY_POLL_INTERVAL)
+                except Exception as e:
+                    print(f"⚠️  Canale push interrotto: {e} — torno al polling")
+                    canale.chiudi()
+                    attesa = POLL_INTERVAL
+                    ultimo_tentativo = time.time()
+                continue
+
+            # Polling: senza canale configurato intervallo fisso (come prima);
+            # con canale caduto backoff 5s, 10s, 20s... fino a POLL_MAX_INTERVAL
+            time.sleep(attesa)
+            if not canale:
+                continue
+            attesa = min(attesa * 2, POLL_MAX_INTERVAL)
+            if time.time() - ultimo_tentativo >= RECONNECT_INTERVAL:
+                ultimo_tentativo = time.time()
+                if canale.connetti():
+                    attesa = POLL_INTERVAL
         except KeyboardInterrupt:
+            if canale:
+                canale.chiudi()
+            pool.shutdown(wait=False, cancel_futures=True)
             print("\n🛑 Agent fermato.")
             sys.exit(0)
 
@@ -0,0 +1,35 @@
+"""
+Test degli script Python (pytest dalla root del progetto):
+    python -m pytest scripts/tests
+
+Gli script si importano tra loro come moduli di primo livello
+("from fattura_pa import ..."), quindi scripts/ va nel path.
+"""
+
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+SCRIPTS_DIR = Path(__file__).resolve().parent.parent
+if str(SCRIPTS_DIR) not in sys.path:
+    sys.path.insert(0, str(SCRIPTS_DIR))
+
+
+@pytest.fixture(scope="module")
+def sync_agent():
+    # sync_agent crea il client Supabase all'import: bastano valori fittizi,
+    # i test non fanno chiamate HTTP
+    vecchi = {k: os.environ.get(k) for k in ("NEXT_PUBLIC_SUPABASE_URL", "SUPABASE_SERVICE_ROLE_KEY")}
+    os.environ["NEXT_PUBLIC_SUPABASE_URL"] = vecchi["NEXT_PUBLIC_SUPABASE_URL"] or "http://localhost:54321"
+    os.environ["SUPABASE_SERVICE_ROLE_KEY"] = vecchi["SUPABASE_SERVICE_ROLE_KEY"] or "eyJ0ZXN0.eyJ0ZXN0.test"
+    try:
+        import sync_agent
+        yield sync_agent
+    finally:
+        for k, v in vecchi.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
@@ -0,0 +1,69 @@
+import csv
+
+from abbinamento_fuzzy import (SOGLIA_AUTO, AbbinatoreFuzzy, _ultimo_gruppo, scrivi_report,
+                               similarita_numero)
+
+
+def _scadenza(id, numero, data, soggetto="S1", importo=100.0):
+    return {"id": id, "fattura_riferimento": numero, "data_emissione": data,
+            "soggetto_id": soggetto, "importo_totale": importo}
+
+
+def test_ultimo_gruppo_salta_l_anno():
+    assert _ultimo_gruppo("FR A26\\0237") == "237"
+    assert _ultimo_gruppo("5/2026") == "5"
+    assert _ultimo_gruppo("2026") == "2026"
+    assert _ultimo_gruppo("FR") is None
+
+
+def test_similarita_numero():
+    assert similarita_numero("FR-237", "fr 237") == 1.0
+    assert similarita_numero("237", "FR A26\\0237") == 0.85
+    assert similarita_numero("ABC", "XABC") == 0.75
+    assert similarita_numero("", "237") == 0.0
+    assert similarita_numero("111", "999") < 0.6
+
+
+def test_abbina_numero_parziale_e_data_vicina():
+    abbinatore = AbbinatoreFuzzy([_scadenza("1", "FR A26\\237", "2026-01-10"),
+                                  _scadenza("2", "FR A26\\500", "2026-01-10")])
+    automatici, da_revisionare = abbinatore.abbina([("f.pdf", "237", "2026-01-12", "S1")])
+    assert [(p.nome_file, p.scadenza["id"]) for p in automatici] == [("f.pdf", "1")]
+    assert automatici[0].punteggio >= SOGLIA_AUTO
+    assert da_revisionare == []
+
+
+def test_abbina_ignora_date_fuori_tolleranza_e_altri_soggetti():
+    abbinatore = AbbinatoreFuzzy([_scadenza("1", "237", "2025-10-01"),
+                                  _scadenza("2", "999", "2026-01-10", soggetto="S2")])
+    assert abbinatore.abbina([("f.pdf", "237", "2026-01-10", "S1")]) == ([], [])
+
+
+def test_abbina_passa_al_candidato_successivo_se_il_migliore_e_preso():
+    abbinatore = AbbinatoreFuzzy([_scadenza("1", "FR 237", "2026-01-10"),
+                                  _scadenza("2", "FR 237", "2026-01-14")])
+    automatici, da_revisionare = abbinatore.abbina([("a.pdf", "237", "2026-01-10", "S1"),
+                                                    ("b.pdf", "237", "2026-01-12", "S1")])
+    assert sorted((p.nome_file, p.scadenza["id"]) for p in automatici) == [("a.pdf", "1"), ("b.pdf", "2")]
+    assert da_revisionare == []
+
+
+def test_abbina_candidati_equivalenti_vanno_in_revisione():
+    abbinatore = AbbinatoreFuzzy([_scadenza("1", "FR 237", "2026-01-08"),
+                                  _scadenza("2", "FR 237", "2026-01-12")])
+    automatici, da_revisionare = abbinatore.abbina([("a.pdf", "237", "2026-01-10", "S1")])
+    assert automatici == []
+    assert [p.nome_file for p in da_revisionare] == ["a.pdf"]
+    assert da_revisionare[0].distacco == 0.0
+
+
+def test_scrivi_report(tmp_path):
+    abbinatore = AbbinatoreFuzzy([_scadenza("1", "FR 237", "2026-01-08"),
+                                  _scadenza("2", "FR 237", "2026-01-12")])
+    _, da_revisionare = abbinatore.abbina([("a.pdf", "237", "2026-01-10", "S1")])
+    percorso = tmp_path / "revisione.csv"
+    scrivi_report(str(percorso), da_revisionare)
+    with open(percorso, encoding="utf-8-sig", newline="") as f:
+        righe = list(csv.reader(f, delimiter=";"))
+    assert righe[0][0] == "file"
+    assert righe[1][:3] == ["a.pdf", "1", "FR 237"]
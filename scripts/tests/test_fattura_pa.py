@@ -0,0 +1,160 @@
+import codecs
+import xml.etree.ElementTree as ET
+
+import pytest
+
+from fattura_pa import (Corpo, DatiDDT, Linea, ddt_per_linea, decodifica_xml, estrai_ddt_da_descrizione,
+                        leggi_fattura, parse_fattura)
+
+FATTURA = """<?xml version="1.0" encoding="UTF-8"?>
+<p:FatturaElettronica versione="FPR12" xmlns:p="http://ivaservizi.agenziaentrate.gov.it/docs/xsd/fatture/v1.2">
+<FatturaElettronicaHeader>
+<CedentePrestatore><DatiAnagrafici><IdFiscaleIVA><IdPaese>IT</IdPaese><IdCodice>01234567890</IdCodice></IdFiscaleIVA>
+<Anagrafica><Denominazione>EDIL ROSSI SRL</Denominazione></Anagrafica></DatiAnagrafici>
+<Sede><Indirizzo>Via Roma 1</Indirizzo><CAP>24100</CAP><Comune>Bergamo</Comune><Provincia>BG</Provincia><Nazione>IT</Nazione></Sede></CedentePrestatore>
+<CessionarioCommittente><DatiAnagrafici><CodiceFiscale>RSSMRA80A01H501U</CodiceFiscale>
+<Anagrafica><Nome>Mario</Nome><Cognome>Rossi</Cognome></Anagrafica></DatiAnagrafici></CessionarioCommittente>
+</FatturaElettronicaHeader>
+<FatturaElettronicaBody>
+<DatiGenerali><DatiGeneraliDocumento><TipoDocumento>TD01</TipoDocumento><Divisa>EUR</Divisa><Data>2025-12-03</Data>
+<Numero>FR1</Numero><ImportoTotaleDocumento>122.00</ImportoTotaleDocumento><Causale>c1</Causale></DatiGeneraliDocumento>
+<DatiDDT><NumeroDDT>101</NumeroDDT><DataDDT>2025-12-01</DataDDT><RiferimentoNumeroLinea>1</RiferimentoNumeroLinea></DatiDDT>
+</DatiGenerali>
+<DatiBeniServizi>
+<DettaglioLinee><NumeroLinea>1</NumeroLinea><CodiceArticolo><CodiceTipo>X</CodiceTipo><CodiceValore>ABC</CodiceValore></CodiceArticolo>
+<Descrizione>Cemento</Descrizione><Quantita>2.00</Quantita><UnitaMisura>kg</UnitaMisura><PrezzoUnitario>50.00</PrezzoUnitario><PrezzoTotale>100.00</PrezzoTotale></DettaglioLinee>
+<DettaglioLinee><NumeroLinea>2</NumeroLinea><Descrizione>Trasporto</Descrizione><PrezzoUnitario>0</PrezzoUnitario><PrezzoTotale>0.00</PrezzoTotale></DettaglioLinee>
+</DatiBeniServizi>
+<DatiPagamento><CondizioniPagamento>TP02</CondizioniPagamento>
+<DettaglioPagamento><ModalitaPagamento>MP05</ModalitaPagamento><DataScadenzaPagamento>2026-01-31</DataScadenzaPagamento><ImportoPagamento>122.00</ImportoPagamento></DettaglioPagamento>
+</DatiPagamento>
+</FatturaElettronicaBody>
+</p:FatturaElettronica>
+"""
+
+
+def test_parse_fattura_estrae_soggetti_e_corpo():
+    fattura = parse_fattura(FATTURA.encode("utf-8"), "f.xml")
+
+    assert fattura.nome_file == "f.xml"
+    assert fattura.versione == "FPR12"
+    assert fattura.cedente.partita_iva == "01234567890"
+    assert fattura.cedente.nominativo() == "EDIL ROSSI SRL"
+    assert fattura.cedente.comune == "Bergamo"
+    assert fattura.cessionario.codice_fiscale == "RSSMRA80A01H501U"
+    assert fattura.cessionario.nominativo() == "Mario Rossi"
+    assert fattura.cessionario.nominativo(cognome_prima=True) == "Rossi Mario"
+
+    corpo = fattura.corpo
+    assert corpo.dati_generali.numero == "FR1"
+    assert corpo.dati_generali.data == "2025-12-03"
+    assert corpo.dati_generali.importo_totale == 122.0
+    assert corpo.dati_generali.causali == ["c1"]
+    assert [(d.numero, d.riferimenti_linea) for d in corpo.ddt] == [("101", ["1"])]
+    assert [(l.numero_linea, l.quantita, l.prezzo_totale, l.codice_articolo) for l in corpo.linee] == [
+        ("1", 2.0, 100.0, "ABC"), ("2", None, 0.0, None)]
+    assert corpo.condizioni_pagamento == "TP02"
+    assert [(p.modalita, p.data_scadenza, p.importo) for p in corpo.pagamenti] == [("MP05", "2026-01-31", 122.0)]
+
+
+def test_parse_fattura_accetta_testo_gia_decodificato():
+    testo = FATTURA.split("?>", 1)[1]
+    assert parse_fattura(testo).corpo.dati_generali.numero == "FR1"
+
+
+def test_lotto_con_piu_corpi():
+    corpo = FATTURA[FATTURA.index("<FatturaElettronicaBody>"):FATTURA.index("</p:FatturaElettronica>")]
+    lotto = FATTURA.replace("</p:FatturaElettronica>", corpo.replace("FR1", "FR2") + "</p:FatturaElettronica>")
+    fattura = parse_fattura(lotto.encode("utf-8"))
+    assert [c.dati_generali.numero for c in fattura.corpi] == ["FR1", "FR2"]
+    assert fattura.corpo.dati_generali.numero == "FR1"
+
+
+def test_xml_malformato_solleva_parse_error():
+    with pytest.raises(ET.ParseError):
+        parse_fattura(FATTURA[:-40].encode("utf-8"))
+
+
+def test_leggi_fattura_calcola_lo_sha256(tmp_path):
+    percorso = tmp_path / "f.xml"
+    percorso.write_bytes(FATTURA.encode("utf-8"))
+    fattura = leggi_fattura(str(percorso))
+    assert fattura.nome_file == "f.xml"
+    assert len(fattura.sha256) == 64
+
+
+# ─── ENCODING ─────────────────────────────────────────────────────────────────
+
+def test_decodifica_xml_riconosce_il_bom():
+    assert decodifica_xml(codecs.BOM_UTF8 + "<a>è</a>".encode("utf-8")) == ("<a>è</a>", "utf-8-sig")
+
+
+def test_decodifica_xml_usa_l_encoding_del_prologo():
+    raw = '<?xml version="1.0" encoding="windows-1252"?><a>€</a>'.encode("cp1252")
+    testo, encoding = decodifica_xml(raw)
+    assert encoding == "windows-1252"
+    assert testo.endswith("<a>€</a>")
+
+
+def test_decodifica_xml_ripiega_su_cp1252_se_il_prologo_mente():
+    raw = '<?xml version="1.0" encoding="UTF-8"?><a>città €</a>'.encode("cp1252")
+    testo, encoding = decodifica_xml(raw)
+    assert encoding == "cp1252"
+    assert "città €" in testo
+
+
+def test_leggi_fattura_con_encoding_dichiarato_sbagliato(tmp_path):
+    percorso = tmp_path / "f.xml"
+    percorso.write_bytes(FATTURA.replace("Cemento", "Cemento è").encode("cp1252"))
+    fattura = leggi_fattura(str(percorso))
+    assert fattura.corpo.linee[0].descrizione == "Cemento è"
+
+
+# ─── DDT PER RIGA ─────────────────────────────────────────────────────────────
+
+def _corpo(ddt, linee):
+    return Corpo(
+        ddt=[DatiDDT(numero=n, riferimenti_linea=rif) for n, rif in ddt],
+        linee=[Linea(numero_linea=str(i), descrizione=d, prezzo_totale=p) for i, (d, p) in enumerate(linee, 1)],
+    )
+
+
+def test_estrai_ddt_da_descrizione():
+    assert estrai_ddt_da_descrizione("DOT 13176 del 01-12-2025") == "13176"
+    assert estrai_ddt_da_descrizione("Rif. DDT n. 0045") == "45"
+    assert estrai_ddt_da_descrizione("Cemento") is None
+    assert estrai_ddt_da_descrizione(None) is None
+
+
+def test_ddt_per_linea_usa_riferimento_numero_linea():
+    corpo = _corpo([("101", ["1"]), ("102", ["2", "3"])], [("a", 1), ("b", 1), ("c", 1)])
+    assert ddt_per_linea(corpo) == {"1": "101", "2": "102", "3": "102"}
+
+
+def test_ddt_per_linea_da_righe_header():
+    corpo = _corpo([("13176", []), ("13177", [])], [
+        ("DOT 13176 del 01-12-2025", 0), ("Cemento", 10), ("DOT 13177 del 02-12-2025", 0), ("Sabbia", 5)])
+    assert ddt_per_linea(corpo) == {"1": "13176", "2": "13176", "3": "13177", "4": "13177"}
+
+
+def test_ddt_per_linea_header_con_un_solo_ddt_resta_globale():
+    corpo = _corpo([("13176", []), ("13177", [])], [("DOT 13176 del 01-12-2025", 0), ("Cemento", 10)])
+    assert ddt_per_linea(corpo) == {"1": "13176,13177", "2": "13176,13177"}
+
+
+def test_ddt_per_linea_senza_unire_i_globali():
+    corpo = _corpo([("13176", []), ("13177", [])], [("Cemento", 10), ("Bolla 13177 sabbia", 5)])
+    assert ddt_per_linea(corpo, unisci_globali=False) == {"1": None, "2": "13177"}
+    corpo = _corpo([("13176", [])], [("Cemento", 10)])
+    assert ddt_per_linea(corpo, unisci_globali=False) == {"1": "13176"}
+
+
+def test_ddt_per_linea_ripiega_sulla_descrizione():
+    corpo = _corpo([], [("Bolla 7 cemento", 10), ("Sabbia", 5)])
+    assert ddt_per_linea(corpo) == {"1": "7", "2": None}
+
+
+def test_ddt_per_linea_salta_le_righe_senza_numero():
+    corpo = _corpo([("101", [])], [("a", 1)])
+    corpo.linee.append(Linea(descrizione="senza numero"))
+    assert ddt_per_linea(corpo) == {"1": "101"}
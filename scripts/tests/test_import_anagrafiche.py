@@ -0,0 +1,51 @@
+import pytest
+
+pytest.importorskip("supabase")
+pytest.importorskip("dotenv")
+
+from import_anagrafiche_fornitori_xml import scrivi_a_blocchi  # noqa: E402
+
+
+class _Esito:
+    def __init__(self, data=None):
+        self.data = data
+
+
+class _Client:
+    """Client finto: l'RPC non esiste (migrazione non applicata), gli update si registrano."""
+
+    def __init__(self):
+        self.update = []
+
+    def rpc(self, nome, parametri):
+        cliente = self
+
+        class _Rpc:
+            def execute(self):
+                raise Exception(f"Could not find the function public.{nome}(p_righe)")
+        cliente.chiamate_rpc = getattr(cliente, "chiamate_rpc", 0) + 1
+        return _Rpc()
+
+    def table(self, nome):
+        cliente = self
+
+        class _Tabella:
+            def update(self, campi):
+                self.campi = campi
+                return self
+
+            def eq(self, colonna, valore):
+                cliente.update.append((valore, self.campi))
+                return self
+
+            def execute(self):
+                return _Esito()
+        return _Tabella()
+
+
+def test_senza_rpc_aggiorna_solo_i_campi_cambiati():
+    client = _Client()
+    righe = [{"id": "s1", "cap": "00100"}, {"id": "s2", "comune": "ROMA", "provincia": "RM"}]
+    assert scrivi_a_blocchi(client, righe, aggiorna=True) == 2
+    assert client.update == [("s1", {"cap": "00100"}), ("s2", {"comune": "ROMA", "provincia": "RM"})]
+    assert client.chiamate_rpc == 1
@@ -0,0 +1,50 @@
+import hashlib
+import os
+
+import pytest
+
+httpx = pytest.importorskip("httpx")
+pytest.importorskip("supabase")
+pytest.importorskip("dotenv")
+
+import import_fatture_pdf  # noqa: E402
+
+
+@pytest.fixture
+def storage(monkeypatch):
+    """Endpoint TUS finto: il terzo PATCH viene ricevuto ma la risposta si perde."""
+    stato = {"ricevuti": b"", "patch": 0}
+
+    def gestisci(richiesta):
+        if richiesta.method == "POST":
+            return httpx.Response(201, headers={"Location": "/storage/v1/upload/resumable/1"})
+        if richiesta.method == "HEAD":
+            return httpx.Response(200, headers={"Upload-Offset": str(len(stato["ricevuti"]))})
+        assert int(richiesta.headers["Upload-Offset"]) == len(stato["ricevuti"])
+        stato["ricevuti"] += richiesta.read()
+        stato["patch"] += 1
+        if stato["patch"] == 3:
+            raise httpx.ConnectError("risposta persa")
+        return httpx.Response(204, headers={"Upload-Offset": str(len(stato["ricevuti"]))})
+
+    client = httpx.Client
+    monkeypatch.setattr(import_fatture_pdf.httpx, "Client",
+                        lambda **kw: client(transport=httpx.MockTransport(gestisci), **kw))
+    monkeypatch.setattr(import_fatture_pdf, "STREAM_BLOCCO", 10)
+    monkeypatch.setattr(import_fatture_pdf, "SUPABASE_URL", "http://storage.test")
+    monkeypatch.setattr(import_fatture_pdf, "SUPABASE_KEY", "chiave")
+    return stato
+
+
+def test_upload_resumable_calcola_l_hash_dai_blocchi_anche_dopo_una_ripresa(tmp_path, storage):
+    contenuto = os.urandom(95)
+    percorso = tmp_path / "f.pdf"
+    percorso.write_bytes(contenuto)
+    sessione = {}
+    with pytest.raises(httpx.ConnectError):
+        import_fatture_pdf.upload_resumable(str(percorso), "2026/f.pdf", len(contenuto), sessione,
+                                            calcola_hash=True)
+    import_fatture_pdf.upload_resumable(str(percorso), "2026/f.pdf", len(contenuto), sessione,
+                                        calcola_hash=True)
+    assert storage["ricevuti"] == contenuto
+    assert sessione["hash"].hexdigest() == hashlib.sha256(contenuto).hexdigest()
@@ -0,0 +1,51 @@
+import pytest
+
+pytest.importorskip("supabase")
+pytest.importorskip("dotenv")
+
+from riconciliazione_xml import IndiceMovimentiDDT, normalizza_ddt, token_fornitore  # noqa: E402
+
+
+def _indice(*movimenti):
+    indice = IndiceMovimentiDDT()
+    for id, numero, fornitore in movimenti:
+        indice.aggiungi({"id": id, "numero_documento": numero, "fornitore": fornitore})
+    return indice
+
+
+def test_normalizza_ddt():
+    assert normalizza_ddt("DDT/0045") == "DDT0045"
+    assert normalizza_ddt("0045") == "45"
+    assert normalizza_ddt(None) == ""
+
+
+def test_token_fornitore_salta_iniziali_e_forme_societarie():
+    assert token_fornitore("D ANGELO COSTRUZIONI SRL") == "ANGELO"
+    assert token_fornitore("F LLI ROSSI") == "ROSSI"
+    assert token_fornitore("SRL BETA") == "BETA"
+    assert token_fornitore("C M B") is None
+
+
+def test_iniziale_non_collega_un_altro_fornitore():
+    indice = _indice(("m1", "12", "BETA DISTRIBUZIONE SPA"))
+    assert indice.cerca_e_consuma("12", "D'ANGELO COSTRUZIONI SRL", "F1") is None
+
+
+def test_collega_sulla_parola_intera():
+    indice = _indice(("m1", "0012", "D'ANGELO COSTRUZIONI"), ("m2", "12", "ROSSINI SNC"))
+    assert indice.cerca_e_consuma("12", "D'ANGELO COSTRUZIONI SRL", "F1") == "m1"
+    # "ROSSI" non e' una parola di "ROSSINI SNC"
+    assert indice.cerca_e_consuma("12", "F.LLI ROSSI", "F2") is None
+
+
+def test_nome_senza_parole_significative_richiede_il_nome_intero():
+    indice = _indice(("m1", "7", "C.M.B."), ("m2", "7", "CMB SRL"))
+    assert indice.cerca_e_consuma("7", "C.M.B.", "F1") == "m1"
+
+
+def test_movimento_consumato_e_ambigui():
+    indice = _indice(("m1", "5", "ROSSI SRL"), ("m2", "5", "ROSSI SPA"), ("m3", "6", "ROSSI SRL"))
+    assert indice.cerca_e_consuma("5", "ROSSI", "F1") is None
+    assert len(indice.ambigui) == 1
+    assert indice.cerca_e_consuma("6", "ROSSI", "F2") == "m3"
+    assert indice.cerca_e_consuma("6", "ROSSI", "F3") is None
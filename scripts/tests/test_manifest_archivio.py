@@ -0,0 +1,129 @@
+import os
+
+import pytest
+
+import manifest_archivio
+from manifest_archivio import ManifestArchivio
+
+
+@pytest.fixture
+def cartella(tmp_path):
+    archivio = tmp_path / "archivio"
+    archivio.mkdir()
+    for nome in ("a.xml", "b.XML", "note.txt"):
+        (archivio / nome).write_text(nome, encoding="utf-8")
+    return archivio
+
+
+@pytest.fixture
+def db(tmp_path):
+    return str(tmp_path / "manifest.sqlite")
+
+
+def test_scansiona_solo_gli_xml(cartella, db):
+    manifest = ManifestArchivio(str(cartella), db)
+    voci = manifest.scansiona()
+    manifest.close()
+    assert sorted(voci) == ["a.xml", "b.XML"]
+    assert voci["a.xml"][0] == len("a.xml")
+
+
+def test_da_processare_nuovi_modificati_e_non_conclusi(cartella, db):
+    manifest = ManifestArchivio(str(cartella), db)
+    voci = manifest.scansiona()
+    assert manifest.da_processare(voci) == ["a.xml", "b.XML"]
+
+    manifest.registra("a.xml", *voci["a.xml"], "sha-a", manifest_archivio.IMPORTATO)
+    manifest.registra("b.XML", *voci["b.XML"], "sha-b", manifest_archivio.ERRORE, "boom")
+    assert manifest.da_processare(voci) == ["b.XML"]
+
+    # mtime cambiato: il file torna da processare (la cartella non cambia, serve forza)
+    os.utime(cartella / "a.xml", (1, 1))
+    assert manifest.da_processare(manifest.scansiona(forza=True)) == ["a.xml", "b.XML"]
+    manifest.close()
+
+
+def test_cartella_invariata_non_viene_riletta(cartella, db, monkeypatch):
+    manifest = ManifestArchivio(str(cartella), db)
+    voci = manifest.scansiona()
+    manifest.close()
+
+    def scandir_vietato(*args):
+        raise AssertionError("cartella riletta")
+
+    monkeypatch.setattr(manifest_archivio.os, "scandir", scandir_vietato)
+    riaperto = ManifestArchivio(str(cartella), db)
+    # I file visti ma mai elaborati restano da processare anche senza riscansione
+    assert riaperto.scansiona() == voci
+    assert riaperto.da_processare(voci) == ["a.xml", "b.XML"]
+    riaperto.close()
+
+
+def test_cartella_cambiata_aggiunge_e_toglie(cartella, db):
+    manifest = ManifestArchivio(str(cartella), db)
+    manifest.scansiona()
+    (cartella / "b.XML").unlink()
+    (cartella / "c.xml").write_text("c", encoding="utf-8")
+    os.utime(cartella, (2, 2))
+    assert sorted(manifest.scansiona()) == ["a.xml", "c.xml"]
+    assert manifest.esito("b.XML") is None
+    assert len(manifest) == 2
+    manifest.close()
+
+
+def test_riscansione_periodica(cartella, db, monkeypatch):
+    manifest = ManifestArchivio(str(cartella), db)
+    manifest.scansiona()
+    (cartella / "a.xml").write_text("modificato", encoding="utf-8")
+    os.utime(cartella / "a.xml", (3, 3))
+    assert manifest.scansiona()["a.xml"] != (len("modificato"), 3)
+    monkeypatch.setattr(manifest_archivio, "RISCANSIONE_OGNI", 0)
+    assert manifest.scansiona()["a.xml"] == (len("modificato"), 3)
+    manifest.close()
+
+
+def test_esiti_persistono_tra_un_run_e_l_altro(cartella, db):
+    manifest = ManifestArchivio(str(cartella), db)
+    voci = manifest.scansiona()
+    manifest.registra_molti([
+        ("a.xml", *voci["a.xml"], "sha-a", manifest_archivio.IMPORTATO, None),
+        ("b.XML", *voci["b.XML"], None, manifest_archivio.IN_CORSO, None),
+    ])
+    manifest.close()
+
+    riaperto = ManifestArchivio(str(cartella), db)
+    assert len(riaperto) == 2
+    assert riaperto.esito("a.xml") == manifest_archivio.IMPORTATO
+    assert riaperto.esito("b.XML") == manifest_archivio.IN_CORSO
+    assert riaperto.esito("c.xml") is None
+    assert riaperto.da_processare(voci) == ["b.XML"]
+    riaperto.close()
+
+    # Stesso db, altra cartella: manifest separati
+    altro = ManifestArchivio(str(cartella.parent), db)
+    assert len(altro) == 0
+    altro.close()
+
+
+def test_stesso_contenuto_solo_per_import_conclusi(cartella, db):
+    manifest = ManifestArchivio(str(cartella), db)
+    manifest.registra("a.xml", 1, 1.0, "sha-a", manifest_archivio.IMPORTATO)
+    manifest.registra("b.XML", 1, 1.0, "sha-b", manifest_archivio.ERRORE)
+    assert manifest.stesso_contenuto("a.xml", "sha-a")
+    assert not manifest.stesso_contenuto("a.xml", "sha-diverso")
+    assert not manifest.stesso_contenuto("a.xml", None)
+    assert not manifest.stesso_contenuto("b.XML", "sha-b")
+
+    # Una registrazione senza hash conserva quello precedente
+    manifest.registra("a.xml", 2, 2.0, None, manifest_archivio.GIA_PRESENTE)
+    assert manifest.stesso_contenuto("a.xml", "sha-a")
+    manifest.close()
+
+
+def test_registro_da_confrontare_per_dimensione_o_percorso(db):
+    registro = manifest_archivio.RegistroStorage("bucket", db)
+    registro.registra("sha-a", "2026/a.pdf", "url-a", 100)
+    assert registro.da_confrontare(100, "2026/b.pdf")
+    assert registro.da_confrontare(200, "2026/a.pdf")
+    assert not registro.da_confrontare(200, "2026/b.pdf")
+    registro.close()
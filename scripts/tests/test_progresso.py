@@ -0,0 +1,42 @@
+import pytest
+
+from progresso import MARKER, Progresso, StepAnnullato, leggi_progresso
+
+
+def test_istantanea_e_limite_di_invio():
+    ricevute = []
+    progresso = Progresso(ricevute.append, intervallo=3600)
+    progresso.fase("elaborazione", totale=4, scansionati=10)
+    progresso.avanza(abbinati=1)
+    progresso.battito()
+    assert len(ricevute) == 1   # fase emette subito, il resto aspetta l'intervallo
+    istantanea = progresso.istantanea()
+    assert (istantanea["fase"], istantanea["elaborati"], istantanea["totale"], istantanea["abbinati"]) == \
+        ("elaborazione", 1, 4, 1)
+    progresso.fine()
+    assert ricevute[-1]["fase"] == "completato"
+
+
+def test_annulla_ferma_lo_script_al_prossimo_aggiornamento():
+    progresso = Progresso()
+    progresso.avanza()
+    progresso.annulla("Timeout (1s superato)")
+    for aggiorna in (progresso.avanza, progresso.battito, progresso.controlla, lambda: progresso.fase("x")):
+        with pytest.raises(StepAnnullato, match="Timeout"):
+            aggiorna()
+
+
+def test_step_annullato_non_e_catturato_da_except_exception():
+    progresso = Progresso()
+    progresso.annulla()
+    with pytest.raises(StepAnnullato):
+        try:
+            progresso.avanza()
+        except Exception:
+            pass
+
+
+def test_leggi_progresso():
+    assert leggi_progresso(MARKER + '{"fase": "x"}') == {"fase": "x"}
+    assert leggi_progresso("altro") is None
+    assert leggi_progresso(MARKER + "{rotto") is None
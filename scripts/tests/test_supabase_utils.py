@@ -0,0 +1,80 @@
+from supabase_utils import a_blocchi, scorri_tabella
+
+
+class _Query:
+    """Query builder minimale (select/gt/in_/order/limit) su una lista di righe."""
+
+    def __init__(self, tabella):
+        self.tabella = tabella
+        self.filtri = []
+        self.limite = None
+
+    def select(self, colonne):
+        self.colonne = [c.strip() for c in colonne.split(",")]
+        return self
+
+    def gt(self, colonna, valore):
+        self.filtri.append(lambda r: r[colonna] > valore)
+        return self
+
+    def in_(self, colonna, valori):
+        self.filtri.append(lambda r: r[colonna] in valori)
+        return self
+
+    def order(self, colonna):
+        self.ordine = colonna
+        return self
+
+    def limit(self, n):
+        self.limite = min(n, self.tabella.max_rows)
+        return self
+
+    def execute(self):
+        self.tabella.richieste += 1
+        righe = sorted((r for r in self.tabella.righe if all(f(r) for f in self.filtri)),
+                       key=lambda r: r[self.ordine])[:self.limite]
+        return type("Risposta", (), {"data": [{c: r[c] for c in self.colonne} for r in righe]})
+
+
+class _Client:
+    """Come PostgREST: ogni select restituisce al massimo `max_rows` righe."""
+
+    def __init__(self, righe, max_rows):
+        self.righe = righe
+        self.max_rows = max_rows
+        self.richieste = 0
+
+    def table(self, nome):
+        return _Query(self)
+
+
+def _righe(n):
+    return [{"id": f"{i:05d}", "tipo": "a" if i % 2 else "b"} for i in range(n)]
+
+
+def test_scorri_tabella_legge_tutte_le_righe():
+    client = _Client(_righe(2500), max_rows=1000)
+    assert [r["id"] for r in scorri_tabella(client, "t", "id")] == [f"{i:05d}" for i in range(2500)]
+
+
+def test_scorri_tabella_con_max_rows_del_server_sotto_page_size():
+    client = _Client(_righe(2500), max_rows=300)
+    assert len(list(scorri_tabella(client, "t", "id", page_size=1000))) == 2500
+
+
+def test_scorri_tabella_applica_i_filtri_e_aggiunge_la_chiave():
+    client = _Client(_righe(10), max_rows=1000)
+    righe = list(scorri_tabella(client, "t", "tipo", filtri=lambda q: q.in_("tipo", ["a"]), page_size=3))
+    assert [r["id"] for r in righe] == ["00001", "00003", "00005", "00007", "00009"]
+    assert all(r["tipo"] == "a" for r in righe)
+
+
+def test_scorri_tabella_vuota():
+    client = _Client([], max_rows=1000)
+    assert list(scorri_tabella(client, "t", "id")) == []
+    assert client.richieste == 1
+
+
+def test_a_blocchi():
+    assert list(a_blocchi([1, 2, 3, 4, 5], 2)) == [[1, 2], [3, 4], [5]]
+    assert list(a_blocchi([], 2)) == []
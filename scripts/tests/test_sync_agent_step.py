@@ -0,0 +1,43 @@
+import sys
+import time
+import types
+
+import pytest
+
+pytest.importorskip("supabase")
+pytest.importorskip("dotenv")
+
+
+@pytest.fixture
+def step_lento(sync_agent, monkeypatch):
+    """Modulo fittizio il cui esegui() avanza all'infinito finche' non viene annullato."""
+    stato = {"finito": False}
+
+    def esegui(client=None, progresso=None):
+        try:
+            while True:
+                time.sleep(0.05)
+                try:
+                    progresso.avanza()
+                except Exception:
+                    pass   # come gli except Exception degli script: non deve fermare l'annullamento
+        finally:
+            stato["finito"] = True
+
+    monkeypatch.setitem(sys.modules, "step_lento_test", types.SimpleNamespace(esegui=esegui))
+    step = {"name": "step_lento_test", "module": "step_lento_test", "label": "Lento", "timeout": 1}
+    return step, stato
+
+
+def test_timeout_in_processo_ferma_davvero_lo_step(sync_agent, step_lento):
+    step, stato = step_lento
+    res = sync_agent.run_step(step)
+    assert res["status"] == "error"
+    assert "Timeout" in res["error"]
+
+    # Lo step annullato esce al prossimo avanza() e rilascia il lock:
+    # un nuovo tentativo non deve aspettare un altro timeout intero
+    lock = sync_agent._step_locks[step["name"]]
+    assert lock.acquire(timeout=2)
+    lock.release()
+    assert stato["finito"]
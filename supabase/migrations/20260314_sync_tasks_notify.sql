@@ -0,0 +1,16 @@
+-- Notifica push all'agent locale quando viene creato un sync_task:
+-- l'agent fa LISTEN sync_tasks e preleva il task subito invece di
+-- interrogare la tabella ogni 5 secondi.
+create or replace function notify_sync_task()
+returns trigger
+language plpgsql as $$
+begin
+  perform pg_notify('sync_tasks', new.id::text);
+  return new;
+end;
+$$;
+
+drop trigger if exists sync_tasks_notify on sync_tasks;
+create trigger sync_tasks_notify
+  after insert on sync_tasks
+  for each row execute function notify_sync_task();
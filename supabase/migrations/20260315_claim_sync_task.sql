@@ -0,0 +1,57 @@
+-- Presa in carico atomica dei sync_task da parte dell'agent.
+--
+-- Prima l'agent faceva SELECT del primo pending e poi UPDATE a running in due
+-- chiamate separate: due agent (o due worker dello stesso agent) potevano
+-- prendere lo stesso task ed eseguire la pipeline due volte in parallelo.
+--
+-- claim_sync_task() blocca il task pending piu' vecchio con FOR UPDATE SKIP
+-- LOCKED (chi arriva dopo salta la riga invece di aspettarla) e lo segna
+-- running nella stessa transazione. Gli altri task pending vengono accorpati
+-- allo stesso run (merged_into = task principale): piu' click su "Sincronizza"
+-- mentre un run e' in coda producono una sola esecuzione, e alla fine l'agent
+-- scrive lo stesso risultato su tutti i task accorpati.
+--
+-- Ritorna le righe prese in carico (prima il task principale), nessuna riga
+-- se la coda e' vuota.
+
+alter table sync_tasks add column if not exists merged_into uuid references sync_tasks(id);
+alter table sync_tasks add column if not exists agent text;
+
+create or replace function claim_sync_task(p_agent text default null)
+returns setof sync_tasks
+language plpgsql as $$
+declare
+  v_id uuid;
+begin
+  select id into v_id
+  from sync_tasks
+  where status = 'pending'
+  order by created_at
+  limit 1
+  for update skip locked;
+
+  if v_id is null then
+    return;
+  end if;
+
+  update sync_tasks
+  set status = 'running', started_at = now(), agent = p_agent
+  where id = v_id;
+
+  return query
+  select * from sync_tasks where id = v_id;
+
+  -- Accorpa gli altri pending non gia' bloccati da un altro agent
+  return query
+  update sync_tasks s
+  set status = 'running', started_at = now(), agent = p_agent, merged_into = v_id
+  where s.id in (
+    select id from sync_tasks
+    where status = 'pending' and id <> v_id
+    for update skip locked
+  )
+  returning s.*;
+end;
+$$;
+
+revoke execute on function claim_sync_task(text) from public, anon, authenticated;
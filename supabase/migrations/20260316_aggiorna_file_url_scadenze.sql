@@ -0,0 +1,19 @@
+-- Aggiornamento file_url di piu' scadenze con una sola chiamata.
+--
+-- import_fatture_pdf carica i PDF in parallelo e a fine run scrive i link
+-- sulle scadenze: con PostgREST un update puo' assegnare un solo valore a
+-- tutte le righe filtrate, quindi servirebbe una chiamata per scadenza.
+-- p_righe: [{"id": "<uuid scadenza>", "file_url": "<url pubblico>"}, ...]
+-- Ritorna gli id effettivamente aggiornati.
+
+create or replace function aggiorna_file_url_scadenze(p_righe jsonb)
+returns setof uuid
+language sql as $$
+  update scadenze_pagamento s
+  set file_url = r.file_url
+  from jsonb_to_recordset(p_righe) as r(id uuid, file_url text)
+  where s.id = r.id
+  returning s.id;
+$$;
+
+revoke execute on function aggiorna_file_url_scadenze(jsonb) from public, anon, authenticated;
@@ -0,0 +1,34 @@
+-- Collegamento fatture di vendita <-> scadenze con una sola chiamata.
+--
+-- fatture_vendita_xml inserisce fatture e scadenze a blocchi; dopo vanno
+-- scritti scadenza_id sulle fatture e fattura_vendita_id sulle scadenze gia'
+-- esistenti ricollegate. Ogni riga ha un valore diverso: con PostgREST
+-- servirebbe un update per riga.
+-- p_fatture:  [{"id": "<uuid fattura>", "scadenza_id": "<uuid scadenza>"}, ...]
+-- p_scadenze: [{"id": "<uuid scadenza>", "fattura_vendita_id": "<uuid fattura>"}, ...]
+-- Ritorna il numero di righe aggiornate (fatture + scadenze).
+
+create or replace function collega_scadenze_vendita(p_fatture jsonb, p_scadenze jsonb)
+returns integer
+language plpgsql as $$
+declare
+  v_fatture integer;
+  v_scadenze integer;
+begin
+  update fatture_vendita f
+  set scadenza_id = r.scadenza_id
+  from jsonb_to_recordset(coalesce(p_fatture, '[]'::jsonb)) as r(id uuid, scadenza_id uuid)
+  where f.id = r.id;
+  get diagnostics v_fatture = row_count;
+
+  update scadenze_pagamento s
+  set fattura_vendita_id = r.fattura_vendita_id
+  from jsonb_to_recordset(coalesce(p_scadenze, '[]'::jsonb)) as r(id uuid, fattura_vendita_id uuid)
+  where s.id = r.id;
+  get diagnostics v_scadenze = row_count;
+
+  return v_fatture + v_scadenze;
+end;
+$$;
+
+revoke execute on function collega_scadenze_vendita(jsonb, jsonb) from public, anon, authenticated;
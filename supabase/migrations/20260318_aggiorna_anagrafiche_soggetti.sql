@@ -0,0 +1,28 @@
+-- Aggiornamento dei campi cambiati di piu' anagrafiche con una sola chiamata.
+--
+-- import_anagrafiche_fornitori_xml scrive solo i campi che differiscono
+-- dall'XML, diversi da soggetto a soggetto: con PostgREST un update assegna
+-- gli stessi valori a tutte le righe filtrate, e un upsert per id controlla
+-- i NOT NULL sulla riga da inserire prima di risolvere il conflitto (fallisce
+-- per ogni colonna obbligatoria non inclusa).
+-- p_righe: [{"id": "<uuid soggetto>", "<campo>": "<valore>", ...}, ...]:
+-- vengono aggiornati solo i campi presenti nell'oggetto, tipo escluso.
+-- Ritorna gli id aggiornati.
+
+create or replace function aggiorna_anagrafiche_soggetti(p_righe jsonb)
+returns setof uuid
+language sql as $$
+  update anagrafica_soggetti s
+  set ragione_sociale = case when r.campi ? 'ragione_sociale' then r.campi->>'ragione_sociale' else s.ragione_sociale end,
+      partita_iva     = case when r.campi ? 'partita_iva'     then r.campi->>'partita_iva'     else s.partita_iva     end,
+      codice_fiscale  = case when r.campi ? 'codice_fiscale'  then r.campi->>'codice_fiscale'  else s.codice_fiscale  end,
+      indirizzo       = case when r.campi ? 'indirizzo'       then r.campi->>'indirizzo'       else s.indirizzo       end,
+      cap             = case when r.campi ? 'cap'             then r.campi->>'cap'             else s.cap             end,
+      comune          = case when r.campi ? 'comune'          then r.campi->>'comune'          else s.comune          end,
+      provincia       = case when r.campi ? 'provincia'       then r.campi->>'provincia'       else s.provincia       end
+  from (select (e->>'id')::uuid as id, e as campi from jsonb_array_elements(p_righe) as e) as r
+  where s.id = r.id
+  returning s.id;
+$$;
+
+revoke execute on function aggiorna_anagrafiche_soggetti(jsonb) from public, anon, authenticated;